@@ -1,9 +1,20 @@
 #!/bin/bash
 
+WHEELHOUSE="${AGENT_WHEELHOUSE:-$HOME/.cache/dojo/wheelhouse}"
+STAMPS=/app/.venv/.modules
+mkdir -p "$STAMPS"
+
 for file in /modules/*; do
     if [ -d "$file" ]; then  # check if the file is a directory
         echo "$file"
-        /app/.venv/bin/pip install -e $file
+        # The code is installed in editable mode, so reinstall only when the packaging metadata changes
+        stamp="$STAMPS/$(basename "$file")"
+        hash=$(cat "$file"/pyproject.toml "$file"/setup.py "$file"/setup.cfg 2>/dev/null | sha256sum | cut -d ' ' -f 1)
+        if [ -f "$stamp" ] && [ "$(cat "$stamp")" = "$hash" ]; then
+            echo "unchanged, skipping"
+            continue
+        fi
+        /app/.venv/bin/pip install --find-links "$WHEELHOUSE/wheels" -e $file && echo "$hash" > "$stamp"
     fi
 done
 
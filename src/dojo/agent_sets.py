@@ -0,0 +1,175 @@
+import asyncio
+import hashlib
+import importlib.metadata
+import json
+import os
+import re
+import shutil
+import tempfile
+import time
+import zipfile
+
+from asyncio import to_thread
+from dataclasses import dataclass, field, asdict
+from typing import Optional
+
+from dojo.core.config import settings
+
+
+MANIFEST = ".agent-set.json"
+
+
+@dataclass
+class AgentSet:
+    name: str
+    packages: list[str] = field(default_factory=list)
+    agents: list[str] = field(default_factory=list)
+    files: int = 0
+    created: float = 0
+
+
+def _normalize(name: str) -> str:
+    return re.sub(r"[-_.]+", "-", name).lower()
+
+
+class AgentStore:
+    """
+    Content-addressed store of the files of agent packages. An agent set is a directory with the unpacked wheels of a
+    few agents and of their dependencies missing from the base environment. Its files are hard links to the objects in
+    the store, so a file is kept on disk once, no matter how many sets use it. Workers of environments created with an
+    agent set put its directory first on sys.path, so its agents take precedence over the installed ones.
+    """
+    def __init__(self, root: str):
+        self.root = os.path.expanduser(root)
+        self.objects = os.path.join(self.root, "objects")
+        self.sets = os.path.join(self.root, "sets")
+        self._lock = asyncio.Lock()
+
+    def path(self, name: str) -> str:
+        path = os.path.realpath(os.path.join(self.sets, name))
+        # The names are validated by the API, this keeps anything else from reaching outside of the store
+        if os.path.dirname(path) != os.path.realpath(self.sets):
+            raise RuntimeError(f"Invalid agent set name '{name}'.")
+        return path
+
+    def exists(self, name: str) -> bool:
+        return os.path.isfile(os.path.join(self.path(name), MANIFEST))
+
+    def _store(self, data: bytes) -> str:
+        digest = hashlib.sha256(data).hexdigest()
+        path = os.path.join(self.objects, digest[:2], digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), delete=False) as f:
+                f.write(data)
+            # The object is shared by every set linking to it, nobody may change it in place
+            os.chmod(f.name, 0o444)
+            os.replace(f.name, path)
+        return path
+
+    @staticmethod
+    def _metadata(wheel: zipfile.ZipFile) -> tuple[str, str, bool]:
+        """
+        Returns the name and version of the wheel's distribution and whether it provides agents.
+        """
+        names = wheel.namelist()
+        dist_info = next(n.split("/")[0] for n in names if n.split("/")[0].endswith(".dist-info"))
+        metadata = wheel.read(f"{dist_info}/METADATA").decode(errors="replace")
+        name = re.search(r"^Name: (.+)$", metadata, re.MULTILINE).group(1).strip()
+        version = re.search(r"^Version: (.+)$", metadata, re.MULTILINE).group(1).strip()
+        entry_points = f"{dist_info}/entry_points.txt"
+        agent = entry_points in names and "[cyst.services]" in wheel.read(entry_points).decode(errors="replace")
+        return name, version, agent
+
+    @staticmethod
+    def _target(filename: str) -> Optional[str]:
+        parts = filename.split("/")
+        if parts[0].endswith(".data"):
+            # Only the importable parts, scripts, headers and data files are of no use to the workers
+            if len(parts) < 3 or parts[1] not in ("purelib", "platlib"):
+                return None
+            parts = parts[2:]
+        target = os.path.normpath(os.path.join(*parts))
+        if os.path.isabs(target) or target.startswith(".."):
+            return None
+        return target
+
+    def _link(self, source: str, destination: str) -> None:
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        try:
+            os.link(source, destination)
+        except OSError:
+            # E.g., a file system without hard links
+            shutil.copyfile(source, destination)
+
+    def _provision(self, name: str, wheels: list[str]) -> AgentSet:
+        base = {_normalize(dist.name) for dist in importlib.metadata.distributions() if dist.name}
+        os.makedirs(self.sets, exist_ok=True)
+        directory = tempfile.mkdtemp(dir=self.sets, prefix=f".{name}-")
+        agent_set = AgentSet(name, created=time.time())
+        try:
+            for wheel_path in wheels:
+                with zipfile.ZipFile(wheel_path) as wheel:
+                    dist_name, version, agent = self._metadata(wheel)
+                    # Dependencies from the base environment (cyst itself in the first place) are already imported by
+                    # the forked workers, another copy would only shadow them
+                    if not agent and _normalize(dist_name) in base:
+                        continue
+                    for info in wheel.infolist():
+                        target = None if info.is_dir() else self._target(info.filename)
+                        if target:
+                            self._link(self._store(wheel.read(info)), os.path.join(directory, target))
+                            agent_set.files += 1
+                    agent_set.packages.append(f"{dist_name}=={version}")
+                    if agent:
+                        agent_set.agents.append(dist_name)
+
+            with open(os.path.join(directory, MANIFEST), "w") as f:
+                json.dump(asdict(agent_set), f)
+            os.chmod(directory, 0o755)
+            os.rename(directory, self.path(name))
+        except BaseException:
+            shutil.rmtree(directory, ignore_errors=True)
+            raise
+        return agent_set
+
+    def _remove(self, name: str) -> None:
+        shutil.rmtree(self.path(name))
+        # Objects not linked from any set anymore
+        for directory, _, files in os.walk(self.objects):
+            for f in files:
+                path = os.path.join(directory, f)
+                if os.stat(path).st_nlink == 1:
+                    os.remove(path)
+
+    def _list(self) -> list[AgentSet]:
+        result = []
+        if not os.path.isdir(self.sets):
+            return result
+        for entry in sorted(os.scandir(self.sets), key=lambda e: e.name):
+            if entry.name.startswith(".") or not self.exists(entry.name):
+                continue
+            with open(os.path.join(entry.path, MANIFEST)) as f:
+                result.append(AgentSet(**json.load(f)))
+        return result
+
+    async def create(self, name: str, wheels: list[str]) -> AgentSet:
+        """
+        Provisions a new agent set from the wheels. Raises RuntimeError if the set already exists.
+        """
+        async with self._lock:
+            if self.exists(name):
+                raise RuntimeError(f"Agent set '{name}' already exists.")
+            return await to_thread(self._provision, name, wheels)
+
+    async def remove(self, name: str) -> None:
+        async with self._lock:
+            if not self.exists(name):
+                raise RuntimeError(f"Agent set '{name}' does not exist.")
+            await to_thread(self._remove, name)
+
+    async def list(self) -> list[AgentSet]:
+        return await to_thread(self._list)
+
+
+agent_store = AgentStore(settings.AGENT_STORE)
@@ -0,0 +1,303 @@
+import asyncio
+import hashlib
+import importlib
+import importlib.metadata
+import json
+import os
+import re
+import sys
+import tempfile
+import time
+
+from asyncio import to_thread
+from collections import defaultdict
+from dataclasses import dataclass
+from typing import Optional
+from urllib.parse import urlparse, urlunparse
+from urllib.request import url2pathname
+
+from dojo.core.config import settings
+from dojo.jobs import jobs, Job
+
+
+@dataclass
+class PackageEntry:
+    module_name: str
+    package_name: str
+    package_version: str
+    code_path: str
+    git_repo: bool
+
+
+# Names of the directories on sys.path which distributions get installed into
+SITE_DIRECTORIES = ("site-packages", "dist-packages")
+
+
+@dataclass(frozen=True)
+class _Distribution:
+    name: str
+    version: str
+    code_path: str
+
+
+class AgentRegistry:
+    """
+    Keeps the list of agents (entry points in the 'cyst.services' group) between requests. The list is rebuilt only when
+    it is invalidated or when a site-packages directory on sys.path changes, e.g., after a package was installed or
+    removed outside of dojo. Even then, only distributions that were not seen before are inspected. Whether the code of an agent lives
+    in a git repository is resolved lazily and concurrently for all new code paths.
+    """
+    def __init__(self):
+        self._entries: Optional[list[tuple[str, _Distribution]]] = None
+        self._signature: Optional[tuple] = None
+        self._distributions: dict[tuple, _Distribution] = {}
+        self._git_repos: dict[str, bool] = {}
+        self._lock = asyncio.Lock()
+        self._version = 0
+        self._version_signature: Optional[tuple] = None
+
+    @staticmethod
+    def _path_signature() -> tuple:
+        signature = []
+        for path in sys.path:
+            # Distributions are installed there, other entries (e.g., the working directory) change for unrelated reasons
+            if os.path.basename(os.path.normpath(path)) not in SITE_DIRECTORIES:
+                continue
+            try:
+                signature.append((path, os.stat(path or ".").st_mtime_ns))
+            except OSError:
+                pass
+        return tuple(signature)
+
+    def _distribution(self, dist: importlib.metadata.Distribution) -> _Distribution:
+        path = getattr(dist, "_path", None)
+        try:
+            key = (str(path), os.stat(path).st_mtime_ns) if path else (dist.name, dist.version)
+        except OSError:
+            key = (dist.name, dist.version)
+
+        if key not in self._distributions:
+            code_path = ""
+            # pip, poetry does not work
+            direct_url = dist.read_text("direct_url.json")
+            if direct_url:
+                direct_url = json.loads(direct_url)
+                # Packages installed from a wheel file have no code to point to
+                if "archive_info" not in direct_url:
+                    code_path = url2pathname(urlparse(direct_url.get("url")).path)
+            self._distributions[key] = _Distribution(dist.name, dist.version, code_path)
+        return self._distributions[key]
+
+    def _scan(self) -> list[tuple[str, _Distribution]]:
+        importlib.invalidate_caches()
+        return [(entry_point.name, self._distribution(entry_point.dist))
+                for entry_point in importlib.metadata.entry_points(group="cyst.services")]
+
+    @staticmethod
+    async def _is_git_repo(code_path: str) -> bool:
+        if not code_path:
+            return False
+        process = await asyncio.create_subprocess_exec("git", "-C", code_path, "rev-parse",
+                                                       stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL)
+        return await process.wait() == 0
+
+    def invalidate(self) -> None:
+        self._entries = None
+        self._version += 1
+
+    @property
+    def version(self) -> int:
+        """
+        Increases whenever the installed agents may have changed. Workers started at an older version are stale.
+        """
+        signature = self._path_signature()
+        if signature != self._version_signature:
+            if self._version_signature is not None:
+                self._version += 1
+            self._version_signature = signature
+        return self._version
+
+    async def list(self) -> list[PackageEntry]:
+        async with self._lock:
+            signature = self._path_signature()
+            if self._entries is None or signature != self._signature:
+                self._entries = await to_thread(self._scan)
+                self._signature = signature
+
+            unresolved = list({dist.code_path for _, dist in self._entries if dist.code_path not in self._git_repos})
+            for code_path, git_repo in zip(unresolved, await asyncio.gather(*map(self._is_git_repo, unresolved))):
+                self._git_repos[code_path] = git_repo
+
+            return [PackageEntry(module_name, dist.name, dist.version, dist.code_path, self._git_repos[dist.code_path])
+                    for module_name, dist in self._entries]
+
+
+agent_registry = AgentRegistry()
+
+# Anything that changes the installed packages has to hold this lock, pip does not cope with concurrent changes
+site_packages_lock = asyncio.Lock()
+
+
+async def run_pip(*args: str, job: Optional[Job] = None) -> tuple[int, str]:
+    """
+    Runs pip without blocking the event loop and streams its output into the job log. Returns the exit code and the
+    complete output.
+    """
+    process = await asyncio.create_subprocess_exec(sys.executable, "-m", "pip", *args,
+                                                   stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT)
+    output = []
+    try:
+        async for line in process.stdout:
+            line = line.decode(errors="replace").rstrip()
+            output.append(line)
+            jobs.log(job, line)
+        return await process.wait(), "\n".join(output)
+    except asyncio.CancelledError:
+        process.kill()
+        await process.wait()
+        raise
+
+
+async def _git_revision(url: str, ref: str) -> Optional[str]:
+    if re.fullmatch(r"[0-9a-f]{40}", ref):
+        return ref
+    process = await asyncio.create_subprocess_exec("git", "ls-remote", url, ref or "HEAD",
+                                                   stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL,
+                                                   env={**os.environ, "GIT_TERMINAL_PROMPT": "0"})
+    stdout, _ = await process.communicate()
+    if process.returncode != 0:
+        return None
+    revision = None
+    for line in stdout.decode().splitlines():
+        sha, name = line.split("\t", 1)
+        # Annotated tags are listed twice, the peeled entry points to the commit
+        if name.endswith("^{}"):
+            return sha
+        revision = revision or sha
+    return revision
+
+
+async def _pypi_version(name: str) -> Optional[str]:
+    returncode, output = await run_pip("index", "versions", name)
+    match = re.search(r"\(([^)]+)\)", output) if returncode == 0 else None
+    return match.group(1) if match else None
+
+
+class Wheelhouse:
+    """
+    Persistent cache of built agents. An agent is built into wheels, including its dependencies, once for each source
+    commit (git) or version (PyPI). The wheels are kept in one flat directory, which pip uses as a local index, and the
+    wheels of each build are listed in a manifest. Installing an agent that was already built then needs neither a
+    build nor the network. When the source cannot be resolved (e.g., offline), the latest build of it is used.
+    """
+    def __init__(self, root: str):
+        self.root = os.path.expanduser(root)
+        self.wheels = os.path.join(self.root, "wheels")
+        self.builds = os.path.join(self.root, "builds")
+        self._locks: dict[str, asyncio.Lock] = defaultdict(asyncio.Lock)
+
+    @staticmethod
+    async def _resolve(installable: str) -> tuple[Optional[str], str, Optional[str]]:
+        """
+        Returns the identity of the source (without credentials), the installable pinned to the resolved revision,
+        and the revision itself, if it can be resolved. Local paths and archive URLs have no identity, as their content
+        can change at any time, and neither do requirements with version ranges. Raises RuntimeError for an invalid
+        requirement.
+        """
+        if installable.startswith("git+"):
+            url = urlparse(installable[4:])
+            path, _, ref = url.path.partition("@")
+            remote = urlunparse(url._replace(path=path, fragment=""))
+            source = urlunparse(url._replace(netloc=url.netloc.rpartition("@")[2]))
+            revision = await _git_revision(remote, ref)
+            if revision:
+                installable = "git+" + urlunparse(url._replace(path=f"{path}@{revision}"))
+            return source, installable, revision
+
+        if "/" in installable or "\\" in installable:
+            return None, installable, None
+
+        match = re.match(r"\s*([A-Za-z0-9._-]+)\s*(==\s*([^\s;,]+))?", installable)
+        if not match:
+            raise RuntimeError(f"'{installable}' is not a valid requirement.")
+        name, pinned, version = match.groups()
+        if pinned and "," not in installable and "*" not in version:
+            return installable, installable, version
+        if installable.strip() != name:
+            # Other specifiers may exclude the latest version, so such builds are not cached
+            return None, installable, None
+        # Without a version, the build is pinned to and keyed by the latest released one
+        revision = await _pypi_version(name)
+        return installable, f"{name}=={revision}" if revision else installable, revision
+
+    def _manifest_path(self, source: str, revision: str) -> str:
+        return os.path.join(self.builds, hashlib.sha256(f"{source}@{revision}".encode()).hexdigest() + ".json")
+
+    def _complete(self, manifest: Optional[dict]) -> Optional[dict]:
+        # Builds cached before the wheel of the installable itself was recorded are made again
+        if manifest and "top" in manifest and all(os.path.exists(os.path.join(self.wheels, wheel)) for wheel in manifest["wheels"]):
+            return manifest
+        return None
+
+    def _manifest(self, source: str, revision: Optional[str]) -> Optional[dict]:
+        if revision:
+            try:
+                with open(self._manifest_path(source, revision)) as f:
+                    return self._complete(json.load(f))
+            except (OSError, ValueError):
+                return None
+
+        latest = None
+        for entry in os.scandir(self.builds) if os.path.isdir(self.builds) else []:
+            try:
+                with open(entry.path) as f:
+                    manifest = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if manifest["source"] == source and (not latest or manifest["created"] > latest["created"]):
+                latest = manifest
+        return self._complete(latest)
+
+    def _save(self, manifest: dict) -> None:
+        path = self._manifest_path(manifest["source"], manifest["revision"])
+        with tempfile.NamedTemporaryFile("w", dir=self.builds, delete=False) as f:
+            json.dump(manifest, f)
+        os.replace(f.name, path)
+
+    async def build(self, installable: str, job: Optional[Job] = None) -> list[str]:
+        """
+        Returns the paths to the wheels of the installable and its dependencies, building them if needed. The wheel of
+        the installable itself comes first. Raises RuntimeError with the pip output if the build fails.
+        """
+        source, installable, revision = await self._resolve(installable)
+        async with self._locks[source or installable]:
+            if source and (manifest := await to_thread(self._manifest, source, revision)):
+                jobs.log(job, f"Using the cached build of {source} at {manifest['revision']}.")
+                return [os.path.join(self.wheels, wheel) for wheel in manifest["wheels"]]
+
+            os.makedirs(self.wheels, exist_ok=True)
+            os.makedirs(self.builds, exist_ok=True)
+            # Build next to the wheelhouse, so the wheels can be moved atomically
+            with tempfile.TemporaryDirectory(dir=self.root) as build_dir:
+                # The installable alone first, so its own wheel is known, then its dependencies from that wheel
+                returncode, output = await run_pip("wheel", "--no-deps", "--wheel-dir", build_dir, "--find-links",
+                                                   self.wheels, installable, job=job)
+                if returncode != 0:
+                    raise RuntimeError(output)
+                top = next(f for f in os.listdir(build_dir) if f.endswith(".whl"))
+                returncode, output = await run_pip("wheel", "--wheel-dir", build_dir, "--find-links", self.wheels,
+                                                   os.path.join(build_dir, top), job=job)
+                if returncode != 0:
+                    raise RuntimeError(output)
+
+                wheels = [top] + sorted(f for f in os.listdir(build_dir) if f.endswith(".whl") and f != top)
+                for wheel in wheels:
+                    os.replace(os.path.join(build_dir, wheel), os.path.join(self.wheels, wheel))
+
+            if source and revision:
+                await to_thread(self._save, {"source": source, "revision": revision, "top": top, "wheels": wheels,
+                                             "created": time.time()})
+            return [os.path.join(self.wheels, wheel) for wheel in wheels]
+
+
+wheelhouse = Wheelhouse(settings.AGENT_WHEELHOUSE)
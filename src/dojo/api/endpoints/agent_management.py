@@ -1,16 +1,18 @@
-import importlib.metadata
-import json
 import os
 import shutil
-import subprocess
-import sys
 
-from dataclasses import dataclass
+from asyncio import gather, to_thread
 from fastapi import APIRouter, HTTPException, status
-from urllib.request import url2pathname
 from urllib.parse import urlparse, urlunparse
 
-from dojo.schemas.agents import AgentAddition, AgentRemoval, AgentMethod
+from dojo.agent_sets import agent_store, AgentSet
+from dojo.agents import agent_registry, PackageEntry, run_pip, site_packages_lock, wheelhouse
+from dojo.controller import environments, ActionResponse, EnvironmentState
+from dojo.api.endpoints.jobs import accepted, AsyncQuery, async_responses
+from dojo.api.responses import FastJSONResponse
+from dojo.jobs import jobs, Job
+from dojo.lib.importtime import profile_imports, ImportReport
+from dojo.schemas.agents import AgentAddition, AgentRemoval, AgentMethod, AgentSetCreation, AgentSetRemoval
 
 router = APIRouter(
     prefix="/agents",
@@ -20,47 +22,43 @@ router = APIRouter(
     },
 )
 
-@dataclass
-class PackageEntry:
-    module_name: str
-    package_name: str
-    package_version: str
-    code_path: str
-    git_repo: bool
-
-
 @router.get("/list", status_code=status.HTTP_200_OK)
 async def list_agents() -> list[PackageEntry]:
-    result = []
-    entry_points = importlib.metadata.entry_points(group='cyst.services')
-    for entry_point in entry_points:
-        module_name = entry_point.name
-        module_package = entry_point.dist
-        code_path = ""
-
-        # pip, poetry does not work
-        try:
-            for f in module_package.files:
-                if f.match("*direct_url.json"):
-                    j = json.loads(f.read_text())
-                    code_url = urlparse(j.get("url")).path
-                    code_path = url2pathname(code_url)
-                    break
-        except FileNotFoundError:
-            pass
-
-        version = module_package.version
-
-        git_info = subprocess.run(['git', '-C', code_path, 'rev-parse'], capture_output=True, text=True)
-        local_git_repo = git_info.returncode == 0
-
-        result.append(PackageEntry(module_name, module_package.name, version, code_path, local_git_repo))
+    return FastJSONResponse(await agent_registry.list())
 
-    return result
+
+import_profile_description = """
+Measures the imports done when starting the API process and an environment worker in a fresh interpreter, aggregated
+by top level package and attributed to the installed agents. Workers only import the cyst components and agents on top
+of what the API process already imported.
+"""
+
+
+@router.get("/import-profile", status_code=status.HTTP_200_OK, description=import_profile_description)
+async def import_profile() -> list[ImportReport]:
+    agents = {agent.package_name for agent in await agent_registry.list()}
+    try:
+        return FastJSONResponse(await profile_imports(agents))
+    except RuntimeError as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+add_description = """
+Builds the agent package and its dependencies into the wheelhouse, then installs them from it. A build is reused until
+the source commit or version changes. Builds of independent agents run in parallel, changes to the installed packages
+are done one at a time. With `async=true`, the installation runs as a job, whose output can be followed at
+`/ws/jobs/{job_id}`.
+"""
 
 
-@router.post("/add", status_code=status.HTTP_201_CREATED)
-async def add_agent(agent: AgentAddition) -> list[PackageEntry]:
+@router.post("/add", status_code=status.HTTP_201_CREATED, description=add_description, responses=async_responses)
+async def add_agent(agent: AgentAddition, run_async: AsyncQuery = False) -> list[PackageEntry]:
+    if run_async:
+        return accepted(jobs.submit("add_agent", None, lambda job: install_agent(agent, job)))
+    return FastJSONResponse(await install_agent(agent), status_code=status.HTTP_201_CREATED)
+
+
+def installable_from(agent: AgentAddition) -> str:
     if agent.method == AgentMethod.GIT:
         url_path = list(urlparse(agent.path))
 
@@ -71,20 +69,31 @@ async def add_agent(agent: AgentAddition) -> list[PackageEntry]:
                     agent.user = "__user"
                 url_path[1] = f"{agent.user}:{agent.access_token}@" + url_path[1]
 
-        installable = f"git+{urlunparse(url_path)}"
+        return f"git+{urlunparse(url_path)}"
     else: # PYPI package name
-        installable = agent.path
+        return agent.path
+
 
+async def install_agent(agent: AgentAddition, job: Job | None = None) -> list[PackageEntry]:
+    installable = installable_from(agent)
     old_packages = await list_agents()
 
-    # Install the agent directly from the Git repository using pip
-    pip_command = [sys.executable, '-m', 'pip', 'install', installable]
-    pip_info = subprocess.run(pip_command, capture_output=True, text=True)
+    # Building (cloning, resolving, compiling) does not touch the installed packages, so it can run in parallel
+    try:
+        wheels = await wheelhouse.build(installable, job=job)
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=f"Failed to build the package from '{installable}'. Reason: {e}")
+
+    async with site_packages_lock:
+        # Only the agent itself is named, so pip keeps the installed packages which satisfy its dependencies (e.g.,
+        # cyst-core) and takes the missing ones from the wheelhouse
+        returncode, output = await run_pip("install", "--no-index", "--find-links", wheelhouse.wheels, wheels[0], job=job)
+        agent_registry.invalidate()
 
     # Check for any errors during the pip install process
-    if pip_info.returncode != 0:
+    if returncode != 0:
         raise HTTPException(status_code=409,
-                            detail=f"Failed to install the package from '{installable}'. Reason: {pip_info.stderr}")
+                            detail=f"Failed to install the package from '{installable}'. Reason: {output}")
 
     new_packages = await list_agents()
 
@@ -107,9 +116,14 @@ async def add_agent(agent: AgentAddition) -> list[PackageEntry]:
     return result
 
 
-@router.post("/remove", status_code=status.HTTP_200_OK)
-async def remove_agent(remove: AgentRemoval) -> dict:
-    result = {}
+@router.post("/remove", status_code=status.HTTP_200_OK, responses=async_responses)
+async def remove_agent(remove: AgentRemoval, run_async: AsyncQuery = False) -> dict:
+    if run_async:
+        return accepted(jobs.submit("remove_agent", None, lambda job: uninstall_agent(remove, job)))
+    return FastJSONResponse(await uninstall_agent(remove))
+
+
+async def uninstall_agent(remove: AgentRemoval, job: Job | None = None) -> dict:
     by_package = {}
     module_to_remove = None
 
@@ -124,6 +138,9 @@ async def remove_agent(remove: AgentRemoval) -> dict:
 
         by_package[agent.package_name].append(agent.module_name)
 
+    if not module_to_remove:
+        raise HTTPException(status_code=404, detail=f"No agent found in the package '{remove.name}'.")
+
     # If there is more than one module in the package, do not remove unless forced
     if len(by_package[module_to_remove.package_name]) > 1 and not remove.force:
         return {"success": False, "reason": f"More then one module in the package '{module_to_remove.package_name}', "
@@ -135,16 +152,92 @@ async def remove_agent(remove: AgentRemoval) -> dict:
         return {"success": False, "reason": f"Code deletion requires forcing."}
 
     # Remove pip entry
-    pip_command = [sys.executable, '-m', 'pip', 'uninstall', '-y', module_to_remove.package_name]
-    pip_info = subprocess.run(pip_command, capture_output=True, text=True)
-    if pip_info.returncode != 0:
-        raise HTTPException(status_code=409, detail=f"Failed to uninstall the required agent. Reason: '{pip_info.stderr}'.")
+    async with site_packages_lock:
+        returncode, output = await run_pip("uninstall", "-y", module_to_remove.package_name, job=job)
+        agent_registry.invalidate()
+    if returncode != 0:
+        raise HTTPException(status_code=409, detail=f"Failed to uninstall the required agent. Reason: '{output}'.")
 
     if remove.delete_code and module_to_remove.code_path:
-        shutil.rmtree(module_to_remove.code_path, ignore_errors=True)
+        await to_thread(shutil.rmtree, module_to_remove.code_path, ignore_errors=True)
         return {"success": True, "message": f"Module '{module_to_remove.module_name}' "
                                             f"in the package '{module_to_remove.package_name}' "
                                             f"was removed including the code at '{module_to_remove.code_path}'."}
     else:
         return {"success": True, "message": f"Module '{module_to_remove.module_name}' "
                                             f"in the package '{module_to_remove.package_name}' was removed."}
+
+
+refresh_description = """
+Loads the agents installed or removed since their workers started into the environments that were not initialized yet.
+New agents are loaded in place, workers that cannot be refreshed in place are replaced. Other environments keep their
+agents, stale ones are refreshed when they are configured or initialized.
+"""
+
+
+@router.post("/refresh", status_code=status.HTTP_200_OK, description=refresh_description)
+async def refresh_agents() -> list[ActionResponse]:
+    stale = [env for env in environments.values() if env.agents_stale and env.state == EnvironmentState.CREATED.name]
+    results = await gather(*(env.refresh_agents() for env in stale), return_exceptions=True)
+
+    responses = []
+    for result in results:
+        if isinstance(result, HTTPException):
+            responses.append(result.detail)
+        elif isinstance(result, BaseException):
+            raise result
+        else:
+            responses.append(result)
+    return FastJSONResponse(responses)
+
+
+@router.get("/sets", status_code=status.HTTP_200_OK)
+async def list_agent_sets() -> list[AgentSet]:
+    return FastJSONResponse(await agent_store.list())
+
+
+create_set_description = """
+Creates a named set of agents, which environments can take their agents from (`agent_set`) instead of the installed
+ones. This way, different versions of an agent can be used side by side. The agents are built into the wheelhouse and
+their files, with dependencies missing from the base environment, are linked from a content-addressed store, so files
+shared by several sets are stored only once.
+"""
+
+
+@router.post("/sets", status_code=status.HTTP_201_CREATED, description=create_set_description, responses=async_responses)
+async def create_agent_set(agent_set: AgentSetCreation, run_async: AsyncQuery = False) -> AgentSet:
+    if agent_store.exists(agent_set.name):
+        raise HTTPException(status_code=409, detail=f"Agent set '{agent_set.name}' already exists.")
+    if run_async:
+        return accepted(jobs.submit("create_agent_set", None, lambda job: provision_agent_set(agent_set, job)))
+    return FastJSONResponse(await provision_agent_set(agent_set), status_code=status.HTTP_201_CREATED)
+
+
+async def provision_agent_set(agent_set: AgentSetCreation, job: Job | None = None) -> AgentSet:
+    installables = [installable_from(agent) for agent in agent_set.agents]
+    builds = await gather(*(wheelhouse.build(installable, job=job) for installable in installables), return_exceptions=True)
+
+    wheels = []
+    for installable, build in zip(installables, builds):
+        if isinstance(build, RuntimeError):
+            raise HTTPException(status_code=409, detail=f"Failed to build the package from '{installable}'. Reason: {build}")
+        elif isinstance(build, BaseException):
+            raise build
+        wheels.extend(build)
+
+    try:
+        return await agent_store.create(agent_set.name, list(dict.fromkeys(wheels)))
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+
+@router.post("/sets/remove", status_code=status.HTTP_200_OK)
+async def remove_agent_set(remove: AgentSetRemoval) -> dict:
+    users = [env.id for env in environments.values() if env.agent_set == remove.name]
+    if users:
+        raise HTTPException(status_code=409, detail=f"Agent set '{remove.name}' is used by environments {', '.join(users)}.")
+    try:
+        await agent_store.remove(remove.name)
+    except RuntimeError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    return FastJSONResponse({"success": True, "message": f"Agent set '{remove.name}' was removed."})
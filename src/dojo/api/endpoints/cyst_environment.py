@@ -2,21 +2,31 @@ import asyncio
 import base64
 import json
 import socket
-from typing import Any
+import uuid
+from typing import Any, Annotated, Literal, Optional
 
-from fastapi import APIRouter, HTTPException, status
-from fastapi.responses import JSONResponse
+from fastapi import APIRouter, HTTPException, Query, status
+from fastapi.responses import JSONResponse, StreamingResponse, PlainTextResponse
 from pathlib import Path
 
-from dataclasses import asdict
-from dojo.schemas.environment import Environment, EnvironmentOut, Parametrization
+from dataclasses import dataclass, field
+from dojo.schemas.environment import Environment, PlacementPolicy, EnvironmentOut, Parametrization, EnvironmentBatch, EnvironmentIds, EnvironmentWaitOut, EnvironmentPage
 from dojo.schemas.configuration import ScenarioOut, AvailableConfigurations
-from dojo.controller import environments, EnvironmentWrapper, EnvironmentAction, ActionResponse, EnvironmentState
-from dojo.lib import util
+from dojo.controller import environments, EnvironmentWrapper, EnvironmentAction, ActionResponse, EnvironmentState, repin_shared_workers, ResetMode
+from dojo.jobs import jobs, Job
+from dojo.agent_sets import agent_store
+from dojo.scheduler import scheduler, SchedulerStatus, ResourcesUnavailable
+from dojo.watchdog import watchdog
+from dojo.nodes import nodes, Node, LOCAL_NODE
+from dojo.api.endpoints.nodes import node_usage
+from dojo.api.endpoints.jobs import accepted, AsyncQuery, async_responses
+from dojo.api.responses import FastJSONResponse
+from dojo.lib import util, export
+from dojo.lib.export import ExportTable, ExportFormat
+from dojo.lib.profiling import ProfileMode
+from dojo.lib.placement import core_pool
 
 
-async_lock = asyncio.Lock()
-
 router = APIRouter(
     prefix="/environment",
     tags=["environments"],
@@ -30,7 +40,22 @@ def get_environment_wrapper(id: str) -> EnvironmentWrapper:
     try:
         return environments[id]
     except KeyError:
-        raise HTTPException(status_code=404, detail=asdict(ActionResponse(id, EnvironmentState.TERMINATED.name, False, "The environment with the given id was not found.")))
+        # Environments terminated by the watchdog are gone, but not without a reason
+        reason = watchdog.reason(id)
+        raise HTTPException(status_code=404, detail=reason or ActionResponse(id, EnvironmentState.TERMINATED.name, False, "The environment with the given id was not found."))
+
+
+def submit_action(id: str, action: EnvironmentAction, param: Any = None) -> FastJSONResponse:
+    wrapper = get_environment_wrapper(id)
+    return accepted(jobs.submit(action, id, lambda job: wrapper.perform_action(action, param)))
+
+
+@dataclass
+class BatchItemResult:
+    id: str | None
+    success: bool
+    responses: list[ActionResponse] = field(default_factory=list)
+    error: Any = None
 
 
 platform_type_description = """
@@ -44,12 +69,42 @@ platform_type_description = """
     "/create/",
     status_code=status.HTTP_201_CREATED,
     description=platform_type_description,
+    responses=async_responses,
 )
-async def create(env: Environment) -> ActionResponse:
+async def create(env: Environment, run_async: AsyncQuery = False) -> ActionResponse:
+    if run_async:
+        return accepted(jobs.submit("create", env.id, lambda job: create_environment(env)))
+    # A synchronous request is not held open while waiting for admission, that is what the asynchronous one is for
+    return FastJSONResponse(await create_environment(env, wait=False), status_code=status.HTTP_201_CREATED)
+
+
+async def admit_environment(env_id: str, memory: int, priority: int, wait: bool = True) -> int:
+    """
+    Waits until the scheduler admits a new environment, then allocates its agent manager port. Without waiting, the
+    environment is refused if it cannot be admitted right away.
+    """
+    try:
+        admitted = await scheduler.acquire(env_id, {"environments": 1, "memory": memory}, priority, wait)
+    except ResourcesUnavailable as e:
+        raise HTTPException(status_code=503, detail=f"{e} Use the asynchronous request (async=true) to wait in the queue.")
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    if not admitted or env_id in environments:
+        raise HTTPException(status_code=409, detail=ActionResponse(env_id, "", False, f"Environment with id {env_id} already exists, cannot create a new one."))
+
+    try:
+        return util.agent_port_allocator.allocate()
+    except RuntimeError as e:
+        scheduler.release(env_id)
+        raise HTTPException(status_code=503, detail=str(e))
+
+
+async def create_environment(env: Environment, wait: bool = True) -> ActionResponse:
     if env.id and env.id in environments:
-        raise HTTPException(status_code=409, detail=asdict(ActionResponse(env.id, "", False, f"Environment with id {env.id} already exists, cannot create a new one.")))
+        raise HTTPException(status_code=409, detail=ActionResponse(env.id, "", False, f"Environment with id {env.id} already exists, cannot create a new one."))
 
     config_str = None
+    config_name = None
     if env.configuration:
         if len(env.configuration) < 256:
             try:
@@ -59,41 +114,181 @@ async def create(env: Environment) -> ActionResponse:
 
             with open(json_configuration_path, "r") as f:
                 config_str = f.read()
+            config_name = env.configuration
         if not config_str:
             config_str = base64.b64decode(env.configuration).decode("utf-8")
 
-    async with async_lock:
-        agent_env_port = await util.set_first_available_env_manager_port()
+    if env.agent_set and not agent_store.exists(env.agent_set):
+        raise HTTPException(status_code=404, detail=f"Agent set '{env.agent_set}' does not exist.")
+
+    env_id = env.id or str(uuid.uuid4())
+    dedicated = env.placement.policy == PlacementPolicy.DEDICATED
+    node = select_node(env)
+    if node:
+        ew = remote_environment(env, env_id, node, config_str, config_name)
+    else:
+        ew = await local_environment(env, env_id, config_str, config_name, wait)
+
+    async def start() -> ActionResponse:
+        response = await ew.start()
+        environments[str(ew.id)] = ew
+        if dedicated:
+            # Move everyone else off the newly dedicated cores
+            repin_shared_workers()
+        return response
+
+    # Once the worker is spawned, it must get registered even if the caller goes away
+    return await asyncio.shield(start())
+
+
+def select_node(env: Environment) -> Optional[Node]:
+    """
+    The node to host a new environment, None for this host. Environments with cores or an agent set stay on this host,
+    unless a node is requested explicitly, which is refused. The scheduler budgets are those of this host, environments
+    on nodes are admitted by the capacity of the node instead (which the node daemon enforces as well).
+    """
+    if env.node == LOCAL_NODE:
+        return None
+    local_only = env.placement.policy == PlacementPolicy.DEDICATED or env.placement.cores or env.agent_set
+    if env.node:
+        if env.node not in nodes:
+            raise HTTPException(status_code=404, detail=f"Node '{env.node}' is not registered.")
+        if local_only:
+            raise HTTPException(status_code=409, detail="Cores and agent sets can only be given to environments on this host.")
+        node = nodes[env.node]
+        if node_usage().get(node.name, 0) >= node.capacity:
+            raise HTTPException(status_code=503, detail=f"Node '{node.name}' is full, it hosts {node.capacity} environments.")
+        return node
+    if local_only:
+        return None
+    return nodes.select(node_usage())
+
+
+def remote_environment(env: Environment, env_id: str, node: Node, config_str: str, config_name: Optional[str]) -> EnvironmentWrapper:
+    ew = EnvironmentWrapper(env.platform, env_id, config_str, env.parameters, 0, config_name, env.resources.cpu,
+                            env.priority, None, False, env.placement.nice, None, env.resources.memory, node)
+    ew.memory_soft_limit, ew.memory_hard_limit = env.resources.memory_soft_limit, env.resources.memory_hard_limit
+    return ew
+
+
+async def local_environment(env: Environment, env_id: str, config_str: str, config_name: Optional[str],
+                            wait: bool = True) -> EnvironmentWrapper:
+    agent_env_port = await admit_environment(env_id, env.resources.memory, env.priority, wait)
+
+    dedicated = env.placement.policy == PlacementPolicy.DEDICATED
+    cores = set(env.placement.cores) if env.placement.cores else None
+    if dedicated:
+        try:
+            cores = core_pool.allocate(env_id, cores, env.placement.dedicated_cores)
+        except RuntimeError as e:
+            scheduler.release(env_id)
+            util.agent_port_allocator.release(agent_env_port)
+            raise HTTPException(status_code=409, detail=str(e))
+
+    ew = EnvironmentWrapper(env.platform, env_id, config_str, env.parameters, agent_env_port, config_name,
+                            env.resources.cpu, env.priority, cores, dedicated, env.placement.nice, env.agent_set,
+                            env.resources.memory)
+    ew.memory_soft_limit, ew.memory_hard_limit = env.resources.memory_soft_limit, env.resources.memory_hard_limit
+    return ew
+
+
+clone_description = """
+Forks the worker of an environment, which is not running, into `count` new environments. They start from exactly the
+same state (created, configured or initialized) and share its memory until they change it, which is much faster than
+creating and configuring them one by one. Each clone gets its own id and agent manager port, and is admitted by the
+scheduler like a newly created environment: a synchronous request is refused (503) if they cannot all be admitted
+right away, an asynchronous one waits in the queue.
+"""
 
-    ew = EnvironmentWrapper(env.platform, env.id, config_str, env.parameters, agent_env_port)
-    response = await ew.start()
-    environments[str(ew.id)] = ew
 
-    return response
+@router.post(
+    "/clone/",
+    status_code=status.HTTP_201_CREATED,
+    description=clone_description,
+    responses=async_responses,
+)
+async def clone(id: str, count: Annotated[int, Query(ge=1, le=1000)] = 1, run_async: AsyncQuery = False) -> list[ActionResponse]:
+    if run_async:
+        template = get_environment_wrapper(id)
+        return accepted(jobs.submit("clone", id, lambda job: clone_environment(template, count)))
+    return FastJSONResponse(await clone_environment(get_environment_wrapper(id), count, wait=False),
+                            status_code=status.HTTP_201_CREATED)
+
+
+async def clone_environment(template: EnvironmentWrapper, count: int, wait: bool = True) -> list[ActionResponse]:
+    id = template.id
+    if template.node:
+        # Checked before the clones are made, as their wrappers would connect to the node
+        raise HTTPException(status_code=409, detail=ActionResponse(id, template.state, False, "Environments on nodes cannot be cloned."))
+
+    clones = []
+    try:
+        for _ in range(count):
+            clone_id = str(uuid.uuid4())
+            clones.append(template.copy(clone_id, await admit_environment(clone_id, template.memory, template.priority, wait)))
+    except BaseException:
+        release_clones(clones)
+        raise
+
+    async def start() -> list[ActionResponse]:
+        try:
+            responses = await template.clone(clones)
+        except BaseException:
+            release_clones(clones)
+            raise
+        for ew in clones:
+            environments[ew.id] = ew
+        return responses
+
+    # Once the workers are forked, they must get registered even if the caller goes away
+    return await asyncio.shield(start())
+
+
+def release_clones(clones: list[EnvironmentWrapper]) -> None:
+    for ew in clones:
+        scheduler.release(ew.id)
+        util.agent_port_allocator.release(ew.agent_manager_port)
 
 
 @router.post(
     "/init/",
     status_code=status.HTTP_200_OK,
+    responses=async_responses,
 )
-async def init(id) -> ActionResponse:
-    return await get_environment_wrapper(id).perform_action(EnvironmentAction.INIT)
+async def init(id, run_async: AsyncQuery = False) -> ActionResponse:
+    if run_async:
+        return submit_action(id, EnvironmentAction.INIT)
+    return FastJSONResponse(await get_environment_wrapper(id).perform_action(EnvironmentAction.INIT))
 
 
 @router.post(
     "/configure/",
     status_code=status.HTTP_200_OK,
+    responses=async_responses,
 )
-async def configure(id: str, parameters: Parametrization) -> ActionResponse:
-    return await get_environment_wrapper(id).perform_action(EnvironmentAction.CONFIGURE, parameters.parameters)
+async def configure(id: str, parameters: Parametrization, run_async: AsyncQuery = False) -> ActionResponse:
+    if run_async:
+        return submit_action(id, EnvironmentAction.CONFIGURE, parameters.parameters)
+    return FastJSONResponse(await get_environment_wrapper(id).perform_action(EnvironmentAction.CONFIGURE, parameters.parameters))
 
 
 @router.post(
     "/reset/",
     status_code=status.HTTP_200_OK,
 )
-async def reset(id) -> ActionResponse:
-    return await get_environment_wrapper(id).perform_action(EnvironmentAction.RESET)
+async def reset(id, mode: ResetMode = ResetMode.FULL) -> ActionResponse:
+    return FastJSONResponse(await get_environment_wrapper(id).reset(mode))
+
+
+@router.post(
+    "/baseline/",
+    status_code=status.HTTP_200_OK,
+)
+async def save_baseline(id) -> ActionResponse:
+    """
+    Saves the current state of the environment as the baseline of incremental resets.
+    """
+    return FastJSONResponse(await get_environment_wrapper(id).save_baseline())
 
 
 @router.post(
@@ -101,6 +296,10 @@ async def reset(id) -> ActionResponse:
     status_code=status.HTTP_200_OK,
 )
 async def terminate(id) -> ActionResponse:
+    return FastJSONResponse(await terminate_environment(id))
+
+
+async def terminate_environment(id: str) -> ActionResponse:
     response = await get_environment_wrapper(id).perform_action(EnvironmentAction.TERMINATE)
     if id in environments:
         del environments[id]
@@ -112,7 +311,60 @@ async def terminate(id) -> ActionResponse:
     status_code=status.HTTP_200_OK,
 )
 async def commit(id) -> ActionResponse:
-    return await get_environment_wrapper(id).perform_action(EnvironmentAction.COMMIT)
+    return FastJSONResponse(await get_environment_wrapper(id).perform_action(EnvironmentAction.COMMIT))
+
+
+@router.get(
+    "/export/",
+    status_code=status.HTTP_200_OK,
+    response_class=StreamingResponse,
+)
+async def export_run(id: str, table: ExportTable = ExportTable.MESSAGES, format: ExportFormat = ExportFormat.ARROW):
+    """
+    Downloads the run data of the environment as an Arrow IPC stream or a Parquet file, streamed from the worker in
+    record batches. The statistics of a run are available once it is committed.
+    """
+    wrapper = get_environment_wrapper(id)
+    if not export.available():
+        raise HTTPException(status_code=501, detail=ActionResponse(id, wrapper.state, False, "The export requires pyarrow, which is not installed."))
+    pipe = await wrapper.export(table, format)
+
+    async def chunks():
+        try:
+            while True:
+                try:
+                    yield await asyncio.to_thread(pipe.recv_bytes)
+                except EOFError:
+                    break
+        finally:
+            pipe.close()
+
+    filename = f"{id}-{table}.{export.EXTENSIONS[format]}"
+    return StreamingResponse(chunks(), media_type=export.MEDIA_TYPES[format],
+                             headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+
+
+@router.post(
+    "/profile/",
+    status_code=status.HTTP_200_OK,
+    response_class=PlainTextResponse,
+    responses={409: {"model": ActionResponse, "description": "The CPU profile was requested for an environment that is not running."}},
+)
+async def profile(id: str, mode: ProfileMode = ProfileMode.CPU,
+                  duration: Annotated[float, Query(gt=0, le=300, description="Duration of the profiling [s].")] = 10,
+                  interval: Annotated[float, Query(ge=0.001, le=1, description="Sampling interval of the CPU profile [s].")] = 0.01,
+                  top: Annotated[int, Query(ge=1, le=1000, description="Number of allocations in the memory profile.")] = 25):
+    """
+    Profiles the worker of the environment from the inside. The CPU profile samples the stacks of the worker's threads
+    and comes as collapsed stacks for flame graphs, the memory profile lists the top allocations made meanwhile. The CPU
+    profile needs the environment to be RUNNING.
+    """
+    option = interval if mode == ProfileMode.CPU else top
+    response = await get_environment_wrapper(id).perform_action(EnvironmentAction.PROFILE, (mode, duration, option))
+    if not response.success:
+        raise HTTPException(status_code=409, detail=response)
+    filename = f"{id}.collapsed" if mode == ProfileMode.CPU else f"{id}-allocations.txt"
+    return PlainTextResponse(response.aux, headers={"Content-Disposition": f'attachment; filename="{filename}"'})
 
 
 @router.post(
@@ -120,15 +372,104 @@ async def commit(id) -> ActionResponse:
     status_code=status.HTTP_200_OK,
 )
 async def pause(id) -> ActionResponse:
-    return await get_environment_wrapper(id).perform_action(EnvironmentAction.PAUSE)
+    return FastJSONResponse(await get_environment_wrapper(id).perform_action(EnvironmentAction.PAUSE))
 
 
 @router.post(
     "/run/",
     status_code=status.HTTP_200_OK,
+    responses=async_responses,
+)
+async def run(id: str, run_async: AsyncQuery = False) -> ActionResponse:
+    if run_async:
+        wrapper = get_environment_wrapper(id)
+        return accepted(jobs.submit(EnvironmentAction.RUN, id, lambda job: wrapper.run()))
+    # A synchronous request is not held open while waiting for CPUs, that is what the asynchronous run is for
+    return FastJSONResponse(await get_environment_wrapper(id).run(wait=False))
+
+
+async def _run_batch_item(id: str | None, steps, semaphore: asyncio.Semaphore) -> BatchItemResult:
+    result = BatchItemResult(id, False)
+    async with semaphore:
+        try:
+            for step in steps:
+                response = await step(result.id)
+                result.id = response.id
+                result.responses.append(response)
+        except HTTPException as e:
+            result.error = e.detail
+            return result
+        except Exception as e:
+            result.error = str(e)
+            return result
+
+    result.success = True
+    return result
+
+
+batch_description = """
+Creates (and configures) all environments listed in `environments`, plus `count` copies of `template`, then
+optionally initializes and runs them. At most `concurrency` environments are processed at the same time and the
+outcome of each one is reported individually, in the order of the request.
+
+Copies of a template with an id get the id suffixed with their index, otherwise the ids are generated.
+"""
+
+
+@router.post(
+    "/batch/",
+    status_code=status.HTTP_200_OK,
+    description=batch_description,
+    responses=async_responses,
 )
-async def run(id: str) -> ActionResponse:
-    return await get_environment_wrapper(id).perform_action(EnvironmentAction.RUN)
+async def batch(environments_batch: EnvironmentBatch, run_async: AsyncQuery = False) -> list[BatchItemResult]:
+    specs = list(environments_batch.environments)
+    if environments_batch.template:
+        for index in range(environments_batch.count):
+            copy = environments_batch.template.model_copy()
+            if copy.id:
+                copy.id = f"{copy.id}-{index}"
+            specs.append(copy)
+
+    ids = [spec.id for spec in specs if spec.id]
+    if len(ids) != len(set(ids)):
+        raise HTTPException(status_code=409, detail="Environment ids within a batch must be unique.")
+
+    if run_async:
+        return accepted(jobs.submit("batch", None, lambda job: _run_batch(specs, environments_batch, job)))
+    return FastJSONResponse(await _run_batch(specs, environments_batch))
+
+
+async def _run_batch(specs: list[Environment], environments_batch: EnvironmentBatch, job: Job | None = None) -> list[BatchItemResult]:
+    semaphore = asyncio.Semaphore(environments_batch.concurrency)
+    tasks = []
+    for spec in specs:
+        steps = [lambda _, spec=spec: create_environment(spec)]
+        if environments_batch.init:
+            steps.append(lambda id: get_environment_wrapper(id).perform_action(EnvironmentAction.INIT))
+        if environments_batch.run:
+            steps.append(lambda id: get_environment_wrapper(id).run())
+        tasks.append(asyncio.ensure_future(_run_batch_item(spec.id, steps, semaphore)))
+
+    if job:
+        def report_progress(_):
+            finished = sum(1 for task in tasks if task.done())
+            job.progress = finished / len(tasks)
+            job.message = f"{finished} out of {len(tasks)} environments processed."
+
+        for task in tasks:
+            task.add_done_callback(report_progress)
+
+    return list(await asyncio.gather(*tasks))
+
+
+@router.post(
+    "/batch/terminate/",
+    status_code=status.HTTP_200_OK,
+)
+async def batch_terminate(environment_ids: EnvironmentIds) -> list[BatchItemResult]:
+    semaphore = asyncio.Semaphore(environment_ids.concurrency)
+    return FastJSONResponse(list(await asyncio.gather(*[_run_batch_item(id, [terminate_environment], semaphore) for id in environment_ids.ids])))
 
 
 @router.get(
@@ -136,17 +477,76 @@ async def run(id: str) -> ActionResponse:
     status_code=status.HTTP_200_OK,
 )
 async def list_environments() -> list[EnvironmentOut]:
-    environments_info = []
-    for env_name, env in environments.items():
-        environments_info.append(EnvironmentOut(
-            id=env_name,
-            state=(await env.perform_action(EnvironmentAction.GET_STATE)).state,
-            platform=env.platform.type.name,
-            provider=env.platform.provider,
-            agent_manager_port=env.agent_manager_port,
-        ))
+    # The descriptions have exactly the fields of EnvironmentOut, so they are sent as they are
+    return FastJSONResponse([env.describe() for env in environments.values()])
+
+
+def _encode_cursor(key: tuple[str, int]) -> str:
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode()
 
-    return environments_info
+
+def _decode_cursor(cursor: str) -> tuple[str, int]:
+    try:
+        value, sequence = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return str(value), int(sequence)
+    except Exception:
+        raise HTTPException(status_code=422, detail="Invalid cursor.")
+
+
+query_description = """
+Lists environments matching the filters, using the cached environment states instead of asking every worker.
+Each filter can be given multiple times to match any of the values. Results are sorted by `sort` and split into
+pages of at most `limit` items; pass the returned `next_cursor` to get the next page. Use `fields` to return only
+a subset of the environment fields.
+"""
+
+
+@router.get(
+    "/query/",
+    status_code=status.HTTP_200_OK,
+    description=query_description,
+)
+async def query_environments(
+    state: Annotated[list[str], Query()] = [],
+    platform: Annotated[list[str], Query()] = [],
+    provider: Annotated[list[str], Query()] = [],
+    configuration: Annotated[list[str], Query()] = [],
+    sort: Literal["created", "id", "state", "platform", "provider", "configuration"] = "created",
+    order: Literal["asc", "desc"] = "asc",
+    limit: Annotated[int, Query(ge=1, le=1000)] = 100,
+    cursor: str | None = None,
+    fields: Annotated[list[str], Query()] = [],
+) -> EnvironmentPage:
+    unknown_fields = set(fields) - set(EnvironmentOut.model_fields)
+    if unknown_fields:
+        raise HTTPException(status_code=422, detail=f"Unknown fields: {', '.join(sorted(unknown_fields))}.")
+
+    ids = environments.filter(
+        state={s.upper() for s in state},
+        platform={p.upper() for p in platform},
+        provider=set(provider),
+        configuration=set(configuration),
+    )
+
+    def sort_key(env_id: str) -> tuple[str, int]:
+        value = "" if sort == "created" else environments[env_id].describe()[sort]
+        return "" if value is None else str(value), environments.sequence(env_id)
+
+    keyed = sorted(((sort_key(env_id), env_id) for env_id in ids), reverse=(order == "desc"))
+    if cursor:
+        after = _decode_cursor(cursor)
+        keyed = [(key, env_id) for key, env_id in keyed if (key < after if order == "desc" else key > after)]
+
+    page = keyed[:limit]
+    items = []
+    for _, env_id in page:
+        description = environments[env_id].describe()
+        if fields:
+            description = {f: description[f] for f in ["id", *fields]}
+        items.append(description)
+
+    next_cursor = _encode_cursor(page[-1][0]) if len(keyed) > limit else None
+    return FastJSONResponse(EnvironmentPage(items=items, total=len(ids), next_cursor=next_cursor))
 
 
 @router.get(
@@ -155,22 +555,74 @@ async def list_environments() -> list[EnvironmentOut]:
 )
 async def get_environment(id) -> EnvironmentOut:
     env = get_environment_wrapper(id)
-    response = EnvironmentOut(
-        id=env.id,
-        state=(await env.perform_action(EnvironmentAction.GET_STATE)).state,
-        platform=env.platform.type.name,
-        provider=env.platform.provider,
-        agent_manager_port=env.agent_manager_port
-        )
+    # Refreshes the cached state from the worker
+    await env.perform_action(EnvironmentAction.GET_STATE)
+    return FastJSONResponse(env.describe())
+
+@router.get(
+    "/queue/",
+    status_code=status.HTTP_200_OK,
+)
+async def get_queue() -> SchedulerStatus:
+    """
+    Reports the resource budgets, their current use, and the requests waiting to be admitted, with their position in
+    the queue and an estimated wait (in seconds).
+    """
+    return FastJSONResponse(scheduler.status())
+
+
+wait_description = """
+Suspends until the environments reach one of the requested states, or until the timeout (in seconds) expires.
+With the mode `all`, every environment has to reach the state; with `any`, one of them is enough. Environments that
+get terminated stop being waited on.
+"""
+
+
+@router.get(
+    "/wait/",
+    status_code=status.HTTP_200_OK,
+    description=wait_description,
+)
+async def wait(
+    id: Annotated[list[str], Query()],
+    state: Annotated[list[str], Query()] = [EnvironmentState.FINISHED.name],
+    mode: Literal["any", "all"] = "all",
+    timeout: Annotated[float, Query(ge=0, le=3600)] = 30,
+) -> EnvironmentWaitOut:
+    target_states = {s.upper() for s in state}
+    unknown_states = target_states - set(EnvironmentState.__members__)
+    if unknown_states:
+        raise HTTPException(status_code=422, detail=f"Unknown environment states: {', '.join(sorted(unknown_states))}.")
+
+    wrappers = {env_id: get_environment_wrapper(env_id) for env_id in id}
+    pending = {asyncio.create_task(wrapper.wait_for_state(target_states)) for wrapper in wrappers.values()}
+    deadline = asyncio.get_running_loop().time() + timeout
+    try:
+        while pending:
+            remaining = deadline - asyncio.get_running_loop().time()
+            if remaining <= 0:
+                break
+            done, pending = await asyncio.wait(pending, timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+            if mode == "any" and any(task.result() in target_states for task in done):
+                break
+    finally:
+        for task in pending:
+            task.cancel()
+
+    states = {env_id: wrapper.state for env_id, wrapper in wrappers.items()}
+    if mode == "any":
+        reached = any(s in target_states for s in states.values())
+    else:
+        reached = all(s in target_states for s in states.values())
+    return FastJSONResponse(EnvironmentWaitOut(reached=reached, states=states))
 
-    return response
 
 @router.get(
     "/configuration/list/",
     status_code=status.HTTP_200_OK,
 )
 async def list_configurations() -> AvailableConfigurations:
-    return AvailableConfigurations(available_configurations=util.list_scenario_files())
+    return FastJSONResponse(AvailableConfigurations(available_configurations=util.list_scenario_files()))
 
 
 @router.get(
@@ -180,6 +632,6 @@ async def list_configurations() -> AvailableConfigurations:
 async def get_configuration(file_name: str) -> ScenarioOut:
     try:
         util.ensure_json_configuration(file_name)
-        return ScenarioOut(configuration_json=util.read_scenario_file(file_name))
+        return FastJSONResponse({"configuration_json": util.read_scenario_file(file_name), "description": util.read_scenario_description(file_name)})
     except Exception as e:
         raise HTTPException(status_code=404, detail=str(e))
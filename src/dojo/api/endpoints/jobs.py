@@ -0,0 +1,65 @@
+from typing import Annotated
+
+from fastapi import APIRouter, HTTPException, Query, status
+
+from dojo.api.responses import FastJSONResponse
+from dojo.jobs import jobs, Job
+
+router = APIRouter(
+    prefix="/jobs",
+    tags=["jobs"],
+    responses={
+        404: {"description": "Not found"},
+    },
+)
+
+
+AsyncQuery = Annotated[bool, Query(alias="async", description="Return immediately with a job to track the action.")]
+async_responses = {202: {"model": Job, "description": "The action was submitted as a job."}}
+
+
+def accepted(job: Job) -> FastJSONResponse:
+    return FastJSONResponse(job, status_code=status.HTTP_202_ACCEPTED)
+
+
+def get_job(id: str) -> Job:
+    job = jobs.get(id)
+    if not job:
+        raise HTTPException(status_code=404, detail=f"The job with the id '{id}' was not found.")
+    return job
+
+
+@router.get(
+    "/list/",
+    status_code=status.HTTP_200_OK,
+)
+async def list_jobs() -> list[Job]:
+    return FastJSONResponse(jobs.list())
+
+
+@router.get(
+    "/get/",
+    status_code=status.HTTP_200_OK,
+)
+async def get(id: str) -> Job:
+    return FastJSONResponse(get_job(id))
+
+
+@router.post(
+    "/cancel/",
+    status_code=status.HTTP_200_OK,
+)
+async def cancel(id: str) -> Job:
+    job = get_job(id)
+    if not jobs.cancel(id):
+        raise HTTPException(status_code=409, detail=f"The job with the id '{id}' has already finished.")
+    return FastJSONResponse(job)
+
+
+@router.get(
+    "/log/",
+    status_code=status.HTTP_200_OK,
+)
+async def get_log(id: str) -> list[str]:
+    get_job(id)
+    return FastJSONResponse(jobs.get_log(id))
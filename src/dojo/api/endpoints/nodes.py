@@ -0,0 +1,74 @@
+import asyncio
+
+from dataclasses import asdict
+
+from fastapi import APIRouter, HTTPException, status
+
+from dojo.api.responses import FastJSONResponse
+from dojo.controller import environments
+from dojo.nodes import nodes, status as node_status, Node
+from dojo.schemas.nodes import NodeRegistration, NodeOut
+
+router = APIRouter(
+    prefix="/nodes",
+    tags=["nodes"],
+    responses={
+        404: {"description": "Not found"},
+    },
+)
+
+
+def node_usage() -> dict[str, int]:
+    """
+    Number of environments hosted by each node.
+    """
+    usage: dict[str, int] = {}
+    for env in environments.values():
+        if env.node:
+            usage[env.node] = usage.get(env.node, 0) + 1
+    return usage
+
+
+def describe(node: Node, usage: dict[str, int]) -> dict:
+    used = usage.get(node.name, 0)
+    return {**asdict(node), "environments": used, "free": max(node.capacity - used, 0)}
+
+
+@router.get(
+    "/list/",
+    status_code=status.HTTP_200_OK,
+)
+async def list_nodes() -> list[NodeOut]:
+    usage = node_usage()
+    return FastJSONResponse([describe(node, usage) for node in nodes.values()])
+
+
+@router.post(
+    "/register/",
+    status_code=status.HTTP_201_CREATED,
+)
+async def register_node(registration: NodeRegistration) -> NodeOut:
+    """
+    Registers a node running the worker daemon (dojo-node), after checking that the controller can reach it. Nodes
+    register themselves when started with --register. Registering a node again updates it.
+    """
+    node = Node(registration.name, registration.host, registration.port, registration.capacity)
+    try:
+        await asyncio.to_thread(node_status, node)
+    except Exception as e:
+        raise HTTPException(status_code=409, detail=f"The node {node.name} at {node.host}:{node.port} is not reachable. Reason: {e}")
+    nodes[node.name] = node
+    return FastJSONResponse(describe(node, node_usage()), status_code=status.HTTP_201_CREATED)
+
+
+@router.post(
+    "/unregister/",
+    status_code=status.HTTP_200_OK,
+)
+async def unregister_node(name: str) -> NodeOut:
+    if name not in nodes:
+        raise HTTPException(status_code=404, detail=f"Node '{name}' is not registered.")
+    usage = node_usage()
+    if usage.get(name):
+        raise HTTPException(status_code=409, detail=f"Node '{name}' still hosts {usage[name]} environments.")
+    return FastJSONResponse(describe(nodes.pop(name), usage))
@@ -5,6 +5,7 @@ from typing import Annotated
 from fastapi import APIRouter, HTTPException, status, File
 from fastapi.responses import FileResponse
 
+from dojo.api.responses import FastJSONResponse
 from dojo.lib import constants
 from dojo.lib import util
 from dojo.schemas.configuration import AvailableConfigurations, ScenarioOut
@@ -22,7 +23,7 @@ router = APIRouter(
     status_code=status.HTTP_200_OK,
 )
 async def list_scenarios() -> AvailableConfigurations:
-    return AvailableConfigurations(available_configurations=util.list_scenario_files())
+    return FastJSONResponse(AvailableConfigurations(available_configurations=util.list_scenario_files()))
 
 
 @router.get(
@@ -32,7 +33,7 @@ async def list_scenarios() -> AvailableConfigurations:
 async def get_scenario(file_name: str) -> ScenarioOut:
     try:
         util.ensure_json_configuration(file_name)
-        return ScenarioOut(configuration_json=util.read_scenario_file(file_name), description=util.read_scenario_description(file_name))
+        return FastJSONResponse({"configuration_json": util.read_scenario_file(file_name), "description": util.read_scenario_description(file_name)})
     except Exception as e:
         raise HTTPException(status_code=404, detail=str(e))
 
@@ -1,3 +1,7 @@
+import asyncio
+
+from typing import Any, Callable
+
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect
 
 class ConnectionManager:
@@ -18,4 +22,51 @@ class ConnectionManager:
     async def send_personal_message(self, message: str, environment_id: str):
         await self.active_connections[environment_id].send_text(message)
 
+
+class EventManager:
+    """
+    Fans out environment lifecycle events to every subscribed websocket. Each subscriber gets its own queue, so that
+    publishing never waits on a slow client.
+    """
+    def __init__(self, max_queue_size: int = 1024):
+        self.active_connections: dict[WebSocket, asyncio.Queue] = {}
+        self._max_queue_size = max_queue_size
+
+    async def stream(self, websocket: WebSocket, snapshot: Callable[[], list[dict[str, Any]]]):
+        await websocket.accept()
+        queue = asyncio.Queue(maxsize=self._max_queue_size)
+        # The snapshot is taken and queued right before registering, with no await in between, so no event is missed
+        # and none can overtake it
+        queue.put_nowait({"type": "snapshot", "environments": snapshot()})
+        self.active_connections[websocket] = queue
+
+        async def forward():
+            while True:
+                await websocket.send_json(await queue.get())
+
+        sender = asyncio.create_task(forward())
+        try:
+            while True:
+                await websocket.receive_text()
+        except (WebSocketDisconnect, RuntimeError):
+            # RuntimeError is raised when the socket was closed from our side
+            pass
+        finally:
+            sender.cancel()
+            self.disconnect(websocket)
+
+    def disconnect(self, websocket: WebSocket):
+        self.active_connections.pop(websocket, None)
+
+    def publish(self, event: dict[str, Any]):
+        for websocket, queue in list(self.active_connections.items()):
+            try:
+                queue.put_nowait(event)
+            except asyncio.QueueFull:
+                # The client is not keeping up, let it reconnect and start from a fresh snapshot
+                self.disconnect(websocket)
+                asyncio.ensure_future(websocket.close(code=1013))
+
+
 socket_manager = ConnectionManager()
+event_manager = EventManager()
@@ -0,0 +1,24 @@
+from typing import Annotated, Any
+
+from fastapi import APIRouter, Query, status
+
+from dojo.api.responses import FastJSONResponse
+from dojo.lib.tracing import collector
+
+router = APIRouter(
+    prefix="/traces",
+    tags=["traces"],
+)
+
+
+@router.get(
+    "/list/",
+    status_code=status.HTTP_200_OK,
+)
+async def list_traces(limit: Annotated[int, Query(ge=1, le=1000)] = 20) -> list[dict[str, Any]]:
+    """
+    The most recent traces, newest first. Each trace has its spans in the order they started, with times in nanoseconds
+    since the epoch and durations in milliseconds. The queue span of an action is the time between sending it to the
+    worker and the worker getting to it.
+    """
+    return FastJSONResponse(collector.traces(limit))
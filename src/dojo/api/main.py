@@ -1,11 +1,19 @@
 from fastapi import APIRouter
 
+from dojo.api.responses import FastJSONResponse
+
 from dojo.api.endpoints import cyst_environment
 from dojo.api.endpoints import agent_management
 from dojo.api.endpoints import scenarios
+from dojo.api.endpoints import jobs
+from dojo.api.endpoints import traces
+from dojo.api.endpoints import nodes
 
 
-api_router = APIRouter()
+api_router = APIRouter(default_response_class=FastJSONResponse)
 api_router.include_router(cyst_environment.router)
 api_router.include_router(agent_management.router)
 api_router.include_router(scenarios.router)
+api_router.include_router(jobs.router)
+api_router.include_router(traces.router)
+api_router.include_router(nodes.router)
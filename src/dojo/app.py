@@ -1,30 +1,48 @@
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.exceptions import HTTPException as StarletteHTTPException
 
+import asyncio
 from contextlib import asynccontextmanager
 
-from dojo.api.endpoints.socket_manager import socket_manager
+from dojo.api.endpoints.socket_manager import socket_manager, event_manager
 from dojo.core.config import settings
 from dojo.api.main import api_router
+from dojo.api.responses import FastJSONResponse, http_exception_handler
 from dojo.controller import environments, EnvironmentAction
+from dojo.lib.placement import core_pool
+from dojo.lib.tracing import TracingMiddleware, collector
+from dojo.agents import agent_registry
+from dojo.jobs import jobs
+from dojo.watchdog import watchdog
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     print("Starting up...")
+    core_pool.reserve_api_cores()
+    await agent_registry.list()
+    watchdog.start()
 
     yield
 
     print("Shutting down...", end="")
-    for env in environments.values():
+    await watchdog.stop()
+    for env in list(environments.values()):
+        # Baselines are not registered, they would outlive the API
+        env.discard_baseline()
         await env.perform_action(EnvironmentAction.TERMINATE)
+    await asyncio.to_thread(collector.flush)
     print("[OK]")
 
 app = FastAPI(
     title=settings.PROJECT_NAME,
     openapi_url=f"{settings.API_V1_STR}/openapi.json",
-    lifespan=lifespan
+    lifespan=lifespan,
+    default_response_class=FastJSONResponse,
 )
+app.add_exception_handler(StarletteHTTPException, http_exception_handler)
+app.add_middleware(TracingMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -40,6 +58,28 @@ async def home() -> dict[str, str]:
     return {"message": "Hello there"}
 
 
+@app.websocket("/ws/events/")
+async def events_websocket_endpoint(websocket: WebSocket):
+    """
+    Streams a snapshot of all environments followed by their creation, state change and termination events.
+    """
+    await event_manager.stream(websocket, lambda: [env.describe() for env in environments.values()])
+
+
+@app.websocket("/ws/jobs/{job_id}")
+async def job_websocket_endpoint(websocket: WebSocket, job_id: str):
+    """
+    Streams the output of a job, e.g., an agent installation, and closes once the job finishes.
+    """
+    await websocket.accept()
+    try:
+        async for line in jobs.follow(job_id):
+            await websocket.send_text(line)
+        await websocket.close()
+    except WebSocketDisconnect:
+        pass
+
+
 @app.websocket("/ws/{environment_id}")
 async def websocket_endpoint(websocket: WebSocket, environment_id: str):
     await socket_manager.connect(websocket, environment_id)
@@ -0,0 +1,179 @@
+"""
+Headless batch runner, which runs episodes of a scenario over a grid of parameters directly on a local process pool,
+without the API. Every pool process drives its environments with the same worker logic as the environment workers of
+the API (EnvironmentWorker). Results are streamed to the output, one JSON line per episode, as the episodes finish.
+
+Example: dojo-batch configuration_1 --grid '{"max_steps": [10, 50]}' --episodes 100 --output results.jsonl
+"""
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import dataclass, asdict
+from typing import Any, Dict, Optional
+
+from cyst.api.environment.platform_specification import PlatformSpecification, PlatformType
+
+from dojo.core.config import settings
+from dojo.controller import EnvironmentWorker, EnvironmentAction, EnvironmentState, ActionResponse
+from dojo.lib import util
+
+
+@dataclass
+class Episode:
+    episode: int
+    repetition: int
+    parameters: Dict[str, Any]
+
+
+@dataclass
+class EpisodeResult:
+    episode: int
+    repetition: int
+    parameters: Dict[str, Any]
+    state: str
+    success: bool
+    message: str
+    duration: float
+    worker: int
+    run_id: Optional[str] = None
+
+
+def parameter_grid(grid: Dict[str, list]) -> list[Dict[str, Any]]:
+    """
+    All combinations of the parameter values.
+    """
+    names = list(grid)
+    return [dict(zip(names, values)) for values in itertools.product(*(grid[name] for name in names))]
+
+
+# Set in every pool process by _initialize
+_platform: Optional[PlatformSpecification] = None
+_configuration: Optional[str] = None
+_ports: Optional[multiprocessing.Queue] = None
+
+
+def _initialize(platform: PlatformSpecification, configuration: str, ports: multiprocessing.Queue) -> None:
+    global _platform, _configuration, _ports
+    _platform, _configuration, _ports = platform, configuration, ports
+    # The output may go to stdout, keep whatever the environments print out of it
+    sys.stdout = sys.stderr
+
+
+def _run_id(worker: EnvironmentWorker) -> Optional[str]:
+    try:
+        return str(worker.environment.infrastructure.statistics.run_id)
+    except AttributeError:
+        return None
+
+
+def run_episode(episode: Episode, timeout: Optional[float] = None) -> EpisodeResult:
+    start = time.perf_counter()
+    # Platforms may start an agent manager, every running environment needs its own port
+    port = _ports.get()
+    os.environ["CYST_AGENT_ENV_MANAGER_PORT"] = str(port)
+    worker = EnvironmentWorker(f"batch-{episode.episode}", _configuration)
+    run_id = None
+    try:
+        response = worker.create(_platform, episode.parameters)
+        if response.success:
+            for action in (EnvironmentAction.INIT, EnvironmentAction.RUN):
+                response = worker.perform(action)
+                if not response.success:
+                    break
+            else:
+                state = worker.wait(timeout)
+                if state == EnvironmentState.FINISHED.name:
+                    response = ActionResponse(worker.id, state, True, "The episode finished.")
+                else:
+                    response = ActionResponse(worker.id, state, False, "The episode did not finish in time.")
+            run_id = _run_id(worker)
+            worker.perform(EnvironmentAction.TERMINATE)
+    except Exception as e:
+        response = ActionResponse(worker.id, EnvironmentState.TERMINATED.name, False, f"The episode failed. Reason: {e}")
+    finally:
+        _ports.put(port)
+
+    return EpisodeResult(episode.episode, episode.repetition, episode.parameters, response.state, response.success,
+                         response.message, time.perf_counter() - start, os.getpid(), run_id)
+
+
+def run_batch(scenario: str, grid: Dict[str, list], episodes: int, workers: int, output, timeout: Optional[float] = None,
+              platform: PlatformSpecification = PlatformSpecification(PlatformType.SIMULATED_TIME, "CYST"),
+              episodes_per_worker: Optional[int] = None) -> list[EpisodeResult]:
+    with open(util.ensure_json_configuration(scenario), "r") as f:
+        configuration = f.read()
+
+    batch = [Episode(i, repetition, parameters) for i, (parameters, repetition)
+             in enumerate(itertools.product(parameter_grid(grid), range(episodes)))]
+
+    if episodes_per_worker:
+        # Processes are replaced after a number of episodes, which is not possible with fork. The fork server imports
+        # the worker logic once, so the new processes still start warm
+        context = multiprocessing.get_context("forkserver")
+        context.set_forkserver_preload(["dojo.controller"])
+    else:
+        context = multiprocessing.get_context("fork")
+
+    allocator = util.PortAllocator(settings.AGENT_ENV_MANAGER_PORT_FIRST, settings.AGENT_ENV_MANAGER_PORT_LAST)
+    ports = context.Queue()
+    for _ in range(workers):
+        ports.put(allocator.allocate())
+
+    results = []
+    started = time.perf_counter()
+    with ProcessPoolExecutor(workers, mp_context=context, initializer=_initialize,
+                             initargs=(platform, configuration, ports), max_tasks_per_child=episodes_per_worker) as pool:
+        futures = [pool.submit(run_episode, episode, timeout) for episode in batch]
+        for future in as_completed(futures):
+            result = future.result()
+            results.append(result)
+            output.write(json.dumps(asdict(result)) + "\n")
+            output.flush()
+
+    elapsed = time.perf_counter() - started
+    succeeded = sum(result.success for result in results)
+    print(f"{len(results)} episodes ({succeeded} successful) in {elapsed:.1f} s, "
+          f"{len(results) / elapsed * 3600:.0f} episodes/hour", file=sys.stderr)
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(prog="dojo-batch", description="Run episodes of a scenario on a local process pool.")
+    parser.add_argument("scenario", help="Name of the scenario (configuration) to run.")
+    parser.add_argument("--grid", default="{}", help="Parameter grid as a JSON object of value lists, or @file with it.")
+    parser.add_argument("--episodes", type=int, default=1, help="Number of episodes for each combination of parameters.")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Number of pool processes.")
+    parser.add_argument("--output", default="-", help="File to write the results to (JSON lines), - for stdout.")
+    parser.add_argument("--timeout", type=float, default=None, help="Maximum duration of a run [s].")
+    parser.add_argument("--platform", default=PlatformType.SIMULATED_TIME.name, choices=[t.name for t in PlatformType])
+    parser.add_argument("--provider", default="CYST")
+    parser.add_argument("--episodes-per-worker", type=int, default=None,
+                        help="Replace pool processes after this many episodes, e.g., to contain leaks.")
+    args = parser.parse_args()
+
+    if args.grid.startswith("@"):
+        with open(args.grid[1:], "r") as f:
+            grid = json.load(f)
+    else:
+        grid = json.loads(args.grid)
+
+    platform = PlatformSpecification(PlatformType[args.platform], args.provider)
+    output = sys.stdout if args.output == "-" else open(args.output, "w")
+    try:
+        results = run_batch(args.scenario, grid, args.episodes, args.workers, output, args.timeout, platform,
+                            args.episodes_per_worker)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+    sys.exit(0 if all(result.success for result in results) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,11 @@
 import asyncio
 import contextlib
+import importlib
 import io
+import json
 import os
+import signal
+import site
 import socket
 import sys
 import uuid
@@ -12,14 +16,29 @@ from cyst.api.environment.control import EnvironmentState
 from cyst.api.environment.platform_specification import PlatformSpecification
 
 from asyncio import to_thread
+from collections import defaultdict
 from dataclasses import dataclass, asdict
 from fastapi import HTTPException
-from multiprocessing import Process, Pipe, connection, Lock
+from importlib.metadata import entry_points
+from multiprocessing import Process, Pipe, connection, reduction
 from enum import StrEnum, auto
 from typing import Any, Optional, Dict
 from threading import Thread
 from pathlib import Path
-from dojo.api.endpoints.socket_manager import socket_manager
+from dojo.agents import agent_registry
+from dojo.agent_sets import agent_store
+from dojo.nodes import Node, RemoteProcess
+from dojo.api.endpoints.socket_manager import socket_manager, event_manager
+from dojo.lib.util import agent_port_allocator
+from dojo.scheduler import scheduler, ResourcesUnavailable
+from dojo.lib import placement, export, profiling, tracing
+from dojo.lib.export import ExportTable, ExportFormat
+from dojo.lib.profiling import ProfileMode
+from dojo.lib.placement import core_pool
+
+
+# How often an idle worker checks whether its environment changed state on its own (e.g., a run finished)
+STATE_POLL_INTERVAL = 0.25
 
 
 @contextlib.contextmanager
@@ -27,11 +46,13 @@ def pipe_redirector(pipe_conn):
     class PipeWriter:
         def __init__(self, original_stdout):
             self.original_stdout = original_stdout
+            # Cloned workers switch to their own pipe
+            self.pipe_conn = pipe_conn
 
         def write(self, msg):
             try:
                 if msg.strip():  # Avoid sending pure newlines if you want
-                    pipe_conn.send(msg)
+                    self.pipe_conn.send(msg)
                 self.original_stdout.write(msg)  # Also print to the original stdout
             except Exception:
                 pass
@@ -43,10 +64,10 @@ def pipe_redirector(pipe_conn):
                 pass
 
     old_stdout, old_stderr = sys.stdout, sys.stderr
-    sys.stdout = sys.stderr = PipeWriter(old_stdout)
+    sys.stdout = sys.stderr = writer = PipeWriter(old_stdout)
 
     try:
-        yield
+        yield writer
     finally:
         sys.stdout = old_stdout
         sys.stderr = old_stderr
@@ -61,6 +82,19 @@ class EnvironmentAction(StrEnum):
     PAUSE = auto()
     RESET = auto()
     GET_STATE = auto()
+    REFRESH_AGENTS = auto()
+    CLONE = auto()
+    EXPORT = auto()
+    PROFILE = auto()
+
+
+class ResetMode(StrEnum):
+    # The environment resets itself
+    FULL = auto()
+    # The worker is replaced by a fork of the saved baseline
+    INCREMENTAL = auto()
+    # The worker is replaced by a fresh one, which is initialized
+    RECREATE = auto()
 
 
 @dataclass
@@ -72,8 +106,122 @@ class ActionResponse:
     aux: Optional[str] = None
 
 
+@dataclass
+class StateNotification:
+    """
+    Sent by a worker over its stdout pipe whenever the environment changes state without being asked to.
+    """
+    id: str
+    state: str
+
+
+class EnvironmentEventType(StrEnum):
+    CREATED = auto()
+    STATE_CHANGED = auto()
+    TERMINATED = auto()
+
+
+@dataclass
+class EnvironmentEvent:
+    type: str
+    environment: Dict[str, Any]
+    previous_state: Optional[str] = None
+
+
+def installed_agents() -> Dict[str, str]:
+    """
+    Returns the versions of the installed agents by their entry point names.
+    """
+    importlib.invalidate_caches()
+    return {entry_point.name: entry_point.dist.version if entry_point.dist else ""
+            for entry_point in entry_points(group="cyst.services")}
+
+
+def service_store(environment: Environment) -> Optional[Any]:
+    """
+    The store the environment registers the agents with when it is created. cyst has no public way of adding agents
+    later, so this relies on its private store (cyst-core 0.5: _service_store with add_service and get_service). None
+    if this version of cyst does not have it.
+    """
+    store = getattr(environment, "_service_store", None)
+    if not all(callable(getattr(store, method, None)) for method in ("add_service", "get_service")):
+        return None
+    return store
+
+
+def load_new_agents(id: str, environment: Environment, loaded: Dict[str, str]) -> ActionResponse:
+    """
+    Registers the agents installed after the environment was created with its service store, and adds them to loaded.
+    Agents that were upgraded or removed in the meantime cannot be changed in place, the worker has to be replaced.
+    """
+    state = environment.control.state.name
+    if environment.control.state != EnvironmentState.CREATED:
+        return ActionResponse(id, state, False, "Agents can only be refreshed before the environment is initialized.")
+
+    # New editable installs are added to sys.path through .pth files, which are only processed at startup
+    for site_dir in site.getsitepackages():
+        site.addsitedir(site_dir)
+
+    installed = installed_agents()
+    changed = [name for name, version in loaded.items() if installed.get(name) != version]
+    if changed:
+        return ActionResponse(id, state, False, f"Agents {', '.join(changed)} were changed or removed.")
+
+    store = service_store(environment)
+    added = []
+    for entry_point in entry_points(group="cyst.services"):
+        if entry_point.name in loaded:
+            continue
+        if store is None:
+            return ActionResponse(id, state, False, "This version of cyst does not support adding agents to an environment.")
+        try:
+            description = entry_point.load()
+            # Same as cyst when creating the environment, the first service of a name wins
+            if not store.get_service(description.name):
+                store.add_service(description)
+        except Exception as e:
+            return ActionResponse(id, state, False, f"Failed to load the agent '{entry_point.name}'. Reason: {e}")
+        loaded[entry_point.name] = installed[entry_point.name]
+        added.append(entry_point.name)
+
+    if added:
+        return ActionResponse(id, state, True, f"Loaded agents {', '.join(added)}.")
+    return ActionResponse(id, state, True, "There were no new agents to load.")
+
+
+class ClonedProcess:
+    """
+    A worker forked by another worker. It is not a child of the API process, so it can only be watched by its pid.
+    """
+    def __init__(self, pid: int):
+        self.pid = pid
+
+    def is_alive(self) -> bool:
+        try:
+            os.kill(self.pid, 0)
+        except OSError:
+            return False
+        # Until its parent reaps it, a finished clone is a zombie
+        try:
+            with open(f"/proc/{self.pid}/stat") as f:
+                return f.read().rpartition(")")[2].split()[0] != "Z"
+        except OSError:
+            return True
+
+    def join(self, timeout: Optional[float] = None) -> None:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.is_alive() and (deadline is None or time.monotonic() < deadline):
+            time.sleep(0.05)
+
+    def kill(self) -> None:
+        with contextlib.suppress(ProcessLookupError):
+            os.kill(self.pid, signal.SIGKILL)
+
+
 class EnvironmentWrapper:
-    def __init__(self, platform: PlatformSpecification, id: str | None, configuration: str, parameters: Optional[Dict[str, Any]], agent_manager_port: int = 8282):
+    def __init__(self, platform: PlatformSpecification, id: str | None, configuration: str, parameters: Optional[Dict[str, Any]], agent_manager_port: int = 8282, configuration_name: Optional[str] = None,
+                 cpu: float = 0, priority: int = 0, cores: Optional[set[int]] = None, dedicated: bool = False,
+                 nice: Optional[int] = None, agent_set: Optional[str] = None, memory: int = 0, node: Optional[Node] = None):
         if not id:
             self._id = str(uuid.uuid4())
         else:
@@ -82,13 +230,49 @@ class EnvironmentWrapper:
         self._platform = platform
 
         self._configuration = configuration
+        self._configuration_name = configuration_name
         self._parameters = parameters
 
+        # Environments without explicit cores follow the shared pool, which changes as cores get dedicated and released
+        self._cores = cores
+        self._dedicated = dedicated
+        self._nice = nice
+        self._agent_set = agent_set
+        # Environments on a node are hosted by its daemon instead of a local process
+        self._node = node
+        self._spawn()
+        self._lock = asyncio.Lock()
+        self._state: str = EnvironmentState.CREATED.name
+        self._state_waiters: list[tuple[set[str], asyncio.Future]] = []
+        self.agent_manager_port: int = agent_manager_port
+        self.cpu = cpu
+        self.memory = memory
+        self.priority = priority
+        self._exited_handled = False
+        self._agents_version = agent_registry.version
+        self._respawning = False
+        self._baseline: Optional[EnvironmentWrapper] = None
+        # Limits of the memory watchdog [MB], derived from the reserved memory if unset
+        self.memory_soft_limit: Optional[int] = None
+        self.memory_hard_limit: Optional[int] = None
+        # When the environment last served an action, the least recently used ones are evicted first
+        self.last_active = time.monotonic()
+        # Baselines are internal, they are neither registered nor announced
+        self._internal = False
+
+    def _spawn(self) -> None:
+        if self._node:
+            self._process = RemoteProcess(self._node, self._id, {"platform": self._platform, "configuration": self._configuration,
+                                                                 "parameters": self._parameters, "nice": self._nice})
+            # The connections are made when the worker is started
+            self._pipe_parent = self._pipe_child = self._stdout_pipe_parent = self._stdout_pipe_child = None
+            return
+
         self._pipe_parent, self._pipe_child = Pipe()
         self._stdout_pipe_parent, self._stdout_pipe_child = Pipe()
-        self._process = Process(target=self.loop, args=(self._id, self._platform, self._configuration, self._parameters, self._pipe_child, self._stdout_pipe_child))
-        self._lock = Lock()
-        self.agent_manager_port: int = agent_manager_port
+        self._process = Process(target=self.loop, args=(self._id, self._platform, self._configuration, self._parameters, self._pipe_child, self._stdout_pipe_child,
+                                                        self._cores or core_pool.shared_cores(), self._nice,
+                                                        agent_store.path(self._agent_set) if self._agent_set else None))
 
     @property
     def id(self) -> str:
@@ -102,142 +286,782 @@ class EnvironmentWrapper:
     def configuration(self) -> str:
         return self._configuration
 
+    @property
+    def configuration_name(self) -> Optional[str]:
+        """
+        The name of the scenario the environment was created from, or None for custom configurations.
+        """
+        return self._configuration_name
+
+    @property
+    def state(self) -> str:
+        """
+        The last state reported by the worker. It is kept up to date by action responses and state notifications, so
+        reading it does not require a round trip to the worker.
+        """
+        return self._state
+
+    @property
+    def agent_set(self) -> Optional[str]:
+        return self._agent_set
+
+    @property
+    def node(self) -> Optional[str]:
+        """
+        Name of the node hosting the environment, None for this host.
+        """
+        return self._node.name if self._node else None
+
+    def describe(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "platform": self.platform.type.name,
+            "provider": self.platform.provider,
+            "state": self.state,
+            "agent_manager_port": self.agent_manager_port,
+            "configuration": self.configuration_name,
+            "agent_set": self.agent_set,
+            "node": self.node,
+        }
+
+    def _set_state(self, state: str) -> None:
+        if state == self._state:
+            return
+
+        previous_state, self._state = self._state, state
+        environments.reindex(self, "state", previous_state, state)
+        if previous_state == EnvironmentState.RUNNING.name:
+            scheduler.release(self.run_ticket)
+        if state == EnvironmentState.TERMINATED.name:
+            event_type = EnvironmentEventType.TERMINATED
+        else:
+            event_type = EnvironmentEventType.STATE_CHANGED
+        if not self._internal:
+            event_manager.publish(asdict(EnvironmentEvent(event_type, self.describe(), previous_state)))
+
+        # A terminated environment will never reach any other state, so wake up everyone waiting on it
+        for states, future in self._state_waiters:
+            if not future.done() and (state in states or state == EnvironmentState.TERMINATED.name):
+                future.set_result(state)
+
+    async def wait_for_state(self, states: set[str]) -> str:
+        """
+        Suspends until the environment reaches one of the given states or gets terminated. Returns the state reached.
+        """
+        if self._state in states or self._state == EnvironmentState.TERMINATED.name:
+            return self._state
+
+        waiter = (states, asyncio.get_running_loop().create_future())
+        self._state_waiters.append(waiter)
+        try:
+            return await waiter[1]
+        finally:
+            self._state_waiters.remove(waiter)
+
     def start_stdout_listener(self):
         loop = asyncio.get_event_loop()
+        # The worker can be replaced, so the listener sticks to the one it was started for
+        process, stdout_pipe = self._process, self._stdout_pipe_parent
 
         def listen():
-            while self._process.is_alive():
-                if self._stdout_pipe_parent.poll():
-                    msg = self._stdout_pipe_parent.recv()
+            while process.is_alive():
+                try:
+                    if not stdout_pipe.poll(1):
+                        continue
+                    msg = stdout_pipe.recv()
+                except (EOFError, OSError):
+                    break
+                if isinstance(msg, StateNotification):
+                    loop.call_soon_threadsafe(self._set_state, msg.state)
+                elif isinstance(msg, tracing.Span):
+                    tracing.collector.add(msg)
+                else:
                     asyncio.run_coroutine_threadsafe(socket_manager.send_personal_message(msg, self.id), loop)
+            loop.call_soon_threadsafe(self._worker_exited, process)
 
         Thread(target=listen, daemon=True).start()
 
-    async def start(self) -> ActionResponse:
-        os.environ["CYST_AGENT_ENV_MANAGER_PORT"] = str(self.agent_manager_port)
-        with self._lock:
+    def _worker_exited(self, process: Process) -> None:
+        if process is self._process and not self._respawning:
+            self._exited()
+
+    @property
+    def run_ticket(self) -> str:
+        """
+        The scheduler owner of the resources held while the environment is running. The environment itself owns the
+        resources held for its whole lifetime.
+        """
+        return f"{self._id}:run"
+
+    async def run(self, wait: bool = True) -> ActionResponse:
+        """
+        Runs the environment once the scheduler admits its CPU demand. Without waiting, the run is refused if the demand
+        cannot be admitted right away.
+        """
+        if self._node:
+            # The CPU budget is the one of this host
+            return await self.perform_action(EnvironmentAction.RUN)
+
+        try:
+            acquired = await scheduler.acquire(self.run_ticket, {"cpu": self.cpu}, self.priority, wait)
+        except ResourcesUnavailable as e:
+            raise HTTPException(status_code=503, detail=ActionResponse(self._id, self._state, False, f"{e} Run the environment asynchronously (async=true) to wait for the CPUs."))
+        except RuntimeError as e:
+            raise HTTPException(status_code=409, detail=ActionResponse(self._id, self._state, False, str(e)))
+        try:
+            return await self.perform_action(EnvironmentAction.RUN)
+        finally:
+            if acquired and self._state != EnvironmentState.RUNNING.name:
+                scheduler.release(self.run_ticket)
+
+    @property
+    def follows_shared_pool(self) -> bool:
+        return not self._cores
+
+    @property
+    def pid(self) -> Optional[int]:
+        return self._process.pid
+
+    def kill(self) -> None:
+        """
+        Kills the worker at once, without giving the environment a chance to terminate (e.g., it is out of memory).
+        """
+        if self._process.is_alive():
+            self._process.kill()
+        self._exited()
+
+    def pin(self, cores: set[int]) -> None:
+        if not self._node and self._process.is_alive():
+            placement.pin(self._process.pid, cores)
+
+    def _exited(self) -> None:
+        self._set_state(EnvironmentState.TERMINATED.name)
+        self.discard_baseline()
+        if environments.get(self._id) is self:
+            del environments[self._id]
+        if not self._exited_handled:
+            self._exited_handled = True
+            # The port of an environment on a node was given by the node
+            if not self._node:
+                agent_port_allocator.release(self.agent_manager_port)
+            scheduler.release(self.run_ticket)
+            scheduler.release(self._id)
+            if self._dedicated and core_pool.release(self._id):
+                repin_shared_workers()
+
+    async def _launch(self) -> ActionResponse:
+        if self._node:
+            try:
+                self.agent_manager_port = await to_thread(self._process.start)
+                self._pipe_parent, self._stdout_pipe_parent = self._process.control, self._process.stdout
+            except (RuntimeError, OSError, EOFError) as e:
+                return ActionResponse(self._id, EnvironmentState.TERMINATED.name, False, f"Failed to start the environment on the node {self._node.name}. Reason: {e}")
+        else:
+            os.environ["CYST_AGENT_ENV_MANAGER_PORT"] = str(self.agent_manager_port)
             self._process.start()
-            self.start_stdout_listener()
-            response: ActionResponse = await to_thread(self._pipe_parent.recv)
+        self.start_stdout_listener()
+        return await asyncio.shield(to_thread(self._pipe_parent.recv))
+
+    async def start(self) -> ActionResponse:
+        async with self._lock:
+            response = await self._launch()
 
         if response and not response.success:
-            raise HTTPException(status_code=409, detail=asdict(response))
+            raise HTTPException(status_code=409, detail=response)
+
+        self._state = response.state
+        event_manager.publish(asdict(EnvironmentEvent(EnvironmentEventType.CREATED, self.describe())))
+        return response
+
+    def copy(self, id: str, agent_manager_port: int) -> "EnvironmentWrapper":
+        """
+        A wrapper for a clone of the environment. Clones share the pool of cores, even if this one has dedicated cores.
+        """
+        wrapper = EnvironmentWrapper(self._platform, id, self._configuration, self._parameters, agent_manager_port,
+                                     self._configuration_name, self.cpu, self.priority,
+                                     None if self._dedicated else self._cores, False, self._nice, self._agent_set, self.memory, self._node)
+        wrapper._agents_version = self._agents_version
+        wrapper.memory_soft_limit, wrapper.memory_hard_limit = self.memory_soft_limit, self.memory_hard_limit
+        return wrapper
+
+    async def clone(self, clones: list["EnvironmentWrapper"]) -> list[ActionResponse]:
+        """
+        Forks the worker into the workers of the clones (see copy), which were not started. The clones start from the
+        current state of the environment, which must not be running.
+        """
+        if not self._process.is_alive():
+            self._exited()
+            raise HTTPException(status_code=409, detail=ActionResponse(self._id, EnvironmentState.TERMINATED.name, False, f"The environment is already terminated."))
+        if self._node:
+            raise HTTPException(status_code=409, detail=ActionResponse(self._id, self._state, False, "Environments on nodes cannot be cloned."))
+
+        pipes = [(Pipe(), Pipe()) for _ in clones]
+        try:
+            async with self._lock:
+                self._pipe_parent.send((EnvironmentAction.CLONE, [(clone.id, clone.agent_manager_port) for clone in clones]))
+                for (_, control), (_, stdout) in pipes:
+                    reduction.send_handle(self._pipe_parent, control.fileno(), self._process.pid)
+                    reduction.send_handle(self._pipe_parent, stdout.fileno(), self._process.pid)
+                response: ActionResponse = await to_thread(self._pipe_parent.recv)
+        finally:
+            # The clones have their own copies by now
+            for (_, control), (_, stdout) in pipes:
+                control.close()
+                stdout.close()
+
+        if not response.success:
+            for (control, _), (stdout, _) in pipes:
+                control.close()
+                stdout.close()
+            raise HTTPException(status_code=409, detail=response)
+
+        pids = json.loads(response.aux)
+        return [await clone._attach(ClonedProcess(pids[clone.id]), control, stdout)
+                for clone, ((control, _), (stdout, _)) in zip(clones, pipes)]
+
+    async def _attach(self, process: ClonedProcess, pipe_parent: connection.Connection, stdout_pipe_parent: connection.Connection) -> ActionResponse:
+        for pipe in (self._pipe_parent, self._pipe_child, self._stdout_pipe_parent, self._stdout_pipe_child):
+            if pipe is not None:
+                pipe.close()
+        self._process, self._pipe_parent, self._stdout_pipe_parent = process, pipe_parent, stdout_pipe_parent
+        self._pipe_child = self._stdout_pipe_child = None
+        self.start_stdout_listener()
+
+        response: ActionResponse = await to_thread(self._pipe_parent.recv)
+        # The clone inherited the affinity of its template
+        self.pin(self._cores or core_pool.shared_cores())
+        if environments.get(self._id) is self:
+            # A registered environment restored from its baseline
+            self._set_state(response.state)
+        else:
+            self._state = response.state
+            if not self._internal:
+                event_manager.publish(asdict(EnvironmentEvent(EnvironmentEventType.CREATED, self.describe())))
+        return response
+
+    @property
+    def agents_stale(self) -> bool:
+        """
+        Whether agents were installed or removed since the worker loaded them. Nodes have agents of their own.
+        """
+        return not self._node and self._agents_version != agent_registry.version
+
+    async def refresh_agents(self) -> ActionResponse:
+        """
+        Brings the agents of an environment that was not initialized yet up to date. New agents are loaded into the
+        running worker, if that is not possible (e.g., an agent was upgraded), the worker is replaced by a fresh one
+        created from the same configuration.
+        """
+        if not self._process.is_alive():
+            self._exited()
+            return ActionResponse(self._id, EnvironmentState.TERMINATED.name, False, f"The environment is already terminated.")
+        if self._state != EnvironmentState.CREATED.name:
+            raise HTTPException(status_code=409, detail=ActionResponse(self._id, self._state, False, "Agents can only be refreshed before the environment is initialized."))
+
+        version = agent_registry.version
+        response: ActionResponse = await asyncio.shield(self._exchange(EnvironmentAction.REFRESH_AGENTS, None))
+        if not response.success:
+            print(f"{self._id}: The agents could not be refreshed in place, replacing the worker. Reason: {response.message}")
+            response = await asyncio.shield(self._respawn())
+            if not response.success:
+                raise HTTPException(status_code=409, detail=response)
+
+        self._agents_version = version
+        return response
+
+    async def _respawn(self) -> ActionResponse:
+        """
+        Replaces the worker by a new one. The environment keeps its id, port and resources.
+        """
+        async with self._lock:
+            self._respawning = True
+            try:
+                process = self._process
+                self._pipe_parent.send((EnvironmentAction.TERMINATE, None))
+                await to_thread(self._pipe_parent.recv)
+                await to_thread(process.join)
+
+                self._spawn()
+                response: ActionResponse = await self._launch()
+            finally:
+                self._respawning = False
+
+        if response.success:
+            response.message = f"The worker was replaced. {response.message}"
+        else:
+            self._exited()
+        return response
+
+    async def save_baseline(self) -> ActionResponse:
+        """
+        Forks the worker into an idle baseline, which incremental resets restore the environment from. The environment
+        must not be running, the baseline has its state at this moment.
+        """
+        if self._node:
+            # Checked before copying, as the wrapper of the baseline would connect to the node
+            raise HTTPException(status_code=409, detail=ActionResponse(self._id, self._state, False, "Environments on nodes cannot save a baseline."))
+        baseline = self.copy(f"{self._id}:baseline", self.agent_manager_port)
+        baseline._internal = True
+        # The baseline holds no resources of its own, the restored workers use those of the environment
+        baseline._exited_handled = True
+        await self.clone([baseline])
+        self.discard_baseline()
+        self._baseline = baseline
+        return ActionResponse(self._id, self._state, True, "The baseline for incremental resets was saved.")
+
+    def discard_baseline(self) -> None:
+        if self._baseline:
+            with contextlib.suppress(OSError):
+                self._baseline._pipe_parent.send((EnvironmentAction.TERMINATE, None))
+            self._baseline = None
+
+    async def reset(self, mode: ResetMode = ResetMode.FULL) -> ActionResponse:
+        """
+        Resets the environment. A full reset is left to the environment. An incremental one replaces the worker by a
+        fork of the baseline (see save_baseline), so the pages the episode did not touch are never copied. Recreate
+        replaces the worker by a fresh one created from the configuration and initializes it.
+        """
+        match mode:
+            case ResetMode.FULL:
+                return await self.perform_action(EnvironmentAction.RESET)
+            case ResetMode.INCREMENTAL:
+                if not self._baseline or not self._baseline._process.is_alive():
+                    raise HTTPException(status_code=409, detail=ActionResponse(self._id, self._state, False, "No baseline was saved for the environment."))
+                response = await asyncio.shield(self._restore())
+            case ResetMode.RECREATE:
+                response = await asyncio.shield(self._respawn())
+                if response.success:
+                    self._set_state(response.state)
+                    return await self.perform_action(EnvironmentAction.INIT)
+
+        if not response.success:
+            raise HTTPException(status_code=409, detail=response)
+        return response
+
+    async def _restore(self) -> ActionResponse:
+        """
+        Replaces the worker by a fork of the baseline.
+        """
+        if not self._process.is_alive():
+            self._exited()
+            return ActionResponse(self._id, EnvironmentState.TERMINATED.name, False, f"The environment is already terminated.")
+
+        async with self._lock:
+            self._respawning = True
+            try:
+                process = self._process
+                self._pipe_parent.send((EnvironmentAction.TERMINATE, None))
+                await to_thread(self._pipe_parent.recv)
+                await to_thread(process.join)
+
+                try:
+                    response = (await self._baseline.clone([self]))[0]
+                except HTTPException as e:
+                    response = e.detail
+            finally:
+                self._respawning = False
+
+        if response.success:
+            self._agents_version = self._baseline._agents_version
+            response.message = "The environment was restored from its baseline."
+        else:
+            self._exited()
         return response
 
     async def perform_action(self, action: EnvironmentAction | None, param: Any = None) -> ActionResponse:
         if not self._process.is_alive():
-            del environments[self._id]
+            self._exited()
             return ActionResponse(self._id, EnvironmentState.TERMINATED.name, False, f"The environment is already terminated.")
 
-        with self._lock:
-            self._pipe_parent.send((action, param))
-            response: ActionResponse = await to_thread(self._pipe_parent.recv)
+        # Agents are instantiated when the environment is configured and initialized, so they must be current by then
+        if action in (EnvironmentAction.INIT, EnvironmentAction.CONFIGURE) and self.agents_stale and self._state == EnvironmentState.CREATED.name:
+            await self.refresh_agents()
+
+        # The exchange is shielded, so that a cancelled caller cannot leave a reply in the pipe for the next one
+        response: ActionResponse = await asyncio.shield(self._exchange(action, param))
+
+        if response:
+            self._set_state(response.state)
+            # A replaced worker is created with the latest parameters
+            if action == EnvironmentAction.CONFIGURE and response.success:
+                self._parameters = param
 
         if response and not response.success:
-            raise HTTPException(status_code=409, detail=asdict(response))
+            raise HTTPException(status_code=409, detail=response)
         return response
 
-    def loop(self, id: str, platform: PlatformSpecification, configuration: str, parameters: Optional[Dict[str, Any]], pipe: connection.Connection, stdout_pipe: connection.Connection):
-        with pipe_redirector(stdout_pipe):
-            environment_thread = None
+    async def export(self, table: ExportTable, format: ExportFormat) -> connection.Connection:
+        """
+        Starts an export of the run data in the worker. Returns the pipe the data are streamed to, as byte messages
+        until the end of file. Closing it early stops the export.
+        """
+        if not self._process.is_alive():
+            self._exited()
+            raise HTTPException(status_code=409, detail=ActionResponse(self._id, EnvironmentState.TERMINATED.name, False, f"The environment is already terminated."))
+        if self._node:
+            raise HTTPException(status_code=409, detail=ActionResponse(self._id, self._state, False, "The run data of environments on nodes cannot be exported yet."))
+
+        receiver, sender = Pipe(duplex=False)
+        try:
+            response = await asyncio.shield(self._start_export(table, format, sender))
+        except asyncio.CancelledError:
+            # Nobody is going to read the export, which stops it
+            receiver.close()
+            raise
+
+        if not response.success:
+            receiver.close()
+            raise HTTPException(status_code=409, detail=response)
+        return receiver
+
+    async def _start_export(self, table: ExportTable, format: ExportFormat, sender: connection.Connection) -> ActionResponse:
+        try:
+            async with self._lock:
+                self._pipe_parent.send((EnvironmentAction.EXPORT, (table, format)))
+                reduction.send_handle(self._pipe_parent, sender.fileno(), self._process.pid)
+                return await to_thread(self._pipe_parent.recv)
+        finally:
+            # The worker has its own copy by now
+            sender.close()
 
+    async def _exchange(self, action: EnvironmentAction | None, param: Any) -> ActionResponse:
+        with tracing.span(f"exchange {action}", environment=self._id):
+            with tracing.span("lock"):
+                await self._lock.acquire()
             try:
-                environment = Environment.create(platform)
-                if configuration:
-                    environment.configure(*environment.configuration.general.load_configuration(configuration), parameters=parameters)
-                pipe.send(ActionResponse(id, EnvironmentState.CREATED.name, True, f"Environment successfully created.", environment.configuration.general.save_configuration(2)))
-            except Exception as e:
-                if configuration:
-                    message = f"Failed to create and configure the environment. Reason: {e}"
-                else:
-                    message = f"Failed to create the environment. Reason: {e}"
-                pipe.send(ActionResponse(id, EnvironmentState.TERMINATED.name, False, message))
-                return
+                self._pipe_parent.send((action, param, tracing.outgoing()))
+                return await to_thread(self._pipe_parent.recv)
+            finally:
+                self._lock.release()
+                self.last_active = time.monotonic()
 
+    @staticmethod
+    def loop(id: str, platform: PlatformSpecification, configuration: str, parameters: Optional[Dict[str, Any]], pipe: connection.Connection, stdout_pipe: connection.Connection,
+             cores: Optional[set[int]] = None, nice: Optional[int] = None, agent_path: Optional[str] = None):
+        # The worker inherits the affinity of the API process, so it has to be set before any threads are started
+        placement.apply(cores, nice)
 
+        # Agents of the set take precedence over the installed ones, cyst finds them by their entry points on sys.path
+        if agent_path:
+            sys.path.insert(0, agent_path)
+            importlib.invalidate_caches()
+
+        with pipe_redirector(stdout_pipe) as stdout_writer:
+            # Spans go to the controller along with the output, clones switch the pipe of the writer
+            tracing.collector.forward(lambda span: stdout_writer.pipe_conn.send(span))
+            worker = EnvironmentWorker(id, configuration)
+            response = worker.create(platform, parameters)
+            pipe.send(response)
+            if not response.success:
+                return
+
+            reported_state = worker.state
+            clone_pids: set[int] = set()
             while True:
-                if not pipe.poll(1):  # Avoid blocking indefinitely
+                if not pipe.poll(STATE_POLL_INTERVAL):  # Avoid blocking indefinitely
+                    # Clones are children of this worker, which has to reap them
+                    for pid in list(clone_pids):
+                        with contextlib.suppress(ChildProcessError):
+                            if os.waitpid(pid, os.WNOHANG)[0] == 0:
+                                continue
+                        clone_pids.discard(pid)
+                    # Let the controller know about state changes that happened on their own, e.g., a finished run
+                    if worker.state != reported_state:
+                        reported_state = worker.state
+                        stdout_pipe.send(StateNotification(id, reported_state))
                     continue
-                terminate = False
                 try:
                     action: EnvironmentAction | None = None
                     param: Any = None
-                    response = None
-
-                    action, param = pipe.recv()
-
-                    match action:
-                        case EnvironmentAction.INIT:
-                            e = environment.control.init()
-                            response = ActionResponse(id, environment.control.state.name, e[0], "The environment was successfully initialized" if e[0] else "Failed to initialize the environment.")
-                        case EnvironmentAction.CONFIGURE:
-                            try:
-                                environment.configure(*environment.configuration.general.load_configuration(self.configuration), parameters=param)
-                                response = ActionResponse(id, environment.control.state.name, True, "The environment was successfully configured.")
-                            except Exception as e:
-                                response = ActionResponse(id, EnvironmentState.TERMINATED.name, False, "Failed to configure the environment.")
-                        case EnvironmentAction.RUN:
-                            # To make our life easier, we do a manual check if the thread is in init or paused state
-                            if environment.control.state == EnvironmentState.INIT or environment.control.state == EnvironmentState.PAUSED:
-                                environment_thread = Thread(target=environment.control.run)
-                                environment_thread.start()
-
-                                # give it a time to start (it should be fairly fast)
-                                counter = 0
-                                while counter < 20:
-                                    if environment.control.state == EnvironmentState.INIT or environment.control.state == EnvironmentState.PAUSED:
-                                        time.sleep(0.2)
-                                    else:
-                                        break
-
-                                if environment.control.state == EnvironmentState.RUNNING:
-                                    response = ActionResponse(id, EnvironmentState.RUNNING.name, True, "The environment is running.")
-                                else:
-                                    response = ActionResponse(id, environment.control.state.name, False, "Failed to run the environment.")
-                            else:
-                                response = ActionResponse(id, environment.control.state.name, False, "The environment is not in the state suitable for running.")
-                        case EnvironmentAction.RESET:
-                            e = environment.control.reset()
-                            if e[0]:
-                                response = ActionResponse(id, environment.control.state.name, True, "The environment was successfully reset.")
-                            else:
-                                response = ActionResponse(id, environment.control.state.name, False, "Failed to reset the environment.")
-                        case EnvironmentAction.COMMIT:
-                            if environment.control.state != EnvironmentState.FINISHED or environment.control.state != EnvironmentState.TERMINATED:
-                                response = ActionResponse(id, environment.control.state.name, False, "The environment is not in a suitable state for commit.")
-                            else:
-                                environment.control.commit()
-                                response = ActionResponse(id, environment.control.state.name, True, "The environment data was successfully committed.")
-                        case EnvironmentAction.PAUSE:
-                            e = environment.control.pause()
-                            if e[0]:
-                                response = ActionResponse(id, environment.control.state.name, True, "The environment was successfully paused.")
-                            else:
-                                if environment.control.state != EnvironmentState.RUNNING:
-                                    response = ActionResponse(id, environment.control.state.name, False, "Failed to pause the environment, it is not in the running state.")
-                                else:
-                                    response = ActionResponse(id, environment.control.state.name, False, "Failed to pause the environment.")
-                        case EnvironmentAction.TERMINATE:
-                            environment.control.terminate()
-                            if environment_thread:
-                                # Environment has issues when terminating without running, so we just do our stuff and die
-                                environment_thread.join()
-
-                            response = ActionResponse(id, environment.control.state.name, True, "The environment was successfully terminated.")
-                            terminate = True
-                        case EnvironmentAction.GET_STATE:
-                            response = ActionResponse(id, environment.control.state.name, True, "")
 
+                    # The controller adds the trace context to the actions it traces
+                    action, param, *trace = pipe.recv()
+                    with tracing.incoming(trace[0] if trace else None), tracing.span(f"worker {action}", environment=worker.id):
+                        if action == EnvironmentAction.CLONE:
+                            response, clone_pipes = fork_clones(worker, pipe, param)
+                            if clone_pipes:
+                                # This is a clone now, it continues with its own pipes and forgets the other clones
+                                pipe.close()
+                                stdout_pipe.close()
+                                pipe, stdout_pipe = clone_pipes
+                                stdout_writer.pipe_conn = stdout_pipe
+                                clone_pids = set()
+                            elif response.success:
+                                clone_pids.update(json.loads(response.aux).values())
+                        elif action == EnvironmentAction.EXPORT:
+                            response = worker.export(*param, connection.Connection(reduction.recv_handle(pipe)))
+                        else:
+                            response = worker.perform(action, param)
+
+                    if response:
+                        reported_state = response.state
                     pipe.send(response)
-                    if not response or terminate:
+                    if not response or action == EnvironmentAction.TERMINATE:
                         break
 
                 except (KeyboardInterrupt, InterruptedError):
                     pass
 
-                except BrokenPipeError:
-                    environment.control.terminate()
+                except (BrokenPipeError, EOFError):
+                    # The controller is gone, e.g., it was shut down while this was an idle clone or baseline
+                    worker.environment.control.terminate()
                     break
 
 
-environments: dict[str, EnvironmentWrapper] = dict()
+def fork_clones(worker: "EnvironmentWorker", pipe: connection.Connection, clones: list[tuple[str, int]]) -> tuple[ActionResponse, Optional[tuple[connection.Connection, connection.Connection]]]:
+    """
+    Forks the worker into clones, which start from exactly the same state of the environment and share its memory until
+    they change it. The controller follows the CLONE action with the control and stdout pipe of each clone, in the
+    order of clones, given as pairs of id and agent manager port. In the worker, returns the response with the pids of
+    the clones by their ids. In a clone, returns its first response and its pipes.
+    """
+    # Take all the handles first, so that the pipe stays in sync even if the clones cannot be made
+    handles = [(reduction.recv_handle(pipe), reduction.recv_handle(pipe)) for _ in clones]
+
+    # The threads of a running environment would not survive the fork
+    if worker.environment.control.state not in (EnvironmentState.CREATED, EnvironmentState.INIT):
+        for handle in (h for pair in handles for h in pair):
+            os.close(handle)
+        return ActionResponse(worker.id, worker.state, False, "Only environments that are not running can be cloned."), None
+
+    pids = {}
+    for index, ((clone_id, port), (control, stdout)) in enumerate(zip(clones, handles)):
+        pid = os.fork()
+        if pid == 0:
+            for handle in (h for pair in handles[index + 1:] for h in pair):
+                os.close(handle)
+            template_id, worker.id = worker.id, clone_id
+            os.environ["CYST_AGENT_ENV_MANAGER_PORT"] = str(port)
+            return (ActionResponse(clone_id, worker.state, True, f"The environment was cloned from {template_id}."),
+                    (connection.Connection(control), connection.Connection(stdout)))
+
+        os.close(control)
+        os.close(stdout)
+        pids[clone_id] = pid
+
+    return ActionResponse(worker.id, worker.state, True, f"The environment was cloned {len(pids)} times.", json.dumps(pids)), None
+
+
+class EnvironmentWorker:
+    """
+    The environment of a worker and the actions on it. EnvironmentWrapper.loop serves the actions sent by the
+    controller, the batch runner (dojo.batch) drives the environment directly.
+    """
+    def __init__(self, id: str, configuration: str):
+        self.id = id
+        self.configuration = configuration
+        self.environment: Optional[Environment] = None
+        self.environment_thread: Optional[Thread] = None
+        self.agents: Dict[str, str] = {}
+
+    @property
+    def state(self) -> str:
+        return self.environment.control.state.name
+
+    def create(self, platform: PlatformSpecification, parameters: Optional[Dict[str, Any]]) -> ActionResponse:
+        try:
+            self.environment = Environment.create(platform)
+            if self.configuration:
+                self.environment.configure(*self.environment.configuration.general.load_configuration(self.configuration), parameters=parameters)
+        except Exception as e:
+            if self.configuration:
+                message = f"Failed to create and configure the environment. Reason: {e}"
+            else:
+                message = f"Failed to create the environment. Reason: {e}"
+            return ActionResponse(self.id, EnvironmentState.TERMINATED.name, False, message)
+
+        self.agents = installed_agents()
+        return ActionResponse(self.id, EnvironmentState.CREATED.name, True, f"Environment successfully created.", self.environment.configuration.general.save_configuration(2))
+
+    def wait(self, timeout: Optional[float] = None) -> str:
+        """
+        Waits until a run of the environment ends. Returns the state reached.
+        """
+        if self.environment_thread:
+            self.environment_thread.join(timeout)
+        return self.state
+
+    def export(self, table: ExportTable, format: ExportFormat, pipe: connection.Connection) -> ActionResponse:
+        """
+        Starts writing the run data to the pipe in a thread, so the worker keeps serving actions while it is read.
+        """
+        try:
+            records = export.run_records(self.environment, table)
+        except Exception as e:
+            pipe.close()
+            return ActionResponse(self.id, self.state, False, f"Failed to export the run data. Reason: {e}")
+
+        Thread(target=export.stream_records, args=(records, format, pipe), daemon=True).start()
+        return ActionResponse(self.id, self.state, True, f"Exporting {len(records)} rows of {table}.")
+
+    def perform(self, action: EnvironmentAction | None, param: Any = None) -> Optional[ActionResponse]:
+        response = None
+
+        match action:
+            case EnvironmentAction.INIT:
+                e = self.environment.control.init()
+                response = ActionResponse(self.id, self.environment.control.state.name, e[0], "The environment was successfully initialized" if e[0] else "Failed to initialize the environment.")
+            case EnvironmentAction.CONFIGURE:
+                try:
+                    self.environment.configure(*self.environment.configuration.general.load_configuration(self.configuration), parameters=param)
+                    response = ActionResponse(self.id, self.environment.control.state.name, True, "The environment was successfully configured.")
+                except Exception as e:
+                    response = ActionResponse(self.id, EnvironmentState.TERMINATED.name, False, "Failed to configure the environment.")
+            case EnvironmentAction.RUN:
+                # To make our life easier, we do a manual check if the thread is in init or paused state
+                if self.environment.control.state == EnvironmentState.INIT or self.environment.control.state == EnvironmentState.PAUSED:
+                    self.environment_thread = Thread(target=self.environment.control.run)
+                    self.environment_thread.start()
+
+                    # give it a time to start (it should be fairly fast)
+                    counter = 0
+                    while counter < 20:
+                        if self.environment.control.state == EnvironmentState.INIT or self.environment.control.state == EnvironmentState.PAUSED:
+                            time.sleep(0.2)
+                            counter += 1
+                        else:
+                            break
+
+                    if self.environment.control.state == EnvironmentState.RUNNING:
+                        response = ActionResponse(self.id, EnvironmentState.RUNNING.name, True, "The environment is running.")
+                    else:
+                        response = ActionResponse(self.id, self.environment.control.state.name, False, "Failed to run the environment.")
+                else:
+                    response = ActionResponse(self.id, self.environment.control.state.name, False, "The environment is not in the state suitable for running.")
+            case EnvironmentAction.RESET:
+                e = self.environment.control.reset()
+                if e[0]:
+                    response = ActionResponse(self.id, self.environment.control.state.name, True, "The environment was successfully reset.")
+                else:
+                    response = ActionResponse(self.id, self.environment.control.state.name, False, "Failed to reset the environment.")
+            case EnvironmentAction.COMMIT:
+                if self.environment.control.state not in (EnvironmentState.FINISHED, EnvironmentState.TERMINATED):
+                    response = ActionResponse(self.id, self.environment.control.state.name, False, "The environment is not in a suitable state for commit.")
+                else:
+                    self.environment.control.commit()
+                    response = ActionResponse(self.id, self.environment.control.state.name, True, "The environment data was successfully committed.")
+            case EnvironmentAction.PAUSE:
+                e = self.environment.control.pause()
+                if e[0]:
+                    response = ActionResponse(self.id, self.environment.control.state.name, True, "The environment was successfully paused.")
+                else:
+                    if self.environment.control.state != EnvironmentState.RUNNING:
+                        response = ActionResponse(self.id, self.environment.control.state.name, False, "Failed to pause the environment, it is not in the running state.")
+                    else:
+                        response = ActionResponse(self.id, self.environment.control.state.name, False, "Failed to pause the environment.")
+            case EnvironmentAction.TERMINATE:
+                self.environment.control.terminate()
+                if self.environment_thread:
+                    # Environment has issues when terminating without running, so we just do our stuff and die
+                    self.environment_thread.join()
+
+                response = ActionResponse(self.id, self.environment.control.state.name, True, "The environment was successfully terminated.")
+            case EnvironmentAction.PROFILE:
+                # The worker serves no other actions meanwhile, the environment itself keeps running in its thread
+                mode, duration, option = param
+                if mode == ProfileMode.CPU and self.environment.control.state != EnvironmentState.RUNNING:
+                    # Only the environment's thread has anything worth sampling, which runs just in the running state
+                    response = ActionResponse(self.id, self.environment.control.state.name, False, "Failed to profile the environment, it is not in the running state.")
+                else:
+                    try:
+                        if mode == ProfileMode.CPU:
+                            result = profiling.sample_stacks(duration, option)
+                        else:
+                            result = profiling.top_allocations(duration, option)
+                        response = ActionResponse(self.id, self.environment.control.state.name, True, f"The environment was profiled for {duration} s.", result)
+                    except Exception as e:
+                        response = ActionResponse(self.id, self.environment.control.state.name, False, f"Failed to profile the environment. Reason: {e}")
+            case EnvironmentAction.GET_STATE:
+                response = ActionResponse(self.id, self.environment.control.state.name, True, "")
+            case EnvironmentAction.REFRESH_AGENTS:
+                response = load_new_agents(self.id, self.environment, self.agents)
+
+
+        return response
+
+
+def repin_shared_workers() -> None:
+    shared = core_pool.shared_cores()
+    for env in environments.values():
+        if env.follows_shared_pool:
+            env.pin(shared)
+
+
+class EnvironmentRegistry(dict[str, EnvironmentWrapper]):
+    """
+    A dictionary of environments by their id, which additionally keeps the ids indexed by the values of the fields in
+    INDEXED_FIELDS, so that environments can be filtered without going through all of them.
+    """
+    INDEXED_FIELDS = ("state", "platform", "provider", "configuration")
+
+    def __init__(self):
+        super().__init__()
+        self._indexes: dict[str, dict[Any, set[str]]] = {f: defaultdict(set) for f in self.INDEXED_FIELDS}
+        self._sequence: dict[str, int] = {}
+        self._counter = 0
+
+    def __setitem__(self, id: str, wrapper: EnvironmentWrapper) -> None:
+        if id in self:
+            del self[id]
+        super().__setitem__(id, wrapper)
+        self._counter += 1
+        self._sequence[id] = self._counter
+        for f, value in wrapper.describe().items():
+            if f in self._indexes:
+                self._indexes[f][value].add(id)
+
+    def __delitem__(self, id: str) -> None:
+        wrapper = self[id]
+        super().__delitem__(id)
+        del self._sequence[id]
+        for f, value in wrapper.describe().items():
+            if f in self._indexes:
+                self._discard(f, value, id)
+
+    def pop(self, id: str, *default):
+        if id not in self:
+            if default:
+                return default[0]
+            raise KeyError(id)
+        wrapper = self[id]
+        del self[id]
+        return wrapper
+
+    def _discard(self, f: str, value: Any, id: str) -> None:
+        ids = self._indexes[f].get(value)
+        if ids is not None:
+            ids.discard(id)
+            if not ids:
+                del self._indexes[f][value]
+
+    def reindex(self, wrapper: EnvironmentWrapper, f: str, old_value: Any, new_value: Any) -> None:
+        if self.get(wrapper.id) is not wrapper:
+            return
+        self._discard(f, old_value, wrapper.id)
+        self._indexes[f][new_value].add(wrapper.id)
+
+    def sequence(self, id: str) -> int:
+        """
+        The order in which the environment was registered.
+        """
+        return self._sequence[id]
+
+    def filter(self, **filters: set[Any]) -> set[str]:
+        """
+        Returns ids of the environments, whose fields match one of the values given for each filter. Empty filters are
+        ignored.
+        """
+        result = None
+        # Start with the most selective filter to keep the intersections small
+        candidates = []
+        for f, values in filters.items():
+            if values:
+                candidates.append(set().union(*(self._indexes[f].get(v, set()) for v in values)))
+        for ids in sorted(candidates, key=len):
+            result = ids if result is None else result & ids
+            if not result:
+                break
+        return set(self.keys()) if result is None else result
+
+
+environments: EnvironmentRegistry = EnvironmentRegistry()
@@ -41,6 +41,50 @@ class Settings(BaseSettings):
     BACKEND_CORS_ORIGINS: Annotated[list[AnyUrl] | str, BeforeValidator(parse_cors)] = []
 
     PROJECT_NAME: str
+
+    # Ports handed out to the agent managers of environments
+    AGENT_ENV_MANAGER_PORT_FIRST: int = 8283
+    AGENT_ENV_MANAGER_PORT_LAST: int = 9282
+
+    # Persistent cache of built agent wheels, used as a local package index
+    AGENT_WHEELHOUSE: str = "~/.cache/dojo/wheelhouse"
+    # Content-addressed store of agent files and the agent sets linked from it
+    AGENT_STORE: str = "~/.cache/dojo/agent-store"
+
+    # Admission control budgets for environments. Unset (or 0) means unlimited environments and CPUs, and 80 % of the
+    # physical memory (in MB). The CPU budget is capped at the cores not reserved for the API process
+    SCHEDULER_MAX_ENVIRONMENTS: int | None = None
+    SCHEDULER_CPU_BUDGET: float | None = None
+    SCHEDULER_MEMORY_BUDGET: int | None = None
+
+    # Budgets for the time spent on imports when starting the API process and an environment worker [ms], see
+    # dojo.lib.importtime. Unset means no budget
+    IMPORT_BUDGET_API: float | None = None
+    IMPORT_BUDGET_WORKER: float | None = None
+
+    # Shared secret of the controller and its worker nodes (dojo.node_daemon), required to use nodes
+    NODE_AUTHKEY: str | None = None
+
+    # Memory watchdog of the workers, see dojo.watchdog. Only environments given memory limits are limited, unless the
+    # factors are set, then the limits default to multiples of the memory an environment reserved. Idle environments
+    # are evicted while less than the given fraction of the host memory is available and the workers use at least the
+    # given share of the used memory, at most the given number until the memory is available again. An interval of 0
+    # turns the watchdog off
+    WATCHDOG_INTERVAL: float = 1
+    WATCHDOG_SOFT_LIMIT_FACTOR: float | None = None
+    WATCHDOG_HARD_LIMIT_FACTOR: float | None = None
+    WATCHDOG_MIN_AVAILABLE: float = 0.1
+    WATCHDOG_EVICTION_SHARE: float = 0.5
+    WATCHDOG_MAX_EVICTIONS: int = 3
+
+    # Tracing of actions from the API to the workers, see dojo.lib.tracing. The most recent spans are kept in memory
+    # and optionally appended to a file in the OTLP/JSON format
+    TRACING: bool = True
+    TRACE_BUFFER: int = 10000
+    TRACE_FILE: str | None = None
+
+    # Keep one core for the API process, environments then use the remaining ones
+    RESERVE_API_CORE: bool = True
     SENTRY_DSN: HttpUrl | None = None
     # POSTGRES_SERVER: str
     # POSTGRES_PORT: int = 5432
@@ -0,0 +1,137 @@
+import asyncio
+import time
+import uuid
+
+from dataclasses import dataclass, field
+from enum import StrEnum, auto
+from typing import Any, AsyncIterator, Awaitable, Callable, Optional
+
+from fastapi import HTTPException
+
+
+class JobState(StrEnum):
+    PENDING = auto()
+    RUNNING = auto()
+    SUCCEEDED = auto()
+    FAILED = auto()
+    CANCELLED = auto()
+
+
+@dataclass
+class Job:
+    id: str
+    action: str
+    environment_id: Optional[str]
+    state: str = JobState.PENDING
+    progress: float = 0.0
+    message: str = ""
+    result: Any = None
+    created: float = field(default_factory=time.time)
+    finished: Optional[float] = None
+
+    @property
+    def done(self) -> bool:
+        return self.state in (JobState.SUCCEEDED, JobState.FAILED, JobState.CANCELLED)
+
+
+class JobManager:
+    """
+    Runs long actions in the background and keeps track of their outcome. Only the last `retention` finished jobs are
+    remembered.
+    """
+    def __init__(self, retention: int = 1000):
+        self._jobs: dict[str, Job] = {}
+        self._tasks: dict[str, asyncio.Task] = {}
+        self._logs: dict[str, list[str]] = {}
+        self._followers: dict[str, list[asyncio.Queue]] = {}
+        self._retention = retention
+
+    def submit(self, action: str, environment_id: Optional[str], work: Callable[[Job], Awaitable[Any]]) -> Job:
+        job = Job(str(uuid.uuid4()), action, environment_id)
+        self._jobs[job.id] = job
+        self._tasks[job.id] = asyncio.create_task(self._run(job, work))
+        self._prune()
+        return job
+
+    async def _run(self, job: Job, work: Callable[[Job], Awaitable[Any]]) -> None:
+        job.state = JobState.RUNNING
+        try:
+            job.result = await work(job)
+            job.state = JobState.SUCCEEDED
+            job.progress = 1.0
+        except asyncio.CancelledError:
+            job.state = JobState.CANCELLED
+        except HTTPException as e:
+            job.state = JobState.FAILED
+            job.result = e.detail
+        except Exception as e:
+            job.state = JobState.FAILED
+            job.result = str(e)
+        finally:
+            job.finished = time.time()
+            self._tasks.pop(job.id, None)
+            for queue in self._followers.pop(job.id, []):
+                queue.put_nowait(None)
+
+    def _prune(self) -> None:
+        finished = [job for job in self._jobs.values() if job.done]
+        for job in finished[:max(0, len(finished) - self._retention)]:
+            del self._jobs[job.id]
+            self._logs.pop(job.id, None)
+
+    def log(self, job: Optional[Job], line: str) -> None:
+        """
+        Records a line of the job's output and passes it to everyone following the job. Does nothing without a job, so
+        that the same code can run both as a job and directly.
+        """
+        if not job:
+            return
+        self._logs.setdefault(job.id, []).append(line)
+        for queue in self._followers.get(job.id, []):
+            queue.put_nowait(line)
+
+    def get_log(self, id: str) -> list[str]:
+        return self._logs.get(id, [])
+
+    async def follow(self, id: str) -> AsyncIterator[str]:
+        """
+        Yields the output of the job recorded so far and then the new lines as they come, until the job finishes.
+        """
+        job = self._jobs.get(id)
+        if not job:
+            return
+
+        queue = asyncio.Queue()
+        for line in self.get_log(id):
+            queue.put_nowait(line)
+        if job.done:
+            queue.put_nowait(None)
+        else:
+            self._followers.setdefault(id, []).append(queue)
+
+        try:
+            while (line := await queue.get()) is not None:
+                yield line
+        finally:
+            if queue in self._followers.get(id, []):
+                self._followers[id].remove(queue)
+
+    def get(self, id: str) -> Optional[Job]:
+        return self._jobs.get(id)
+
+    def list(self) -> list[Job]:
+        return list(self._jobs.values())
+
+    def cancel(self, id: str) -> bool:
+        """
+        Cancels a job that has not finished yet. An action that was already handed over to a worker is still carried
+        out by the worker, but its result is discarded.
+        """
+        task = self._tasks.get(id)
+        if not task:
+            return False
+        task.cancel()
+        return True
+
+
+jobs = JobManager()
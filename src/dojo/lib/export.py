@@ -0,0 +1,119 @@
+"""
+Columnar export of the run data of an environment: the messages exchanged in the run (with the actions of the requests
+and the results of the responses) and the statistics of the committed run. The data are written as Arrow IPC streams
+or Parquet files in record batches, so neither the worker nor the API ever holds more than a batch of converted rows.
+
+pyarrow is optional (pip install pyarrow), it is only imported by the workers that export something.
+"""
+import importlib.util
+import io
+
+from enum import StrEnum, auto
+from multiprocessing import connection
+from typing import Any, Dict, Sequence
+
+from cyst.api.environment.environment import Environment
+
+
+BATCH_SIZE = 10_000
+# Pipe messages carry whole buffers, not every small write of the writers
+BUFFER_SIZE = 1 << 20
+
+
+class ExportTable(StrEnum):
+    MESSAGES = auto()
+    STATISTICS = auto()
+
+
+class ExportFormat(StrEnum):
+    ARROW = auto()
+    PARQUET = auto()
+
+
+MEDIA_TYPES = {
+    ExportFormat.ARROW: "application/vnd.apache.arrow.stream",
+    ExportFormat.PARQUET: "application/vnd.apache.parquet",
+}
+
+EXTENSIONS = {
+    ExportFormat.ARROW: "arrows",
+    ExportFormat.PARQUET: "parquet",
+}
+
+
+def available() -> bool:
+    return importlib.util.find_spec("pyarrow") is not None
+
+
+def run_records(environment: Environment, table: ExportTable) -> Sequence[Dict[str, Any]]:
+    """
+    Rows of the table for the current run. Raises RuntimeError if the data store of the environment cannot be read.
+    """
+    statistics = environment.infrastructure.statistics
+    if table == ExportTable.STATISTICS:
+        return [{
+            "run_id": str(statistics.run_id),
+            "configuration_id": str(statistics.configuration_id),
+            "start_time_real": statistics.start_time_real,
+            "end_time_real": statistics.end_time_real,
+            "end_time_virtual": statistics.end_time_virtual,
+        }]
+
+    # cyst has no public API for reading the data store, the messages are only kept by the memory backend
+    store = getattr(getattr(getattr(environment, "_data_store", None), "_backend", None), "_store", None)
+    if store is None:
+        raise RuntimeError("The messages can only be exported from environments with the memory data store backend.")
+    return store.get(str(statistics.run_id), {}).get("Message", [])
+
+
+class PipeSink(io.RawIOBase):
+    """
+    Write-only file, whose writes are sent as byte messages over a pipe.
+    """
+    def __init__(self, pipe: connection.Connection):
+        self._pipe = pipe
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, b) -> int:
+        self._pipe.send_bytes(b)
+        return len(b)
+
+
+def write_records(records: Sequence[Dict[str, Any]], format: ExportFormat, sink, batch_size: int = BATCH_SIZE) -> int:
+    """
+    Writes the records in record batches to a file-like sink. Returns the number of rows written.
+    """
+    import pyarrow
+    import pyarrow.parquet
+
+    # The records may still grow (e.g., messages of a running environment), the export ends where they ended now
+    count = len(records)
+    schema = pyarrow.RecordBatch.from_pylist(list(records[:1])).schema if count else pyarrow.schema([])
+    if format == ExportFormat.PARQUET:
+        writer = pyarrow.parquet.ParquetWriter(sink, schema)
+    else:
+        writer = pyarrow.ipc.new_stream(sink, schema)
+
+    with writer:
+        for start in range(0, count, batch_size):
+            batch = pyarrow.RecordBatch.from_pylist(list(records[start:min(start + batch_size, count)]), schema=schema)
+            writer.write_batch(batch)
+    return count
+
+
+def stream_records(records: Sequence[Dict[str, Any]], format: ExportFormat, pipe: connection.Connection) -> None:
+    """
+    Writes the records to the pipe and closes it. The reader may close its end any time, which ends the export.
+    """
+    try:
+        with io.BufferedWriter(PipeSink(pipe), BUFFER_SIZE) as sink:
+            write_records(records, format, sink)
+    except (BrokenPipeError, ConnectionResetError):
+        pass
+    except Exception as e:
+        # The reader only sees a truncated stream, the reason goes to the log of the environment
+        print(f"The export failed. Reason: {e}")
+    finally:
+        pipe.close()
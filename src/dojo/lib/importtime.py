@@ -0,0 +1,127 @@
+import asyncio
+import importlib.metadata
+import re
+import sys
+
+from dataclasses import dataclass, field
+from typing import Optional
+
+from dojo.core.config import settings
+
+
+# Imports done by the API process, followed by the ones a worker adds on top of them. Workers are forked from the API
+# process, so they only pay for the cyst components and agents, which cyst loads by their entry points when creating
+# the environment.
+PROFILE_SCRIPT = """
+import importlib.metadata
+import sys
+
+import dojo.app
+
+sys.stderr.write("{marker}\\n")
+sys.stderr.flush()
+for distribution in importlib.metadata.distributions():
+    for entry_point in distribution.entry_points:
+        if entry_point.group.startswith("cyst."):
+            try:
+                # importlib.import_module, used by load(), bypasses the import statement, which -X importtime measures
+                __import__(entry_point.module)
+                entry_point.load()
+            except Exception as e:
+                print(f"Failed to load {{entry_point.name}}: {{e}}")
+"""
+WORKER_MARKER = "dojo: worker imports"
+
+_IMPORT_LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \| ( *)(\S+)")
+
+
+@dataclass
+class PackageImportTime:
+    package: str
+    distribution: Optional[str]
+    agent: bool
+    # Time spent in the modules of the package itself [ms]
+    self_time: float = 0
+    # Time spent importing the package, including the dependencies it imported first [ms]
+    cumulative_time: float = 0
+    modules: int = 0
+
+
+@dataclass
+class ImportReport:
+    process: str
+    total_time: float
+    budget: Optional[float]
+    over_budget: bool
+    packages: list[PackageImportTime] = field(default_factory=list)
+
+
+def _parse(output: str) -> dict[str, list[tuple[int, int, int, str]]]:
+    """
+    Splits the -X importtime output into the API and worker phases, each a list of (self [us], cumulative [us], depth,
+    module).
+    """
+    phases = {"api": [], "worker": []}
+    phase = phases["api"]
+    for line in output.splitlines():
+        if line == WORKER_MARKER:
+            phase = phases["worker"]
+            continue
+        match = _IMPORT_LINE.match(line)
+        # The header line has no numbers, so it does not match
+        if match:
+            self_us, cumulative_us, indent, module = match.groups()
+            phase.append((int(self_us), int(cumulative_us), len(indent) // 2, module))
+    return phases
+
+
+def _aggregate(process: str, imports: list[tuple[int, int, int, str]], distributions: dict[str, list[str]],
+               agents: set[str], budget: Optional[float]) -> ImportReport:
+    packages: dict[str, PackageImportTime] = {}
+    for self_us, cumulative_us, depth, module in imports:
+        package = module.split(".")[0]
+        if package not in packages:
+            distribution = next(iter(distributions.get(package, [])), None)
+            packages[package] = PackageImportTime(package, distribution, distribution in agents)
+        entry = packages[package]
+        entry.self_time += self_us / 1000
+        entry.modules += 1
+        # Only top level imports, nested ones are already included in their cumulative time
+        if depth == 0:
+            entry.cumulative_time += cumulative_us / 1000
+
+    total = sum(self_us for self_us, _, _, _ in imports) / 1000
+    return ImportReport(process, total, budget, budget is not None and total > budget,
+                        sorted(packages.values(), key=lambda p: p.self_time, reverse=True))
+
+
+def _distributions() -> dict[str, list[str]]:
+    distributions = importlib.metadata.packages_distributions()
+    # Not every distribution lists its files, but the entry points of the cyst components still tell where they live
+    for distribution in importlib.metadata.distributions():
+        for entry_point in distribution.entry_points:
+            if entry_point.group.startswith("cyst."):
+                distributions.setdefault(entry_point.module.split(".")[0], [distribution.name])
+    return distributions
+
+
+async def profile_imports(agents: set[str]) -> list[ImportReport]:
+    """
+    Measures the imports of the API process and of an environment worker in a fresh interpreter (python -X importtime)
+    and aggregates them by top level package. Packages are attributed to their distributions, distributions in agents
+    are marked as agents.
+    """
+    script = PROFILE_SCRIPT.format(marker=WORKER_MARKER)
+    process = await asyncio.create_subprocess_exec(sys.executable, "-X", "importtime", "-c", script,
+                                                   stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE)
+    _, stderr = await process.communicate()
+    output = stderr.decode(errors="replace")
+    if process.returncode != 0:
+        raise RuntimeError(f"Failed to profile the imports: {output[-2000:]}")
+    phases = _parse(output)
+
+    distributions = await asyncio.to_thread(_distributions)
+    return [
+        _aggregate("api", phases["api"], distributions, agents, settings.IMPORT_BUDGET_API),
+        _aggregate("worker", phases["worker"], distributions, agents, settings.IMPORT_BUDGET_WORKER),
+    ]
@@ -0,0 +1,97 @@
+import os
+
+from typing import Iterable, Optional
+
+from dojo.core.config import settings
+
+
+def available_cores() -> set[int]:
+    try:
+        return set(os.sched_getaffinity(0))
+    except AttributeError:
+        # Not supported outside of Linux
+        return set(range(os.cpu_count() or 1))
+
+
+def pin(pid: int, cores: Iterable[int]) -> None:
+    """
+    Sets the CPU affinity of all threads of a process. os.sched_setaffinity only affects the thread with the given id,
+    so we go through every task of the process.
+    """
+    if not hasattr(os, "sched_setaffinity"):
+        return
+
+    cores = set(cores)
+    try:
+        tasks = [int(task) for task in os.listdir(f"/proc/{pid}/task")]
+    except OSError:
+        tasks = [pid]
+    for task in tasks:
+        try:
+            os.sched_setaffinity(task, cores)
+        except OSError:
+            # The thread may have ended in the meantime
+            pass
+
+
+def apply(cores: Optional[Iterable[int]], nice: Optional[int]) -> None:
+    """
+    Applies the placement to the current process. Intended to be called by a worker before it starts any threads.
+    """
+    if cores and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, set(cores))
+    if nice is not None:
+        try:
+            os.setpriority(os.PRIO_PROCESS, 0, nice)
+        except PermissionError:
+            print(f"Insufficient permissions to set the nice level to {nice}, keeping {os.getpriority(os.PRIO_PROCESS, 0)}.")
+
+
+class CorePool:
+    """
+    Splits the cores available to dojo between the API process, cores dedicated to individual environments, and a
+    shared pool used by all other environments.
+    """
+    def __init__(self, cores: set[int], reserve_api_core: bool):
+        self._cores = set(cores)
+        self.api_cores: set[int] = set()
+        # Reserving a core only makes sense when there are some left for the environments
+        if reserve_api_core and len(self._cores) > 2:
+            self.api_cores = {min(self._cores)}
+            self._cores -= self.api_cores
+        self._dedicated: dict[str, set[int]] = {}
+
+    def shared_cores(self) -> set[int]:
+        taken = set().union(*self._dedicated.values())
+        return self._cores - taken
+
+    def allocate(self, owner: str, cores: Optional[Iterable[int]] = None, count: int = 1) -> set[int]:
+        """
+        Dedicates either the given cores, or the given number of cores from the shared pool, to the owner. At least one
+        core is always left in the shared pool.
+        """
+        shared = self.shared_cores()
+        if cores:
+            selected = set(cores)
+            if not selected <= shared:
+                raise RuntimeError(f"Cores {sorted(selected - shared)} are not available for dedication.")
+        else:
+            selected = set(sorted(shared)[:count])
+        if len(selected) < count or len(shared - selected) < 1:
+            raise RuntimeError(f"Not enough free cores to dedicate, {len(shared)} left in the shared pool.")
+
+        self._dedicated[owner] = selected
+        return selected
+
+    def release(self, owner: str) -> bool:
+        return self._dedicated.pop(owner, None) is not None
+
+    def reserve_api_cores(self) -> None:
+        """
+        Pins the calling (API) process to its reserved cores.
+        """
+        if self.api_cores and hasattr(os, "sched_setaffinity"):
+            pin(os.getpid(), self.api_cores)
+
+
+core_pool = CorePool(available_cores(), settings.RESERVE_API_CORE)
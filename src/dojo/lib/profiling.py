@@ -0,0 +1,70 @@
+"""
+Profiling of a live process from the inside, without external tools. The CPU profile samples the stacks of all threads
+and returns them as collapsed stacks (one "frame;frame;frame count" line per distinct stack, root first), which
+flamegraph.pl, speedscope and similar tools read. The memory profile lists the biggest allocations made while tracing.
+"""
+import sys
+import threading
+import time
+import tracemalloc
+
+from collections import Counter
+from enum import StrEnum, auto
+
+
+class ProfileMode(StrEnum):
+    CPU = auto()
+    MEMORY = auto()
+
+
+def _frame_name(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({code.co_filename}:{frame.f_lineno})"
+
+
+def sample_stacks(duration: float, interval: float = 0.01) -> str:
+    """
+    Samples the stacks of the other threads every interval for the duration. Returns them as collapsed stacks.
+    """
+    own = threading.get_ident()
+    stacks: Counter[str] = Counter()
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            frames = []
+            while frame is not None:
+                frames.append(_frame_name(frame))
+                frame = frame.f_back
+            frames.append(names.get(ident, str(ident)))
+            stacks[";".join(reversed(frames))] += 1
+        time.sleep(interval)
+    return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+
+def top_allocations(duration: float, top: int = 25) -> str:
+    """
+    Traces the allocations for the duration and lists the lines which allocated most of the memory still held. If
+    tracing is already on, the allocations made before are included as well.
+    """
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+        tracemalloc.start()
+    try:
+        time.sleep(duration)
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        if not tracing:
+            tracemalloc.stop()
+
+    snapshot = snapshot.filter_traces((tracemalloc.Filter(False, tracemalloc.__file__),))
+    statistics = snapshot.statistics("lineno")
+    lines = [f"Traced: {current / 1024:.1f} KiB, peak: {peak / 1024:.1f} KiB",
+             f"{'size [KiB]':>12}{'blocks':>10}  location"]
+    for stat in statistics[:top]:
+        frame = stat.traceback[0]
+        lines.append(f"{stat.size / 1024:>12.1f}{stat.count:>10}  {frame.filename}:{frame.lineno}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,205 @@
+"""
+Lightweight tracing of actions from the API request to the environment worker and back. Spans are timed with the wall
+clock, so the spans of the API process and of the workers line up. The context of the current span travels with the
+actions over the control pipe, and the workers send their spans back over the stdout pipe. The API keeps the recent
+spans in memory and can also append them to a file in the OTLP/JSON format of the OpenTelemetry file exporter. The file
+is written in batches by a background thread, so the event loop never waits for the disk.
+"""
+import contextlib
+import contextvars
+import json
+import os
+import queue
+import secrets
+import threading
+import time
+
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field, asdict
+from typing import Any, Callable, Dict, Iterator, Optional
+
+from dojo.core.config import settings
+
+
+# Trace id and span id of the current span
+_current: contextvars.ContextVar[Optional[tuple[str, str]]] = contextvars.ContextVar("trace_context", default=None)
+
+
+@dataclass
+class Span:
+    trace_id: str
+    span_id: str
+    parent_id: Optional[str]
+    name: str
+    start: int
+    end: int = 0
+    process: int = field(default_factory=os.getpid)
+    attributes: Dict[str, Any] = field(default_factory=dict)
+
+    @property
+    def duration(self) -> float:
+        """
+        Duration of the span [ms].
+        """
+        return (self.end - self.start) / 1e6
+
+
+def _otlp(span: Span) -> Dict[str, Any]:
+    otlp_span = {
+        "traceId": span.trace_id,
+        "spanId": span.span_id,
+        "name": span.name,
+        "kind": 1,
+        "startTimeUnixNano": str(span.start),
+        "endTimeUnixNano": str(span.end),
+        "attributes": [{"key": key, "value": {"stringValue": str(value)}}
+                       for key, value in {**span.attributes, "process.pid": span.process}.items()],
+    }
+    if span.parent_id:
+        otlp_span["parentSpanId"] = span.parent_id
+    return {"resourceSpans": [{
+        "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": "dojo"}}]},
+        "scopeSpans": [{"scope": {"name": "dojo"}, "spans": [otlp_span]}],
+    }]}
+
+
+class Collector:
+    """
+    Keeps the most recent spans. Workers forward their spans to the API instead (see forward). Spans for the file are
+    queued and appended by a writer thread, all the spans queued meanwhile at once.
+    """
+    def __init__(self, capacity: int, path: Optional[str] = None):
+        self._spans: deque[Span] = deque(maxlen=capacity)
+        self._path = os.path.expanduser(path) if path else None
+        self._pending: queue.Queue[Span] = queue.Queue()
+        self._writer: Optional[threading.Thread] = None
+        self._writer_lock = threading.Lock()
+        self._forward: Optional[Callable[[Span], None]] = None
+
+    def forward(self, send: Callable[[Span], None]) -> None:
+        self._forward = send
+
+    def add(self, span: Span) -> None:
+        if self._forward:
+            self._forward(span)
+            return
+        self._spans.append(span)
+        if self._path:
+            self._pending.put(span)
+            if self._writer is None:
+                self._start_writer()
+
+    def _start_writer(self) -> None:
+        with self._writer_lock:
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._write, name="trace-writer", daemon=True)
+                self._writer.start()
+
+    def _write(self) -> None:
+        while True:
+            batch = [self._pending.get()]
+            while True:
+                try:
+                    batch.append(self._pending.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                with open(self._path, "a") as f:
+                    f.write("".join(json.dumps(_otlp(span)) + "\n" for span in batch))
+            except OSError as e:
+                print(f"Failed to write {len(batch)} spans to {self._path}. Reason: {e}")
+            finally:
+                for _ in batch:
+                    self._pending.task_done()
+
+    def flush(self) -> None:
+        """
+        Waits until the spans queued so far are written to the file. Blocks, run it in a thread from the event loop.
+        """
+        self._pending.join()
+
+    def traces(self, limit: int) -> list[Dict[str, Any]]:
+        """
+        The most recent traces, newest first, each with its spans in the order they started.
+        """
+        traces: OrderedDict[str, list[Span]] = OrderedDict()
+        for span in reversed(list(self._spans)):
+            traces.setdefault(span.trace_id, []).append(span)
+
+        result = []
+        for trace_id, spans in list(traces.items())[:limit]:
+            spans.sort(key=lambda s: s.start)
+            root = next((s for s in spans if s.parent_id is None), spans[0])
+            result.append({
+                "trace_id": trace_id,
+                "name": root.name,
+                "start": root.start,
+                "duration": root.duration,
+                "spans": [{**asdict(s), "duration": s.duration} for s in spans],
+            })
+        return result
+
+
+collector = Collector(settings.TRACE_BUFFER, settings.TRACE_FILE)
+
+
+@contextlib.contextmanager
+def span(name: str, **attributes: Any) -> Iterator[Optional[Span]]:
+    """
+    Times the block as a child of the current span, or as the root of a new trace.
+    """
+    if not settings.TRACING:
+        yield None
+        return
+
+    parent = _current.get()
+    current = Span(parent[0] if parent else secrets.token_hex(16), secrets.token_hex(8), parent[1] if parent else None,
+                   name, time.time_ns(), attributes=attributes)
+    token = _current.set((current.trace_id, current.span_id))
+    try:
+        yield current
+    finally:
+        _current.reset(token)
+        current.end = time.time_ns()
+        collector.add(current)
+
+
+def outgoing() -> Optional[tuple[str, str, int]]:
+    """
+    The context to send along with a message to a worker: trace id, span id and the time of sending.
+    """
+    parent = _current.get()
+    return (parent[0], parent[1], time.time_ns()) if parent else None
+
+
+@contextlib.contextmanager
+def incoming(context: Optional[tuple[str, str, int]]) -> Iterator[None]:
+    """
+    Continues the trace of a received message. The time the message spent on the way (in the pipe and until the
+    receiver got to it) is recorded as a queue span.
+    """
+    if not context or not settings.TRACING:
+        yield
+        return
+
+    trace_id, parent_id, sent = context
+    collector.add(Span(trace_id, secrets.token_hex(8), parent_id, "queue", sent, time.time_ns()))
+    token = _current.set((trace_id, parent_id))
+    try:
+        yield
+    finally:
+        _current.reset(token)
+
+
+class TracingMiddleware:
+    """
+    Starts a trace for every HTTP request.
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not settings.TRACING:
+            return await self.app(scope, receive, send)
+        with span(f"{scope['method']} {scope['path']}"):
+            await self.app(scope, receive, send)
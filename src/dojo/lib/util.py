@@ -1,6 +1,7 @@
 import os
 import socket
 
+from dojo.core.config import settings
 from dojo.lib import constants
 from pathlib import Path
 import jsonpickle
@@ -12,30 +13,30 @@ def configuration_json_serializer(obj):
     return jsonpickle.encode(obj, make_refs=True, indent=2, keys=True)
 
 
-def import_and_serialize_configs(file_name):
+def compile_configuration(file_name) -> str:
+    """
+    Runs the Python configuration of the scenario and returns it serialized to JSON.
+    """
     python_config_path = constants.PATH_CONFIGURATIONS.joinpath(file_name, file_name + ".py")
     if not python_config_path.exists():
         raise RuntimeError(
             f"File '{file_name}' not found in configurations folder. Please check the path and try again.")
 
-    try:
-        spec = importlib.util.spec_from_file_location("module.name", python_config_path)
-        module = importlib.util.module_from_spec(spec)
-        spec.loader.exec_module(module)
+    spec = importlib.util.spec_from_file_location("module.name", python_config_path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
 
-        if hasattr(module, 'all_configs'):
-            all_configs = getattr(module, 'all_configs')
-            serialized_data = configuration_json_serializer(all_configs)
+    if not hasattr(module, 'all_configs'):
+        raise RuntimeError("The variable 'all_configs' is not found in the specified file.")
+    return configuration_json_serializer(getattr(module, 'all_configs'))
 
-            # Create JSON file with the same name as the Python file in the same folder
-            json_file_path = constants.PATH_CONFIGURATIONS.joinpath(file_name, file_name + ".json")
-            with open(json_file_path, 'w') as json_file:
-                json_file.write(serialized_data)
+def import_and_serialize_configs(file_name):
+    serialized_data = compile_configuration(file_name)
 
-        else:
-            raise RuntimeError("The variable 'all_configs' is not found in the specified file.")
-    except Exception as e:
-        raise e
+    # Create JSON file with the same name as the Python file in the same folder
+    json_file_path = constants.PATH_CONFIGURATIONS.joinpath(file_name, file_name + ".json")
+    with open(json_file_path, 'w') as json_file:
+        json_file.write(serialized_data)
 
 def ensure_json_configuration(file_name):
     path = constants.PATH_CONFIGURATIONS.joinpath(file_name, file_name + ".json")
@@ -59,13 +60,46 @@ def read_scenario_description(file_name: str) -> str:
     return ""
 
 
-last_agent_env_port: int = 8282
-async def set_first_available_env_manager_port(host='localhost') -> int:
-    global last_agent_env_port
-    while True:
-        last_agent_env_port += 1
+class PortAllocator:
+    """
+    Hands out ports from the range [first, last] and takes them back once they are no longer needed. Ports in use are
+    tracked in a bitmap, so that the lowest free port is found with a couple of integer operations. Before a port is
+    handed out, it is checked by binding to it, which never blocks, in case something else outside of dojo uses it.
+    """
+    def __init__(self, first: int, last: int, host: str = ""):
+        if last < first:
+            raise ValueError(f"Invalid port range {first}-{last}.")
+        self._first = first
+        self._host = host
+        self._full = (1 << (last - first + 1)) - 1
+        self._used = 0
+
+    def allocate(self) -> int:
+        busy = 0
+        while True:
+            taken = self._used | busy
+            if taken == self._full:
+                raise RuntimeError(f"No free port left in the range {self._first}-{self._first + self._full.bit_length() - 1}.")
+            # Isolates the lowest zero bit of the bitmap
+            bit = (~taken & (taken + 1)).bit_length() - 1
+            port = self._first + bit
+            if self._is_free(port):
+                self._used |= 1 << bit
+                return port
+            busy |= 1 << bit
+
+    def release(self, port: int) -> None:
+        bit = port - self._first
+        if 0 <= bit < self._full.bit_length():
+            self._used &= ~(1 << bit)
+
+    def _is_free(self, port: int) -> bool:
         with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            result = s.connect_ex((host, last_agent_env_port))
-            if result != 0:
-                print("Found available port: " + str(last_agent_env_port))
-                return last_agent_env_port
+            try:
+                s.bind((self._host, port))
+                return True
+            except OSError:
+                return False
+
+
+agent_port_allocator = PortAllocator(settings.AGENT_ENV_MANAGER_PORT_FIRST, settings.AGENT_ENV_MANAGER_PORT_LAST)
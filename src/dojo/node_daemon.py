@@ -0,0 +1,196 @@
+"""
+Worker daemon, which hosts environments for a controller on another host, or on the same one as a loopback node. The
+controller connects twice for every environment: the first connection carries the actions and their responses, the
+second one the output of the worker. The worker is forked with both connections and runs the same loop as a local one,
+so the daemon itself only takes part in starting and killing workers.
+
+The connections are authenticated with NODE_AUTHKEY, which has to be the same on the controller and on its nodes.
+Every connection is served by its own thread, so a slow or stalled client holds up nobody else, and a connection which
+does not authenticate and send its request in time is dropped.
+
+Example: NODE_AUTHKEY=... dojo-node --listen 0.0.0.0:9400 --capacity 16 --register http://controller:8000 --name rack-1
+"""
+import argparse
+import multiprocessing
+import os
+import socket
+import struct
+import threading
+import time
+
+from multiprocessing.connection import Listener, Connection, AuthenticationError, answer_challenge, deliver_challenge
+from typing import Any, Dict
+
+import httpx
+
+from dojo.core.config import settings
+from dojo.controller import EnvironmentWrapper
+from dojo.lib import util
+from dojo.nodes import authkey
+
+
+# How long a client gets to authenticate and send its request [s]
+REQUEST_TIMEOUT = 30
+# How long a started environment waits for its stdout connection [s]
+PENDING_TIMEOUT = 30
+
+
+def _set_receive_timeout(connection: Connection, timeout: float) -> None:
+    # The option belongs to the socket, so blocking receives on the connection fail with an OSError once it expires
+    with socket.socket(fileno=os.dup(connection.fileno())) as s:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVTIMEO, struct.pack("ll", int(timeout), int(timeout % 1 * 1e6)))
+
+
+def _run_worker(listener: Listener, inherited: list[Connection], id: str, spec: Dict[str, Any], port: int,
+                control: Connection, stdout: Connection) -> None:
+    # The daemon keeps listening, a restarted one could not bind to the address if the workers held it as well. The
+    # connections of other clients would stay open for as long as this worker lives, hiding the end of their workers.
+    listener.close()
+    for connection in inherited:
+        connection.close()
+    os.environ["CYST_AGENT_ENV_MANAGER_PORT"] = str(port)
+    EnvironmentWrapper.loop(id, spec["platform"], spec["configuration"], spec["parameters"], control, stdout,
+                            None, spec.get("nice"))
+
+
+class NodeDaemon:
+    def __init__(self, address: tuple[str, int], capacity: int):
+        # Authenticated by the thread of each connection, Listener.accept would do it in the accepting one
+        self.listener = Listener(address)
+        self.authkey = authkey()
+        self.capacity = capacity
+        self.ports = util.PortAllocator(settings.AGENT_ENV_MANAGER_PORT_FIRST, settings.AGENT_ENV_MANAGER_PORT_LAST)
+        self.context = multiprocessing.get_context("fork")
+        self.workers: Dict[str, tuple[multiprocessing.Process, int]] = {}
+        # Control connections waiting for the stdout connection of their environment, with the time they were accepted
+        self.pending: Dict[str, tuple[Connection, Dict[str, Any], int, float]] = {}
+        # Every connection the daemon holds, the workers close those that are not theirs
+        self.connections: set[Connection] = set()
+        self.lock = threading.Lock()
+
+    def drop(self, connection: Connection) -> None:
+        self.connections.discard(connection)
+        connection.close()
+
+    def reap(self) -> None:
+        """
+        Releases the ports of exited workers and drops the environments whose stdout connection never came.
+        """
+        for id, (process, port) in list(self.workers.items()):
+            if not process.is_alive():
+                process.join()
+                self.ports.release(port)
+                del self.workers[id]
+        for id, (control, _, port, accepted) in list(self.pending.items()):
+            if time.monotonic() - accepted > PENDING_TIMEOUT:
+                self.drop(control)
+                self.ports.release(port)
+                del self.pending[id]
+
+    def serve(self) -> None:
+        while True:
+            try:
+                connection = self.listener.accept()
+            except OSError as e:
+                print(f"Failed to accept a connection: {e}")
+                continue
+            self.connections.add(connection)
+            threading.Thread(target=self.serve_connection, args=(connection,), daemon=True).start()
+
+    def serve_connection(self, connection: Connection) -> None:
+        try:
+            _set_receive_timeout(connection, REQUEST_TIMEOUT)
+            deliver_challenge(connection, self.authkey)
+            answer_challenge(connection, self.authkey)
+            request = connection.recv()
+            # Workers block on their connections for as long as the controller is idle
+            _set_receive_timeout(connection, 0)
+        except (AuthenticationError, OSError, EOFError) as e:
+            print(f"Rejected a connection: {e}")
+            self.drop(connection)
+            return
+
+        try:
+            with self.lock:
+                self.reap()
+                self.handle(connection, request)
+        except (OSError, EOFError) as e:
+            print(f"Failed to handle a request: {e}")
+            self.drop(connection)
+
+    def handle(self, connection: Connection, request: tuple) -> None:
+        match request[0]:
+            case "control":
+                _, id, spec = request
+                if id in self.workers or id in self.pending:
+                    connection.send(("error", f"Environment with id {id} already exists on the node."))
+                elif len(self.workers) + len(self.pending) >= self.capacity:
+                    connection.send(("error", f"The node is full, it hosts {self.capacity} environments."))
+                else:
+                    try:
+                        port = self.ports.allocate()
+                    except RuntimeError as e:
+                        connection.send(("error", str(e)))
+                    else:
+                        self.pending[id] = (connection, spec, port, time.monotonic())
+                        connection.send(("ok", port))
+                        return
+                self.drop(connection)
+            case "stdout":
+                _, id = request
+                if id not in self.pending:
+                    self.drop(connection)
+                    return
+                control, spec, port, _ = self.pending.pop(id)
+                inherited = [c for c in list(self.connections) if c is not control and c is not connection]
+                process = self.context.Process(target=_run_worker, args=(self.listener, inherited, id, spec, port,
+                                                                         control, connection))
+                process.start()
+                # The worker has its own copies
+                self.drop(control)
+                self.drop(connection)
+                self.workers[id] = (process, port)
+            case "kill":
+                _, id = request
+                if id in self.workers:
+                    self.workers[id][0].kill()
+                self.drop(connection)
+            case "status":
+                connection.send({"capacity": self.capacity, "environments": list(self.workers)})
+                self.drop(connection)
+            case _:
+                self.drop(connection)
+
+
+def register(controller: str, name: str, host: str, port: int, capacity: int) -> None:
+    response = httpx.post(f"{controller}{settings.API_V1_STR}/nodes/register/",
+                          json={"name": name, "host": host, "port": port, "capacity": capacity}, timeout=30)
+    if response.is_error:
+        print(f"Failed to register with the controller: {response.text}")
+    else:
+        print(f"Registered with the controller {controller} as {name}.")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(prog="dojo-node", description="Host environments for a remote controller.")
+    parser.add_argument("--listen", default="0.0.0.0:9400", help="Address to listen on, host:port.")
+    parser.add_argument("--capacity", type=int, default=os.cpu_count() or 1, help="Maximum number of environments.")
+    parser.add_argument("--register", default=None, help="URL of the controller to register with.")
+    parser.add_argument("--name", default=socket.gethostname(), help="Name of the node at the controller.")
+    parser.add_argument("--advertise", default=None, help="Host the controller reaches the node at, if not the listening one.")
+    args = parser.parse_args()
+
+    host, _, port = args.listen.rpartition(":")
+    daemon = NodeDaemon((host, int(port)), args.capacity)
+    print(f"Listening on {args.listen}, capacity {args.capacity}.")
+
+    if args.register:
+        advertised = args.advertise or (socket.gethostname() if host in ("", "0.0.0.0") else host)
+        # The controller checks the node while registering it, so the daemon has to be serving by then
+        threading.Thread(target=register, args=(args.register, args.name, advertised, int(port), args.capacity),
+                         daemon=True).start()
+    daemon.serve()
+
+
+if __name__ == "__main__":
+    main()
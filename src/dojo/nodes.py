@@ -0,0 +1,119 @@
+import contextlib
+import os
+import socket
+import time
+
+from dataclasses import dataclass
+from multiprocessing.connection import Client, Connection
+from typing import Any, Dict, Optional
+
+from dojo.core.config import settings
+
+
+# Name of this host when choosing where to create an environment
+LOCAL_NODE = "local"
+
+
+@dataclass
+class Node:
+    """
+    A host running the worker daemon (dojo.node), which hosts environments for the controller.
+    """
+    name: str
+    host: str
+    port: int
+    capacity: int
+
+    @property
+    def address(self) -> tuple[str, int]:
+        return self.host, self.port
+
+
+def authkey() -> bytes:
+    if not settings.NODE_AUTHKEY:
+        raise RuntimeError("NODE_AUTHKEY is not set, it is required to talk to worker nodes.")
+    return settings.NODE_AUTHKEY.encode()
+
+
+def connect(node: Node) -> Connection:
+    """
+    An authenticated connection to the daemon of the node. Messages are pickled, so the key must be kept secret.
+    """
+    return Client(node.address, authkey=authkey())
+
+
+def status(node: Node) -> Dict[str, Any]:
+    with contextlib.closing(connect(node)) as connection:
+        connection.send(("status",))
+        return connection.recv()
+
+
+class RemoteProcess:
+    """
+    A worker hosted by a node. The controller exchanges the same messages with it as with a local worker, over two TCP
+    connections instead of the control and stdout pipes. The connections are made by start, which blocks.
+    """
+    pid = None
+
+    def __init__(self, node: Node, id: str, spec: Dict[str, Any]):
+        self.node = node
+        self.id = id
+        self._spec = spec
+        self.control: Optional[Connection] = None
+        self.stdout: Optional[Connection] = None
+
+    def start(self) -> int:
+        """
+        Asks the node to start the worker. Returns the agent manager port the node gave it.
+        """
+        self.control = connect(self.node)
+        try:
+            self.control.send(("control", self.id, self._spec))
+            result, value = self.control.recv()
+            if result != "ok":
+                raise RuntimeError(value)
+            self.stdout = connect(self.node)
+            self.stdout.send(("stdout", self.id))
+        except BaseException:
+            for conn in (self.control, self.stdout):
+                if conn is not None:
+                    conn.close()
+            raise
+        return value
+
+    def is_alive(self) -> bool:
+        if self.stdout is None or self.stdout.closed:
+            return False
+        # The worker only writes to the stdout connection, peeking at it tells whether the other end is gone
+        try:
+            with socket.socket(fileno=os.dup(self.stdout.fileno())) as s:
+                return s.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT) != b""
+        except BlockingIOError:
+            return True
+        except OSError:
+            return False
+
+    def join(self, timeout: Optional[float] = None) -> None:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.is_alive() and (deadline is None or time.monotonic() < deadline):
+            time.sleep(0.05)
+
+    def kill(self) -> None:
+        with contextlib.suppress(OSError), contextlib.closing(connect(self.node)) as connection:
+            connection.send(("kill", self.id))
+
+
+class NodeRegistry(dict[str, Node]):
+    """
+    Worker nodes by their name.
+    """
+    def select(self, used: Dict[str, int]) -> Optional[Node]:
+        """
+        The node with the most free capacity, given the number of environments on each node, or None if all are full.
+        """
+        free = [(node.capacity - used.get(node.name, 0), node) for node in self.values()]
+        free = [(slots, node) for slots, node in free if slots > 0]
+        return max(free, key=lambda f: f[0])[1] if free else None
+
+
+nodes = NodeRegistry()
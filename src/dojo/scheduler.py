@@ -0,0 +1,180 @@
+import asyncio
+import bisect
+import itertools
+import math
+import os
+import time
+
+from dataclasses import dataclass, field
+from typing import Optional, Dict
+
+from dojo.core.config import settings
+from dojo.lib.placement import available_cores, core_pool
+
+
+class ResourcesUnavailable(RuntimeError):
+    """
+    The resources cannot be granted without waiting.
+    """
+
+
+@dataclass
+class QueuedRequest:
+    owner: str
+    position: int
+    priority: int
+    demand: Dict[str, float]
+    waiting: float
+    estimated_wait: Optional[float]
+
+
+@dataclass
+class SchedulerStatus:
+    budgets: Dict[str, Optional[float]]
+    in_use: Dict[str, float]
+    queue: list[QueuedRequest]
+
+
+@dataclass(order=True)
+class _Ticket:
+    sort_key: tuple[int, int]
+    owner: str = field(compare=False)
+    demand: Dict[str, float] = field(compare=False)
+    priority: int = field(compare=False)
+    enqueued: float = field(compare=False)
+    future: asyncio.Future = field(compare=False)
+
+
+class ResourceScheduler:
+    """
+    Admits requests for resources (environment slots, CPUs, memory) within the given budgets. Requests that do not fit
+    wait in a queue ordered by priority and then by arrival, and are granted in that order as resources get released.
+    A request is never overtaken by a later one that needs any of the same resources, so that large requests cannot be
+    starved by small ones.
+
+    Resources are held by an owner until they are released. Budgets set to math.inf are not limited.
+    """
+    def __init__(self, budgets: Dict[str, float]):
+        self._budgets = budgets
+        self._in_use: Dict[str, float] = {resource: 0 for resource in budgets}
+        self._held: Dict[str, tuple[Dict[str, float], float]] = {}
+        self._queue: list[_Ticket] = []
+        self._queued: set[str] = set()
+        self._counter = itertools.count()
+        self._average_hold: Optional[float] = None
+
+    def _fits(self, demand: Dict[str, float]) -> bool:
+        return all(self._in_use[r] + amount <= self._budgets[r] for r, amount in demand.items() if r in self._budgets)
+
+    def _grant(self, owner: str, demand: Dict[str, float]) -> None:
+        for r, amount in demand.items():
+            if r in self._budgets:
+                self._in_use[r] += amount
+        self._held[owner] = (demand, time.monotonic())
+
+    def _contended(self, demand: Dict[str, float]) -> bool:
+        """
+        Whether a queued request waits for any of the resources, so the demand would overtake it if granted now.
+        """
+        resources = {r for r, amount in demand.items() if r in self._budgets and amount > 0}
+        return any(resources & {r for r, amount in ticket.demand.items() if amount > 0} for ticket in self._queue)
+
+    async def acquire(self, owner: str, demand: Dict[str, float], priority: int = 0, wait: bool = True) -> bool:
+        """
+        Waits until the demand fits into the budgets and grants it to the owner. Returns False without waiting if the
+        owner already holds or waits for resources. Without waiting, ResourcesUnavailable is raised if the demand cannot
+        be granted right away.
+        """
+        if owner in self._held or owner in self._queued:
+            return False
+
+        for r, amount in demand.items():
+            if r in self._budgets and amount > self._budgets[r]:
+                raise RuntimeError(f"The request for {amount} {r} exceeds the total budget of {self._budgets[r]}.")
+
+        if not wait:
+            if self._contended(demand) or not self._fits(demand):
+                raise ResourcesUnavailable(f"The request for {demand} cannot be granted now, the budgets are used up or "
+                                           f"other requests wait for them.")
+            self._grant(owner, demand)
+            return True
+
+        ticket = _Ticket((-priority, next(self._counter)), owner, demand, priority, time.monotonic(),
+                         asyncio.get_running_loop().create_future())
+        bisect.insort(self._queue, ticket)
+        self._queued.add(owner)
+        self._dispatch()
+        try:
+            await ticket.future
+            return True
+        except asyncio.CancelledError:
+            if ticket.future.done() and not ticket.future.cancelled():
+                # Granted in the meantime, give it back
+                self.release(owner)
+            else:
+                self._queue.remove(ticket)
+                self._queued.discard(owner)
+                self._dispatch()
+            raise
+
+    def release(self, owner: str) -> None:
+        held = self._held.pop(owner, None)
+        if not held:
+            return
+
+        demand, granted = held
+        for r, amount in demand.items():
+            if r in self._budgets:
+                self._in_use[r] -= amount
+
+        duration = time.monotonic() - granted
+        self._average_hold = duration if self._average_hold is None else 0.8 * self._average_hold + 0.2 * duration
+        self._dispatch()
+
+    def _dispatch(self) -> None:
+        blocked: set[str] = set()
+        waiting = []
+        for ticket in self._queue:
+            resources = {r for r, amount in ticket.demand.items() if r in self._budgets and amount > 0}
+            if not resources & blocked and self._fits(ticket.demand):
+                self._queued.discard(ticket.owner)
+                self._grant(ticket.owner, ticket.demand)
+                ticket.future.set_result(None)
+            else:
+                blocked |= resources
+                waiting.append(ticket)
+        self._queue = waiting
+
+    def status(self) -> SchedulerStatus:
+        now = time.monotonic()
+        queue = []
+        for position, ticket in enumerate(self._queue):
+            estimated_wait = None
+            if self._average_hold is not None:
+                # A crude estimate: everyone ahead has to wait for the current holders to cycle through
+                estimated_wait = self._average_hold * math.ceil((position + 1) / max(1, len(self._held)))
+            queue.append(QueuedRequest(ticket.owner, position, ticket.priority, ticket.demand, now - ticket.enqueued, estimated_wait))
+        budgets = {r: None if math.isinf(budget) else budget for r, budget in self._budgets.items()}
+        return SchedulerStatus(budgets, dict(self._in_use), queue)
+
+
+def _default_memory_budget() -> float:
+    try:
+        total = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") // (1024 * 1024)
+    except (ValueError, OSError):
+        return math.inf
+    return int(total * 0.8)
+
+
+def _default_cpu_budget() -> float:
+    if not settings.SCHEDULER_CPU_BUDGET:
+        return math.inf
+    # The cores reserved for the API process are not available to the environments
+    return max(min(settings.SCHEDULER_CPU_BUDGET, len(available_cores() - core_pool.api_cores)), 1)
+
+
+scheduler = ResourceScheduler({
+    "environments": settings.SCHEDULER_MAX_ENVIRONMENTS or math.inf,
+    "cpu": _default_cpu_budget(),
+    "memory": settings.SCHEDULER_MEMORY_BUDGET or _default_memory_budget(),
+})
@@ -4,6 +4,10 @@ from pydantic import BaseModel, Field
 from typing import Optional
 
 
+# Agent set names become directory names in the agent store
+AGENT_SET_NAME_PATTERN = r"^[A-Za-z0-9][A-Za-z0-9._-]*$"
+
+
 class AgentMethod(Enum):
     GIT = "git"
     PYPI = "pypi"
@@ -15,6 +19,15 @@ class AgentAddition(BaseModel):
     access_token: Optional[str] = Field(default="")
 
 
+class AgentSetCreation(BaseModel):
+    name: str = Field(pattern=AGENT_SET_NAME_PATTERN)
+    agents: list[AgentAddition]
+
+
+class AgentSetRemoval(BaseModel):
+    name: str = Field(pattern=AGENT_SET_NAME_PATTERN)
+
+
 class AgentRemoval(BaseModel):
     name: str
     delete_code: Optional[bool] = Field(default=False)
@@ -1,7 +1,11 @@
+from enum import Enum
+
 from pydantic import BaseModel, constr, Field
 from typing import Optional, Any, Dict
 from cyst.api.environment.platform_specification import PlatformSpecification, PlatformType
 
+from dojo.schemas.agents import AGENT_SET_NAME_PATTERN
+
 
 # @pydantic.dataclasses.dataclass(frozen=True)
 # class Platform(PlatformSpecification):
@@ -11,12 +15,55 @@ class Parametrization(BaseModel):
     """ """
     parameters: dict[str, Any]
 
+class EnvironmentResources(BaseModel):
+    """ """
+    cpu: float = Field(default=1.0, ge=0, description="CPUs reserved while the environment is running.")
+    memory: int = Field(default=256, ge=0, description="Memory in MB reserved for the lifetime of the environment.")
+    memory_soft_limit: Optional[int] = Field(default=None, gt=0, description="Worker memory in MB at which a running environment is paused.")
+    memory_hard_limit: Optional[int] = Field(default=None, gt=0, description="Worker memory in MB at which the environment is terminated.")
+
+
+class PlacementPolicy(Enum):
+    SHARED = "shared"
+    DEDICATED = "dedicated"
+
+
+class Placement(BaseModel):
+    """ """
+    policy: PlacementPolicy = Field(default=PlacementPolicy.SHARED, description="Run on the shared pool of cores, or on cores dedicated to the environment.")
+    cores: Optional[list[int]] = Field(default=None, description="Cores to pin the environment to, or to dedicate to it.")
+    dedicated_cores: int = Field(default=1, ge=1, description="Number of cores to dedicate, when no cores are given.")
+    nice: Optional[int] = Field(default=None, ge=-20, le=19)
+
+
 class Environment(BaseModel):
     """ """
     id: Optional[str] = None
     platform: PlatformSpecification = Field(default=PlatformSpecification(PlatformType.SIMULATED_TIME, "CYST"))
     configuration: str = Field(default="configuration_1")
     parameters: Dict[str, Any] = Field(default={})
+    resources: EnvironmentResources = Field(default=EnvironmentResources())
+    priority: int = Field(default=0, description="Environments with a higher priority are admitted first.")
+    placement: Placement = Field(default=Placement())
+    agent_set: Optional[str] = Field(default=None, pattern=AGENT_SET_NAME_PATTERN,
+                                     description="Agent set to take the agents from, before the installed ones.")
+    node: Optional[str] = Field(default=None, description="Node to host the environment, 'local' for this host. By default, the registered node with the most free capacity, or this host if there is none or the environment has cores or an agent set. Environments on nodes are admitted by the capacity of the node, not by the scheduler of this host.")
+
+
+class EnvironmentBatch(BaseModel):
+    """ """
+    environments: list[Environment] = Field(default=[])
+    template: Optional[Environment] = None
+    count: int = Field(default=0, ge=0)
+    init: bool = Field(default=True)
+    run: bool = Field(default=True)
+    concurrency: int = Field(default=16, ge=1)
+
+
+class EnvironmentIds(BaseModel):
+    """ """
+    ids: list[str]
+    concurrency: int = Field(default=16, ge=1)
 
 
 class EnvironmentOut(BaseModel):
@@ -26,3 +73,19 @@ class EnvironmentOut(BaseModel):
     provider: str
     state: str
     agent_manager_port: int
+    configuration: Optional[str] = None
+    agent_set: Optional[str] = None
+    node: Optional[str] = None
+
+
+class EnvironmentPage(BaseModel):
+    """ """
+    items: list[dict[str, Any]]
+    total: int
+    next_cursor: Optional[str] = None
+
+
+class EnvironmentWaitOut(BaseModel):
+    """ """
+    reached: bool
+    states: dict[str, str]
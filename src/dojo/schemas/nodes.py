@@ -0,0 +1,17 @@
+from pydantic import BaseModel, Field
+
+
+class NodeRegistration(BaseModel):
+    name: str = Field(pattern=r"^[A-Za-z0-9][A-Za-z0-9._-]*$")
+    host: str
+    port: int = Field(ge=1, le=65535)
+    capacity: int = Field(ge=1, description="Maximum number of environments hosted by the node.")
+
+
+class NodeOut(BaseModel):
+    name: str
+    host: str
+    port: int
+    capacity: int
+    environments: int
+    free: int
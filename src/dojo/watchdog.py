@@ -0,0 +1,178 @@
+import asyncio
+
+from collections import OrderedDict
+from typing import Optional
+
+from dojo.api.endpoints.socket_manager import socket_manager
+from dojo.controller import environments, EnvironmentWrapper, EnvironmentAction, ActionResponse, EnvironmentState
+from dojo.core.config import settings
+
+
+# Reasons are kept for this many terminated environments
+REASONS = 1000
+# How long an evicted environment gets to terminate on its own
+EVICTION_TIMEOUT = 10
+
+
+def uss(pid: int) -> Optional[float]:
+    """
+    Unique set size of a process [MB], the memory freed when it exits. Unlike the resident set size, it leaves out the
+    pages still shared copy-on-write with the process the worker was forked from (e.g. a baseline).
+    """
+    try:
+        private = 0
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            for line in f:
+                if line.startswith(("Private_Clean:", "Private_Dirty:")):
+                    private += int(line.split()[1])
+        return private / 1024
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def host_memory() -> Optional[tuple[float, float]]:
+    """
+    Total host memory and the memory available without swapping [MB].
+    """
+    try:
+        with open("/proc/meminfo") as f:
+            info = {line.split(":")[0]: int(line.split()[1]) for line in f}
+        return info["MemTotal"] / 1024, info["MemAvailable"] / 1024
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+class MemoryWatchdog:
+    """
+    Samples the memory of every worker, so that a runaway environment is stopped before the OOM killer takes out an
+    arbitrary process (possibly the API). A running environment over its soft limit is paused, an environment over its
+    hard limit is killed. Environments only have limits if they were given, or if the limit factors are set. While the
+    host runs low on memory and the workers use a significant share of it, idle environments are evicted, those with
+    the lowest priority and least recently used first, a bounded number while the memory stays low. The reasons of the
+    terminations are kept for later requests.
+    """
+    def __init__(self, interval: float, soft_factor: Optional[float], hard_factor: Optional[float], min_available: float,
+                 worker_share: float, max_evictions: int):
+        self.interval = interval
+        self.soft_factor = soft_factor
+        self.hard_factor = hard_factor
+        self.min_available = min_available
+        self.worker_share = worker_share
+        self.max_evictions = max_evictions
+        self._over_soft_limit: set[str] = set()
+        # Environments the watchdog paused, they are kept for inspection rather than evicted
+        self._paused: set[str] = set()
+        # Evictions since the host ran low on memory
+        self._evictions = 0
+        self._reasons: OrderedDict[str, ActionResponse] = OrderedDict()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        if self.interval:
+            self._task = asyncio.create_task(self._watch())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def reason(self, id: str) -> Optional[ActionResponse]:
+        """
+        Why the watchdog terminated the environment, if it did.
+        """
+        return self._reasons.get(id)
+
+    def limits(self, wrapper: EnvironmentWrapper) -> tuple[Optional[float], Optional[float]]:
+        soft = wrapper.memory_soft_limit or (wrapper.memory * self.soft_factor if wrapper.memory and self.soft_factor else None)
+        hard = wrapper.memory_hard_limit or (wrapper.memory * self.hard_factor if wrapper.memory and self.hard_factor else None)
+        return soft, hard
+
+    async def _watch(self) -> None:
+        while True:
+            try:
+                await self.check()
+            except Exception as e:
+                print(f"Memory watchdog check failed: {e}")
+            await asyncio.sleep(self.interval)
+
+    async def check(self) -> None:
+        workers = 0.0
+        for wrapper in list(environments.values()):
+            if wrapper.state == EnvironmentState.RUNNING.name:
+                self._paused.discard(wrapper.id)
+            used = uss(wrapper.pid) if wrapper.pid else None
+            if used is None:
+                continue
+            workers += used
+            soft, hard = self.limits(wrapper)
+            if hard and used > hard:
+                self._record(wrapper, f"The environment was terminated, its worker used {used:.0f} MB of memory, over "
+                                      f"the hard limit of {hard:.0f} MB.")
+                wrapper.kill()
+            elif soft and used > soft:
+                if wrapper.id not in self._over_soft_limit:
+                    self._over_soft_limit.add(wrapper.id)
+                    await self._soft_limit_reached(wrapper, used, soft)
+            else:
+                self._over_soft_limit.discard(wrapper.id)
+
+        self._over_soft_limit &= set(environments)
+        self._paused &= set(environments)
+        memory = host_memory()
+        if memory is None:
+            return
+        total, available = memory
+        if available >= total * self.min_available:
+            self._evictions = 0
+        # Evicting workers does not help if something else uses up the memory
+        elif self._evictions < self.max_evictions and workers >= (total - available) * self.worker_share:
+            self._evictions += 1
+            await self._evict_idle(available / total)
+
+    async def _soft_limit_reached(self, wrapper: EnvironmentWrapper, used: float, soft: float) -> None:
+        message = f"The worker uses {used:.0f} MB of memory, over the soft limit of {soft:.0f} MB."
+        if wrapper.state == EnvironmentState.RUNNING.name:
+            try:
+                paused = (await wrapper.perform_action(EnvironmentAction.PAUSE)).success
+            except Exception:
+                paused = False
+            if paused:
+                self._paused.add(wrapper.id)
+                message += " The environment was paused."
+            else:
+                message += " Failed to pause the environment."
+        print(f"{wrapper.id}: {message}")
+        if wrapper.id in socket_manager.active_connections:
+            await socket_manager.send_personal_message(message, wrapper.id)
+
+    async def _evict_idle(self, available: float) -> None:
+        """
+        Evicts one idle environment, the next check evicts another if it was not enough.
+        """
+        # Environments on other nodes do not use the memory of this host, those over their soft limit are dealt with
+        idle = [wrapper for wrapper in environments.values()
+                if wrapper.state != EnvironmentState.RUNNING.name and wrapper.node is None
+                and wrapper.id not in self._over_soft_limit and wrapper.id not in self._paused]
+        if not idle:
+            return
+        wrapper = min(idle, key=lambda w: (w.priority, w.last_active))
+        self._record(wrapper, f"The environment was evicted, it was idle while only {available:.0%} of the host "
+                              f"memory was available.")
+        try:
+            await asyncio.wait_for(wrapper.perform_action(EnvironmentAction.TERMINATE), EVICTION_TIMEOUT)
+        except Exception:
+            wrapper.kill()
+        if environments.get(wrapper.id) is wrapper:
+            del environments[wrapper.id]
+
+    def _record(self, wrapper: EnvironmentWrapper, message: str) -> None:
+        print(f"{wrapper.id}: {message}")
+        self._reasons[wrapper.id] = ActionResponse(wrapper.id, EnvironmentState.TERMINATED.name, False, message)
+        while len(self._reasons) > REASONS:
+            self._reasons.popitem(last=False)
+
+
+watchdog = MemoryWatchdog(settings.WATCHDOG_INTERVAL, settings.WATCHDOG_SOFT_LIMIT_FACTOR,
+                          settings.WATCHDOG_HARD_LIMIT_FACTOR, settings.WATCHDOG_MIN_AVAILABLE,
+                          settings.WATCHDOG_EVICTION_SHARE, settings.WATCHDOG_MAX_EVICTIONS)
@@ -0,0 +1,269 @@
+"""
+Benchmark suite of the controller. It runs offline against the app in this process (no server), with real environment
+workers, and covers the environment lifecycle, the round trip of an action, listing environments against their count,
+the stdout forwarding of the workers, scenario compilation and memory per environment. The results are saved as JSON,
+and a previous result can be given to compare with, e.g., the one of the last release.
+
+Run from the repository root (for the .env file):
+PYTHONPATH=src python -m testing.benchmark_suite [--scenario NAME] [--repetitions N] [--counts N ...]
+                                                 [--output FILE] [--compare FILE]
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+from typing import Any, Callable, Dict, Optional
+
+import httpx
+
+from dojo.app import app
+from dojo.controller import environments, pipe_redirector, EnvironmentAction, EnvironmentState
+from dojo.lib import util
+
+
+API = "/api/v1/environment"
+
+
+def summary(durations: list[float]) -> Dict[str, float]:
+    """
+    Statistics of durations in seconds, in milliseconds.
+    """
+    durations = sorted(d * 1000 for d in durations)
+    return {
+        "mean": statistics.mean(durations),
+        "p50": durations[len(durations) // 2],
+        "p95": durations[min(len(durations) - 1, int(len(durations) * 0.95))],
+        "min": durations[0],
+        "max": durations[-1],
+        "n": len(durations),
+    }
+
+
+async def timed(call: Callable) -> tuple[float, Any]:
+    start = time.perf_counter()
+    result = await call()
+    return time.perf_counter() - start, result
+
+
+def checked(response: httpx.Response) -> Dict[str, Any]:
+    if response.is_error:
+        raise RuntimeError(f"{response.request.method} {response.request.url.path} failed: {response.text}")
+    return response.json()
+
+
+async def lifecycle(client: httpx.AsyncClient, scenario: str, repetitions: int) -> Dict[str, Any]:
+    steps = {step: [] for step in ("create", "init", "run", "terminate")}
+    for _ in range(repetitions):
+        duration, created = await timed(lambda: client.post(f"{API}/create/", json={"configuration": scenario}))
+        id = checked(created)["id"]
+        steps["create"].append(duration)
+
+        duration, response = await timed(lambda: client.post(f"{API}/init/", params={"id": id}))
+        checked(response)
+        steps["init"].append(duration)
+
+        # Until the end of the run, not just its start
+        start = time.perf_counter()
+        checked(await client.post(f"{API}/run/", params={"id": id}))
+        await environments[id].wait_for_state({EnvironmentState.FINISHED.name})
+        steps["run"].append(time.perf_counter() - start)
+
+        duration, response = await timed(lambda: client.post(f"{API}/terminate/", params={"id": id}))
+        checked(response)
+        steps["terminate"].append(duration)
+
+    return {step: summary(durations) for step, durations in steps.items()}
+
+
+async def round_trip(client: httpx.AsyncClient, scenario: str, repetitions: int) -> Dict[str, Any]:
+    id = checked(await client.post(f"{API}/create/", json={"configuration": scenario}))["id"]
+    wrapper = environments[id]
+    try:
+        # The pipe exchange with the worker alone, and with the HTTP layer on top
+        direct = [(await timed(lambda: wrapper.perform_action(EnvironmentAction.GET_STATE)))[0] for _ in range(repetitions)]
+        http = []
+        for _ in range(repetitions):
+            duration, response = await timed(lambda: client.get(f"{API}/get/", params={"id": id}))
+            checked(response)
+            http.append(duration)
+    finally:
+        await client.post(f"{API}/terminate/", params={"id": id})
+    return {"perform_action": summary(direct), "http": summary(http)}
+
+
+def pss(pid: int) -> Optional[int]:
+    """
+    Proportional set size of a process [kB], which splits the pages shared with other processes among them.
+    """
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            for line in f:
+                if line.startswith("Pss:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+async def scaling(client: httpx.AsyncClient, scenario: str, counts: list[int], repetitions: int) -> Dict[str, Any]:
+    """
+    Listing latency and memory per environment for increasing numbers of environments.
+    """
+    results = {}
+    ids = []
+    try:
+        for count in sorted(counts):
+            while len(ids) < count:
+                ids.append(checked(await client.post(f"{API}/create/", json={"configuration": scenario}))["id"])
+
+            durations = []
+            for _ in range(repetitions):
+                duration, response = await timed(lambda: client.get(f"{API}/list/"))
+                checked(response)
+                durations.append(duration)
+
+            sizes = [pss(environments[id]._process.pid) for id in ids]
+            sizes = [size for size in sizes if size is not None]
+            results[str(count)] = {
+                "list": summary(durations),
+                "pss_per_environment_kb": statistics.mean(sizes) if sizes else None,
+            }
+    finally:
+        for id in ids:
+            await client.post(f"{API}/terminate/", params={"id": id})
+    return results
+
+
+def _write_lines(pipe, lines: int, line: str) -> None:
+    with pipe_redirector(pipe):
+        for _ in range(lines):
+            print(line)
+    pipe.close()
+
+
+def stdout_throughput(lines: int, length: int = 120) -> Dict[str, Any]:
+    """
+    Output of a worker process through the stdout redirection, as read by the listener of the controller.
+    """
+    receiver, sender = multiprocessing.Pipe()
+    process = multiprocessing.get_context("fork").Process(target=_write_lines, args=(sender, lines, "x" * length))
+    # The worker's own stdout would only slow it down here
+    with open(os.devnull, "w") as devnull:
+        stdout, sys.stdout = sys.stdout, devnull
+        try:
+            start = time.perf_counter()
+            process.start()
+        finally:
+            sys.stdout = stdout
+    sender.close()
+
+    received = 0
+    while True:
+        try:
+            receiver.recv()
+            received += 1
+        except EOFError:
+            break
+    elapsed = time.perf_counter() - start
+    process.join()
+    return {"lines": received, "seconds": elapsed, "lines_per_second": received / elapsed,
+            "mb_per_second": received * length / elapsed / 1e6}
+
+
+def compile_time(scenarios: list[str], repetitions: int) -> Dict[str, Any]:
+    results = {}
+    for scenario in scenarios:
+        durations = []
+        size = 0
+        for _ in range(repetitions):
+            start = time.perf_counter()
+            try:
+                size = len(util.compile_configuration(scenario))
+            except Exception as e:
+                results[scenario] = {"error": str(e)}
+                break
+            durations.append(time.perf_counter() - start)
+        else:
+            results[scenario] = {**summary(durations), "size_kb": size / 1024}
+    return results
+
+
+def revision() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(current: Dict[str, Any], previous: Dict[str, Any], path: str = "") -> None:
+    """
+    Prints the relative change of every number present in both results.
+    """
+    for key, value in current.items():
+        other = previous.get(key) if isinstance(previous, dict) else None
+        name = f"{path}.{key}" if path else key
+        if isinstance(value, dict):
+            compare(value, other or {}, name)
+        elif isinstance(value, (int, float)) and isinstance(other, (int, float)) and other and key != "n":
+            print(f"{name:<60}{other:>12.2f}{value:>12.2f}{(value - other) / other * 100:>+9.1f} %")
+
+
+async def run(args: argparse.Namespace) -> Dict[str, Any]:
+    results: Dict[str, Any] = {}
+    transport = httpx.ASGITransport(app=app)
+    async with app.router.lifespan_context(app), httpx.AsyncClient(transport=transport, base_url="http://dojo", timeout=None) as client:
+        print("lifecycle...", file=sys.stderr)
+        results["lifecycle"] = await lifecycle(client, args.scenario, args.repetitions)
+        print("round trip...", file=sys.stderr)
+        results["round_trip"] = await round_trip(client, args.scenario, args.repetitions * 10)
+        print("scaling...", file=sys.stderr)
+        results["scaling"] = await scaling(client, args.scenario, args.counts, args.repetitions)
+    print("stdout forwarding...", file=sys.stderr)
+    results["stdout"] = stdout_throughput(args.lines)
+    print("scenario compilation...", file=sys.stderr)
+    scenarios = [scenario for scenario in util.list_scenario_files() if not scenario.startswith("__")]
+    results["compile"] = compile_time(sorted(scenarios), args.repetitions)
+    return results
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the controller against the app in this process.")
+    parser.add_argument("--scenario", default="configuration_1", help="Scenario of the environments.")
+    parser.add_argument("--repetitions", type=int, default=5, help="Number of repetitions of each measurement.")
+    parser.add_argument("--counts", type=int, nargs="+", default=[1, 4, 16], help="Numbers of environments to list.")
+    parser.add_argument("--lines", type=int, default=100_000, help="Number of lines for the stdout forwarding.")
+    parser.add_argument("--output", default=None, help="File to save the results to, benchmark-<revision>.json by default.")
+    parser.add_argument("--compare", default=None, help="Results of a previous run to compare with.")
+    args = parser.parse_args()
+
+    report = {
+        "revision": revision(),
+        "timestamp": time.time(),
+        "python": platform.python_version(),
+        "machine": {"platform": platform.platform(), "cpus": len(os.sched_getaffinity(0))},
+        "parameters": {"scenario": args.scenario, "repetitions": args.repetitions, "counts": args.counts},
+        "results": asyncio.run(run(args)),
+    }
+
+    output = args.output or f"benchmark-{report['revision'] or int(report['timestamp'])}.json"
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results saved to {output}", file=sys.stderr)
+
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+        print(f"{'metric':<60}{previous.get('revision') or 'previous':>12}{report['revision'] or 'current':>12}{'change':>11}")
+        compare(report["results"], previous["results"])
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
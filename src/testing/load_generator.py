@@ -0,0 +1,252 @@
+"""
+Load generator for a running Dojo API. Virtual users are started gradually over the ramp-up and each of them keeps
+performing operations picked from a weighted mix (create, run, list, get, terminate environments, fetch scenarios),
+while websocket subscribers follow the environment events. All users share one pooled HTTP client. The report has the
+latency percentiles and error rate of every operation, and a per-second timeline of the number of environments against
+the latency, which shows where the API starts to degrade. It is written as JSON, or as HTML for a file ending .html.
+
+Example:
+PYTHONPATH=src python -m testing.load_generator --url http://127.0.0.1:8000 --users 20 --ramp-up 60 --duration 300 \
+    --mix create=1,run=1,list=5,get=5,terminate=1,scenario=2 --subscribers 5 --output report.html
+"""
+import argparse
+import asyncio
+import html
+import json
+import random
+import sys
+import time
+
+from collections import defaultdict
+from dataclasses import dataclass, field
+from typing import Any, Dict, Optional
+
+import httpx
+import websockets
+
+
+API = "/api/v1"
+OPERATIONS = ("create", "run", "list", "get", "terminate", "scenario")
+
+
+def percentile(values: list[float], p: float) -> Optional[float]:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+@dataclass
+class Recorder:
+    start: float = field(default_factory=time.perf_counter)
+    latencies: Dict[str, list[float]] = field(default_factory=lambda: defaultdict(list))
+    errors: Dict[str, int] = field(default_factory=lambda: defaultdict(int))
+    # Seconds since the start -> latencies of the requests finished in that second
+    timeline: Dict[int, list[float]] = field(default_factory=lambda: defaultdict(list))
+    environments: Dict[int, int] = field(default_factory=dict)
+    events: int = 0
+    subscriber_errors: int = 0
+
+    def record(self, operation: str, duration: float, success: bool) -> None:
+        self.latencies[operation].append(duration * 1000)
+        self.timeline[int(time.perf_counter() - self.start)].append(duration * 1000)
+        if not success:
+            self.errors[operation] += 1
+
+    def report(self, parameters: Dict[str, Any]) -> Dict[str, Any]:
+        elapsed = time.perf_counter() - self.start
+        operations = {}
+        for operation, latencies in sorted(self.latencies.items()):
+            operations[operation] = {
+                "requests": len(latencies),
+                "errors": self.errors[operation],
+                "error_rate": self.errors[operation] / len(latencies),
+                "throughput": len(latencies) / elapsed,
+                "mean": sum(latencies) / len(latencies),
+                "p50": percentile(latencies, 50),
+                "p95": percentile(latencies, 95),
+                "p99": percentile(latencies, 99),
+                "max": max(latencies),
+            }
+        timeline = [{"second": second, "environments": self.environments.get(second), "requests": len(latencies),
+                     "p50": percentile(latencies, 50), "p95": percentile(latencies, 95), "p99": percentile(latencies, 99)}
+                    for second, latencies in sorted(self.timeline.items())]
+        return {"parameters": parameters, "duration": elapsed, "operations": operations,
+                "websocket": {"events": self.events, "errors": self.subscriber_errors}, "timeline": timeline}
+
+
+class VirtualUser:
+    """
+    Performs the operations of the mix on its own environments, except for listing, which covers everybody's.
+    """
+    def __init__(self, client: httpx.AsyncClient, recorder: Recorder, scenario: str, mix: Dict[str, float],
+                 max_environments: int, population: list[str]):
+        self.client = client
+        self.recorder = recorder
+        self.scenario = scenario
+        self.operations, self.weights = list(mix), list(mix.values())
+        self.max_environments = max_environments
+        # Environments of all users, shared
+        self.population = population
+        self.environments: list[str] = []
+        # Environments that were not run yet
+        self.fresh: list[str] = []
+
+    async def request(self, operation: str, method: str, path: str, **kwargs) -> Optional[httpx.Response]:
+        start = time.perf_counter()
+        try:
+            response = await self.client.request(method, f"{API}{path}", **kwargs)
+        except httpx.HTTPError:
+            self.recorder.record(operation, time.perf_counter() - start, False)
+            return None
+        self.recorder.record(operation, time.perf_counter() - start, not response.is_error)
+        return response
+
+    async def step(self) -> None:
+        operation = random.choices(self.operations, self.weights)[0]
+        # Operations on an environment need one first
+        if operation in ("get", "terminate") and not self.environments or operation == "run" and not self.fresh:
+            operation = "create"
+
+        match operation:
+            case "create":
+                if len(self.population) >= self.max_environments:
+                    return
+                response = await self.request(operation, "POST", "/environment/create/", json={"configuration": self.scenario})
+                if response is not None and response.status_code == 201:
+                    id = response.json()["id"]
+                    self.environments.append(id)
+                    self.fresh.append(id)
+                    self.population.append(id)
+            case "run":
+                id = self.fresh.pop()
+                await self.request("init", "POST", "/environment/init/", params={"id": id})
+                await self.request(operation, "POST", "/environment/run/", params={"id": id})
+            case "get":
+                await self.request(operation, "GET", "/environment/get/", params={"id": random.choice(self.environments)})
+            case "list":
+                await self.request(operation, "GET", "/environment/list/")
+            case "terminate":
+                await self.terminate(self.environments[0])
+            case "scenario":
+                await self.request(operation, "GET", "/scenario/get/", params={"file_name": self.scenario})
+
+    async def terminate(self, id: str) -> None:
+        await self.request("terminate", "POST", "/environment/terminate/", params={"id": id})
+        self.environments.remove(id)
+        self.population.remove(id)
+        if id in self.fresh:
+            self.fresh.remove(id)
+
+    async def run(self, deadline: float, think_time: float) -> None:
+        while time.perf_counter() < deadline:
+            await self.step()
+            if think_time:
+                await asyncio.sleep(random.expovariate(1 / think_time))
+
+
+async def subscribe(url: str, recorder: Recorder, deadline: float) -> None:
+    try:
+        async with websockets.connect(url) as websocket:
+            while (remaining := deadline - time.perf_counter()) > 0:
+                try:
+                    await asyncio.wait_for(websocket.recv(), remaining)
+                    recorder.events += 1
+                except asyncio.TimeoutError:
+                    break
+    except (OSError, websockets.WebSocketException):
+        recorder.subscriber_errors += 1
+
+
+async def sample_environments(population: list[str], recorder: Recorder, deadline: float) -> None:
+    while time.perf_counter() < deadline:
+        recorder.environments[int(time.perf_counter() - recorder.start)] = len(population)
+        await asyncio.sleep(0.5)
+
+
+def parse_mix(mix: str) -> Dict[str, float]:
+    weights = {}
+    for item in mix.split(","):
+        operation, _, weight = item.partition("=")
+        if operation not in OPERATIONS:
+            raise argparse.ArgumentTypeError(f"Unknown operation '{operation}', use one of {', '.join(OPERATIONS)}.")
+        weights[operation] = float(weight or 1)
+    return weights
+
+
+def write_html(report: Dict[str, Any], f) -> None:
+    def cell(value) -> str:
+        return f"<td>{value:.2f}</td>" if isinstance(value, float) else f"<td>{html.escape(str(value))}</td>"
+
+    def table(rows: list[Dict[str, Any]], first: Optional[str] = None) -> str:
+        if not rows:
+            return "<p>No data.</p>"
+        columns = list(rows[0])
+        head = "".join(f"<th>{html.escape(c)}</th>" for c in columns)
+        body = "".join("<tr>" + "".join(cell(row[c]) for c in columns) + "</tr>" for row in rows)
+        return f"<table><tr>{head}</tr>{body}</table>"
+
+    operations = [{"operation": name, **values} for name, values in report["operations"].items()]
+    f.write("<!DOCTYPE html><html><head><meta charset='utf-8'><title>Dojo load report</title>"
+            "<style>body{font-family:sans-serif}table{border-collapse:collapse}td,th{border:1px solid #ccc;"
+            "padding:2px 8px;text-align:right}</style></head><body>")
+    f.write(f"<h1>Dojo load report</h1><pre>{html.escape(json.dumps(report['parameters'], indent=2))}</pre>")
+    f.write(f"<p>Duration: {report['duration']:.1f} s, websocket events: {report['websocket']['events']}, "
+            f"websocket errors: {report['websocket']['errors']}</p>")
+    f.write("<h2>Operations [ms]</h2>" + table(operations))
+    f.write("<h2>Timeline [ms]</h2>" + table(report["timeline"]))
+    f.write("</body></html>")
+
+
+async def main() -> int:
+    parser = argparse.ArgumentParser(description="Generate load on a Dojo API and report the latencies.")
+    parser.add_argument("--url", default="http://127.0.0.1:8000", help="Base URL of the API.")
+    parser.add_argument("--users", type=int, default=10, help="Number of concurrent virtual users.")
+    parser.add_argument("--ramp-up", type=float, default=10, help="Time over which the users are started [s].")
+    parser.add_argument("--duration", type=float, default=60, help="Duration of the test, including the ramp-up [s].")
+    parser.add_argument("--mix", type=parse_mix, default="create=1,run=1,list=5,get=5,terminate=1,scenario=1",
+                        help="Weights of the operations, as operation=weight pairs separated by commas.")
+    parser.add_argument("--subscribers", type=int, default=0, help="Number of websocket subscribers of the events.")
+    parser.add_argument("--scenario", default="configuration_1", help="Scenario of the created environments.")
+    parser.add_argument("--max-environments", type=int, default=100, help="Do not create more environments than this.")
+    parser.add_argument("--think-time", type=float, default=0, help="Mean pause of a user between operations [s].")
+    parser.add_argument("--output", default="load-report.json", help="Report file, HTML if it ends with .html.")
+    args = parser.parse_args()
+
+    recorder = Recorder()
+    deadline = recorder.start + args.duration
+    population: list[str] = []
+    limits = httpx.Limits(max_connections=args.users, max_keepalive_connections=args.users)
+    async with httpx.AsyncClient(base_url=args.url, limits=limits, timeout=httpx.Timeout(60)) as client:
+        users = [VirtualUser(client, recorder, args.scenario, args.mix, args.max_environments, population)
+                 for _ in range(args.users)]
+        events_url = args.url.replace("http", "ws", 1) + "/ws/events/"
+        tasks = [asyncio.create_task(sample_environments(population, recorder, deadline))]
+        tasks += [asyncio.create_task(subscribe(events_url, recorder, deadline)) for _ in range(args.subscribers)]
+        for user in users:
+            tasks.append(asyncio.create_task(user.run(deadline, args.think_time)))
+            await asyncio.sleep(args.ramp_up / args.users)
+        await asyncio.gather(*tasks)
+
+        report = recorder.report({key: value for key, value in vars(args).items() if key != "output"})
+        print("Cleaning up...", file=sys.stderr)
+        for user in users:
+            for id in list(user.environments):
+                await user.terminate(id)
+
+    with open(args.output, "w") as f:
+        if args.output.endswith(".html"):
+            write_html(report, f)
+        else:
+            json.dump(report, f, indent=2)
+
+    print(f"{'operation':<12}{'requests':>10}{'errors':>8}{'p50 [ms]':>10}{'p95 [ms]':>10}{'p99 [ms]':>10}")
+    for operation, values in report["operations"].items():
+        print(f"{operation:<12}{values['requests']:>10}{values['errors']:>8}{values['p50']:>10.1f}{values['p95']:>10.1f}"
+              f"{values['p99']:>10.1f}")
+    print(f"Report saved to {args.output}", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
@@ -0,0 +1,113 @@
+"""
+Loopback worker node. A node daemon is started on this host and registered with the app in this process (no server),
+and environments are created on it, initialized, run to the end and terminated, as they would be on a remote node. The
+durations of the actions are listed next to those of the same actions on local workers, which is the overhead of the TCP
+connections. Both the app and the daemon take NODE_AUTHKEY from the environment (or the .env file).
+
+Run from the repository root (for the .env file):
+NODE_AUTHKEY=... PYTHONPATH=src python -m testing.loopback_node [--scenario NAME] [--count N] [--port PORT]
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+from typing import Dict, Optional
+
+import httpx
+
+from dojo.app import app
+from dojo.core.config import settings
+from dojo.nodes import LOCAL_NODE
+
+ACTIONS = ["create", "init", "run", "terminate"]
+
+
+async def timed(client: httpx.AsyncClient, method: str, url: str, **kwargs) -> tuple[httpx.Response, float]:
+    start = time.perf_counter()
+    response = await client.request(method, url, **kwargs)
+    response.raise_for_status()
+    return response, (time.perf_counter() - start) * 1000
+
+
+async def episode(client: httpx.AsyncClient, scenario: str, node: str, timeout: float) -> Dict[str, float]:
+    """
+    Durations of the actions of a single environment on the node [ms].
+    """
+    api = settings.API_V1_STR
+    response, create = await timed(client, "POST", f"{api}/environment/create/", json={"configuration": scenario, "node": node})
+    id = response.json()["id"]
+    durations = {"create": create}
+    try:
+        _, durations["init"] = await timed(client, "POST", f"{api}/environment/init/?id={id}")
+        start = time.perf_counter()
+        await client.post(f"{api}/environment/run/?id={id}")
+        await client.get(f"{api}/environment/wait/?id={id}&state=FINISHED&timeout={timeout}")
+        durations["run"] = (time.perf_counter() - start) * 1000
+        environment = (await client.get(f"{api}/environment/get/?id={id}")).json()
+        if environment.get("node") != (None if node == LOCAL_NODE else node):
+            raise RuntimeError(f"The environment {id} ended up on {environment.get('node')}, not on {node}.")
+    finally:
+        _, durations["terminate"] = await timed(client, "POST", f"{api}/environment/terminate/?id={id}")
+    return durations
+
+
+def wait_for_daemon(daemon: subprocess.Popen, port: int, timeout: float = 10) -> None:
+    from dojo.nodes import Node, status
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            status(Node("loopback", "127.0.0.1", port, 0))
+            return
+        except OSError:
+            if daemon.poll() is not None or time.monotonic() > deadline:
+                raise RuntimeError("The node daemon did not start.")
+            time.sleep(0.1)
+
+
+async def main() -> int:
+    parser = argparse.ArgumentParser(description="Run environments on a loopback worker node.")
+    parser.add_argument("--scenario", default="configuration_1", help="Scenario to run.")
+    parser.add_argument("--count", type=int, default=5, help="Number of environments on each node.")
+    parser.add_argument("--port", type=int, default=9400, help="Port of the node daemon.")
+    parser.add_argument("--timeout", type=float, default=60, help="Maximum duration of a run [s].")
+    args = parser.parse_args()
+
+    daemon = subprocess.Popen([sys.executable, "-m", "dojo.node_daemon", "--listen", f"127.0.0.1:{args.port}",
+                               "--capacity", str(args.count)], env=os.environ.copy())
+    results: Dict[str, Dict[str, list[float]]] = {}
+    failed: Optional[str] = None
+    try:
+        wait_for_daemon(daemon, args.port)
+        transport = httpx.ASGITransport(app=app)
+        async with app.router.lifespan_context(app), httpx.AsyncClient(transport=transport, base_url="http://dojo", timeout=None) as client:
+            (await client.post(f"{settings.API_V1_STR}/nodes/register/",
+                               json={"name": "loopback", "host": "127.0.0.1", "port": args.port,
+                                     "capacity": args.count})).raise_for_status()
+            for node in (LOCAL_NODE, "loopback"):
+                results[node] = {action: [] for action in ACTIONS}
+                for _ in range(args.count):
+                    for action, duration in (await episode(client, args.scenario, node, args.timeout)).items():
+                        results[node][action].append(duration)
+            (await client.post(f"{settings.API_V1_STR}/nodes/unregister/?name=loopback")).raise_for_status()
+    except (httpx.HTTPStatusError, RuntimeError) as e:
+        failed = e.response.text if isinstance(e, httpx.HTTPStatusError) else str(e)
+    finally:
+        daemon.terminate()
+        daemon.wait()
+
+    print(f"{'action':<12}" + "".join(f"{node + ' p50 [ms]':>20}" for node in results))
+    for action in ACTIONS:
+        print(f"{action:<12}" + "".join(f"{statistics.median(r[action]):>20.2f}" if r[action] else f"{'-':>20}"
+                                        for r in results.values()))
+    if failed:
+        print(f"Failed: {failed}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
@@ -0,0 +1,77 @@
+"""
+Between-episode reset latency. Every scenario is initialized, run to the end and reset, repeatedly, with each of the
+reset modes: full (the environment resets itself), incremental (the worker is replaced by a fork of the baseline saved
+after the initialization) and recreate (the worker is replaced by a fresh one, which is initialized). The scenarios are
+listed with the size of their configuration, as that is what the cost of recreating grows with.
+
+Run from the repository root (for the .env file):
+PYTHONPATH=src python -m testing.reset_benchmark [--scenarios NAME ...] [--modes MODE ...] [--repetitions N]
+"""
+import argparse
+import asyncio
+import statistics
+import sys
+import time
+
+from cyst.api.environment.platform_specification import PlatformSpecification, PlatformType
+from fastapi import HTTPException
+
+from dojo.controller import EnvironmentWrapper, EnvironmentAction, EnvironmentState, ResetMode
+from dojo.lib import util
+from dojo.lib.util import agent_port_allocator
+
+
+async def measure(configuration: str, mode: ResetMode, repetitions: int, timeout: float) -> list[float]:
+    """
+    Durations of the resets after each run [ms].
+    """
+    wrapper = EnvironmentWrapper(PlatformSpecification(PlatformType.SIMULATED_TIME, "CYST"), None, configuration, None,
+                                 agent_port_allocator.allocate())
+    await wrapper.start()
+    try:
+        await wrapper.perform_action(EnvironmentAction.INIT)
+        if mode == ResetMode.INCREMENTAL:
+            await wrapper.save_baseline()
+
+        durations = []
+        for _ in range(repetitions):
+            await wrapper.perform_action(EnvironmentAction.RUN)
+            await asyncio.wait_for(wrapper.wait_for_state({EnvironmentState.FINISHED.name}), timeout)
+            start = time.perf_counter()
+            await wrapper.reset(mode)
+            durations.append((time.perf_counter() - start) * 1000)
+        return durations
+    finally:
+        if wrapper.state != EnvironmentState.TERMINATED.name:
+            await wrapper.perform_action(EnvironmentAction.TERMINATE)
+
+
+async def main() -> int:
+    parser = argparse.ArgumentParser(description="Compare the latency of the reset modes across scenarios.")
+    parser.add_argument("--scenarios", nargs="+", default=None, help="Scenarios to measure, all by default.")
+    parser.add_argument("--modes", nargs="+", default=[mode.value for mode in ResetMode], choices=[mode.value for mode in ResetMode])
+    parser.add_argument("--repetitions", type=int, default=10, help="Number of episodes (and resets) for each mode.")
+    parser.add_argument("--timeout", type=float, default=60, help="Maximum duration of a run [s].")
+    args = parser.parse_args()
+
+    failed = False
+    print(f"{'scenario':<30}{'size [kB]':>10}{'mode':>13}{'mean [ms]':>11}{'p50 [ms]':>10}{'max [ms]':>10}")
+    for scenario in args.scenarios or sorted(util.list_scenario_files()):
+        with open(util.ensure_json_configuration(scenario), "r") as f:
+            configuration = f.read()
+        for mode in args.modes:
+            try:
+                durations = await measure(configuration, ResetMode(mode), args.repetitions, args.timeout)
+            except (HTTPException, asyncio.TimeoutError) as e:
+                failed = True
+                reason = e.detail.message if isinstance(e, HTTPException) else "the run timed out"
+                print(f"{scenario:<30}{len(configuration) / 1024:>10.1f}{mode:>13}  failed: {reason}")
+                continue
+            print(f"{scenario:<30}{len(configuration) / 1024:>10.1f}{mode:>13}{statistics.mean(durations):>11.2f}"
+                  f"{statistics.median(durations):>10.2f}{max(durations):>10.2f}")
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
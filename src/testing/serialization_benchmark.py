@@ -0,0 +1,71 @@
+"""
+Micro-benchmark of the response serialization of the controller. Compares the default FastAPI path (validation against
+the response model, encoding, json.dumps) with the orjson fast path used by the endpoints.
+
+Run from the repository root (for the .env file): PYTHONPATH=src python -m testing.serialization_benchmark
+"""
+import json
+import timeit
+
+from dataclasses import asdict
+
+from fastapi.encoders import jsonable_encoder
+from pydantic import TypeAdapter
+
+from dojo.api.responses import FastJSONResponse
+from dojo.controller import ActionResponse
+from dojo.lib import util
+from dojo.schemas.configuration import ScenarioOut
+from dojo.schemas.environment import EnvironmentOut
+
+
+def default_path(adapter: TypeAdapter, content) -> bytes:
+    # What FastAPI does for an endpoint with a response model, followed by JSONResponse.render()
+    value = adapter.dump_python(adapter.validate_python(content, from_attributes=True), mode="json")
+    return json.dumps(value, ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")).encode("utf-8")
+
+
+def default_error_path(content: ActionResponse) -> bytes:
+    # asdict() when raising the HTTPException, then the default exception handler
+    return json.dumps(jsonable_encoder({"detail": asdict(content)})).encode("utf-8")
+
+
+def fast_path(content) -> bytes:
+    return FastJSONResponse(content).body
+
+
+def fast_error_path(content: ActionResponse) -> bytes:
+    return FastJSONResponse({"detail": content}).body
+
+
+def main(number: int = 2000) -> None:
+    action_response = ActionResponse("environment", "RUNNING", True, "The environment is running.")
+    # Dumped from the model, so the dicts have every field that EnvironmentWrapper.describe() returns
+    environments_list = [
+        EnvironmentOut(id=f"environment-{i}", platform="SIMULATED_TIME", provider="CYST", state="RUNNING",
+                       agent_manager_port=8283 + i, configuration="configuration_1").model_dump() for i in range(100)
+    ]
+    scenario = ScenarioOut(configuration_json=util.read_scenario_file("configuration_1"), description="")
+
+    # FastAPI builds the adapters once per route, so they are not part of the measurement
+    action_adapter = TypeAdapter(ActionResponse)
+    environments_adapter = TypeAdapter(list[EnvironmentOut])
+    scenario_adapter = TypeAdapter(ScenarioOut)
+
+    cases = [
+        ("ActionResponse", lambda: default_path(action_adapter, action_response), lambda: fast_path(action_response)),
+        ("ActionResponse (error)", lambda: default_error_path(action_response), lambda: fast_error_path(action_response)),
+        ("100 x EnvironmentOut", lambda: default_path(environments_adapter, environments_list), lambda: fast_path(environments_list)),
+        ("ScenarioOut", lambda: default_path(scenario_adapter, scenario), lambda: fast_path(scenario)),
+    ]
+
+    print(f"{'Response':<25}{'default [us]':>15}{'fast [us]':>15}{'speedup':>10}")
+    for name, default, fast in cases:
+        assert json.loads(default()) == json.loads(fast())
+        default_time = min(timeit.repeat(default, number=number, repeat=3)) / number * 1e6
+        fast_time = min(timeit.repeat(fast, number=number, repeat=3)) / number * 1e6
+        print(f"{name:<25}{default_time:>15.2f}{fast_time:>15.2f}{default_time / fast_time:>9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
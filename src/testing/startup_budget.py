@@ -0,0 +1,53 @@
+"""
+Import time report of the API process and an environment worker, checked against the startup budgets. Exits with a
+non-zero status if any of the processes is over its budget. tests/test_startup_budget.py runs the same check as part of
+the test suite, to guard against regressions, e.g., a slow agent.
+
+Run from the repository root (for the .env file):
+PYTHONPATH=src python -m testing.startup_budget [--api-budget MS] [--worker-budget MS] [--top N]
+"""
+import argparse
+import asyncio
+import sys
+
+from dojo.agents import agent_registry
+from dojo.core.config import settings
+from dojo.lib.importtime import profile_imports, ImportReport
+
+
+def print_report(report: ImportReport, top: int) -> None:
+    budget = f"{report.budget:.0f} ms" if report.budget is not None else "none"
+    status = "OVER BUDGET" if report.over_budget else "ok"
+    print(f"{report.process}: {report.total_time:.1f} ms (budget: {budget}) {status}")
+    print(f"  {'package':<30}{'distribution':<30}{'self [ms]':>12}{'cumul. [ms]':>12}{'modules':>9}")
+    for package in report.packages[:top]:
+        name = package.package + (" [agent]" if package.agent else "")
+        print(f"  {name:<30}{package.distribution or '':<30}{package.self_time:>12.1f}{package.cumulative_time:>12.1f}"
+              f"{package.modules:>9}")
+
+    agents = [package for package in report.packages if package.agent]
+    if agents:
+        print(f"  agents: {sum(package.self_time for package in agents):.1f} ms")
+    print()
+
+
+async def main() -> int:
+    parser = argparse.ArgumentParser(description="Report import times and check them against the startup budgets.")
+    parser.add_argument("--api-budget", type=float, default=settings.IMPORT_BUDGET_API, help="Budget of the API process [ms].")
+    parser.add_argument("--worker-budget", type=float, default=settings.IMPORT_BUDGET_WORKER, help="Budget of a worker [ms].")
+    parser.add_argument("--top", type=int, default=15, help="Number of the slowest packages to list.")
+    args = parser.parse_args()
+
+    settings.IMPORT_BUDGET_API = args.api_budget
+    settings.IMPORT_BUDGET_WORKER = args.worker_budget
+
+    agents = {agent.package_name for agent in await agent_registry.list()}
+    reports = await profile_imports(agents)
+    for report in reports:
+        print_report(report, args.top)
+
+    return 1 if any(report.over_budget for report in reports) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
@@ -0,0 +1,35 @@
+"""
+Startup budgets: fails when the imports of the API process or of an environment worker take longer than their budget
+(IMPORT_BUDGET_API, IMPORT_BUDGET_WORKER [ms], see dojo.lib.importtime), e.g., after adding a slow agent. Skipped for
+processes without a budget. testing/startup_budget.py prints the full report.
+"""
+import asyncio
+
+import pytest
+
+from dojo.agents import agent_registry
+from dojo.core.config import settings
+from dojo.lib.importtime import profile_imports, ImportReport
+
+
+@pytest.fixture(scope="module")
+def reports() -> dict[str, ImportReport]:
+    if settings.IMPORT_BUDGET_API is None and settings.IMPORT_BUDGET_WORKER is None:
+        pytest.skip("No startup budget is set.")
+
+    async def profile() -> dict[str, ImportReport]:
+        agents = {agent.package_name for agent in await agent_registry.list()}
+        return {report.process: report for report in await profile_imports(agents)}
+
+    return asyncio.run(profile())
+
+
+@pytest.mark.parametrize("process", ["api", "worker"])
+def test_imports_within_budget(reports: dict[str, ImportReport], process: str):
+    report = reports[process]
+    if report.budget is None:
+        pytest.skip(f"No startup budget is set for the {process} process.")
+
+    slowest = ", ".join(f"{package.package} ({package.self_time:.0f} ms)" for package in report.packages[:5])
+    assert not report.over_budget, (f"The imports of the {process} process took {report.total_time:.0f} ms, over the "
+                                    f"budget of {report.budget:.0f} ms. Slowest packages: {slowest}.")